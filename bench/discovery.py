@@ -0,0 +1,93 @@
+# bench/discovery.py
+"""
+Tráfico de descubrimiento según el número de nodos.
+
+  python bench/discovery.py --nodes 4 8 16 32 --duration 6
+
+Para cada N arranca N nodos con `presence` sobre linksim (intervalos
+acortados vía LINKCHAT_BEACON_INTERVAL) y mide:
+  - tramas por segundo en régimen (tras la convergencia)
+  - tiempo hasta que todos los nodos ven a todos
+  - tramas extra al unirse un nodo nuevo
+y lo compara con el sondeo antiguo (cada nodo: 1 broadcast + N-1 respuestas
+unicast cada 3 s), calculado de forma analítica.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from linksim import Link, Node, mac_for  # noqa: E402
+
+LEGACY_PERIOD = 3.0
+
+
+def _wait_converged(mods, expected: int, timeout: float) -> float:
+    start = time.time()
+    while time.time() - start < timeout:
+        if all(
+            sum(p["named"] for p in m.get_peers().values()) >= expected for m in mods
+        ):
+            return time.time() - start
+        time.sleep(0.02)
+    return float("nan")
+
+
+def run(n: int, duration: float, beacon: float) -> dict:
+    os.environ["LINKCHAT_BEACON_INTERVAL"] = str(beacon)
+    cache_dir = tempfile.mkdtemp()
+    link = Link()
+    mods = []
+
+    def add_node(i: int, name: str):
+        node = Node(link, mac_for(i))
+        # caché propia y vacía: se mide el arranque en frío
+        os.environ["LINKCHAT_PEER_CACHE"] = os.path.join(cache_dir, f"{i}.json")
+        mod = node.load("presence")
+        mod.start(node.mac, name=name)
+        mods.append(mod)
+
+    for i in range(n):
+        add_node(i + 1, f"bench{i}")
+
+    converge = _wait_converged(mods, n - 1, timeout=10 * beacon)
+    time.sleep(beacon)  # dejar pasar la ráfaga de arranque
+    link.reset_counters()
+    time.sleep(duration)
+    steady = link.frames / duration
+
+    link.reset_counters()
+    add_node(n + 1, "joiner")
+    join_time = _wait_converged(mods, n, timeout=10 * beacon)
+    join_frames = link.frames
+
+    for mod in mods:
+        mod.stop()
+    return {
+        "nodes": n,
+        "beacon_interval": beacon,
+        "converge_s": round(converge, 3),
+        "steady_frames_per_s": round(steady, 2),
+        "join_s": round(join_time, 3),
+        "join_frames": join_frames,
+        "legacy_frames_per_s": round(n * n / LEGACY_PERIOD, 2),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--nodes", type=int, nargs="+", default=[4, 8, 16, 32])
+    ap.add_argument("--duration", type=float, default=6.0)
+    ap.add_argument("--beacon", type=float, default=2.0)
+    args = ap.parse_args()
+
+    results = [run(n, args.duration, args.beacon) for n in args.nodes]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
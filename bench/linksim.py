@@ -0,0 +1,174 @@
+# bench/linksim.py
+"""
+Enlace Ethernet simulado en memoria para los benchmarks: cada nodo carga
+su propia copia de los módulos de src/ con un `ethernet` falso que entrega
+las tramas a los demás nodos (con pérdida y retardo opcionales) sin
+sockets raw.
+"""
+import importlib.util
+import os
+import queue
+import random
+import struct
+import sys
+import threading
+import time
+import types
+from typing import Callable, Dict, List, Optional
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+import protocol  # noqa: E402
+from pcap import PcapWriter  # noqa: E402
+
+BROADCAST_MAC = "ff:ff:ff:ff:ff:ff"
+
+
+def load_module(name: str, alias: str, overrides: Dict[str, types.ModuleType]):
+    """Carga src/<name>.py como módulo nuevo `alias` viendo `overrides` al importar."""
+    saved = {k: sys.modules.get(k) for k in overrides}
+    sys.modules.update(overrides)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            alias, os.path.join(SRC_DIR, f"{name}.py")
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                sys.modules.pop(k, None)
+            else:
+                sys.modules[k] = v
+    return module
+
+
+class Link:
+    """
+    Segmento compartido: cuenta tramas y bytes por tipo de mensaje.
+    loss: probabilidad de perder cada trama; delay: retardo de ida en
+    segundos (RTT = 2 * delay); capture: ruta pcap donde grabar todas las
+    tramas enviadas (para bench/replay.py); drop: drop(payload) -> True
+    descarta esa trama (pérdidas dirigidas, p. ej. solo el FILE_END).
+    """
+
+    def __init__(
+        self,
+        loss: float = 0.0,
+        delay: float = 0.0,
+        capture: Optional[str] = None,
+        drop: Optional[Callable[[bytes], bool]] = None,
+    ):
+        self.loss = loss
+        self.delay = delay
+        self.drop = drop
+        self.capture = PcapWriter(capture) if capture else None
+        self.nodes: Dict[str, "Node"] = {}
+        self.frames = 0
+        self.bytes = 0
+        self.by_type: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.frames = 0
+            self.bytes = 0
+            self.by_type = {}
+
+    def send(self, src: str, dest: str, payload: bytes) -> None:
+        with self._lock:
+            self.frames += 1
+            self.bytes += 14 + len(payload)
+            if len(payload) >= protocol.HEADER_LEN:
+                t = payload[1]
+                self.by_type[t] = self.by_type.get(t, 0) + 1
+        if self.capture is not None:
+            self.capture.write(eth_frame(dest, src, payload))
+        if self.drop is not None and self.drop(payload):
+            return
+        due = time.monotonic() + self.delay
+        for mac, node in self.nodes.items():
+            if mac == src or dest not in (mac, BROADCAST_MAC):
+                continue
+            if self.loss and random.random() < self.loss:
+                continue
+            node.inbox.put((due, src, payload))
+
+
+class Node:
+    """Un host del enlace con su propio módulo `ethernet` falso."""
+
+    def __init__(self, link: Link, mac: str):
+        self.link = link
+        self.mac = mac
+        self.inbox: "queue.Queue" = queue.Queue()
+        self.channels: Dict[int, List[Callable]] = {}
+        self.observers: List[Callable] = []
+        self.ethernet = self._fake_ethernet()
+        link.nodes[mac] = self
+        threading.Thread(target=self._deliver, daemon=True).start()
+
+    def _fake_ethernet(self) -> types.ModuleType:
+        eth = types.ModuleType("ethernet")
+        eth.INTERFACE = "sim0"
+        eth.ETH_P_LINKCHAT = 0x1234
+        eth.send_frame = lambda dest, payload, eth_type=0x1234: self.link.send(
+            self.mac, dest, payload
+        )
+        eth.register_channel_callback = lambda ch, cb: self.channels.setdefault(
+            ch, []
+        ).append(cb)
+        eth.register_frame_observer = self.observers.append
+        eth.flush_tx = lambda timeout=2.0: True
+        eth.set_tx_weight = lambda file_id, weight: None
+        eth.recv_one = self._recv_one
+        eth.start_recv_loop = lambda *a, **k: None
+        eth.stop_recv_loop = lambda *a, **k: None
+        eth.get_interface_mac = lambda iface: bytes.fromhex(self.mac.replace(":", ""))
+        return eth
+
+    def _recv_one(self, eth_type: int = 0x1234):
+        raise NotImplementedError("linksim entrega las tramas por callbacks")
+
+    def load(self, name: str, **deps: types.ModuleType):
+        """Copia propia de src/<name>.py enlazada a este nodo."""
+        overrides = {"ethernet": self.ethernet, **deps}
+        return load_module(name, f"{name}_{self.mac.replace(':', '')}", overrides)
+
+    def _deliver(self) -> None:
+        while True:
+            due, src, payload = self.inbox.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)  # retardo fijo: el orden de llegada se mantiene
+            self.dispatch(src, payload)
+
+    def dispatch(self, src: str, payload: bytes) -> None:
+        """Entrega una trama como ethernet._dispatch_frame, en el hilo que llama."""
+        for observer in self.observers:
+            observer(src)
+        try:
+            channel = protocol.parse_header(payload)["channel"]
+        except Exception:
+            return
+        for cb in self.channels.get(channel, []):
+            try:
+                cb(src, payload)
+            except Exception as e:
+                print(f"[linksim] error en callback de {self.mac}: {e}")
+
+
+def eth_frame(dest: str, src: str, payload: bytes, eth_type: int = 0x1234) -> bytes:
+    """Trama Ethernet completa (sin FCS), como la ve un socket raw."""
+    return (
+        bytes.fromhex(dest.replace(":", ""))
+        + bytes.fromhex(src.replace(":", ""))
+        + struct.pack("!H", eth_type)
+        + payload
+    )
+
+
+def mac_for(i: int) -> str:
+    return "02:00:" + ":".join(f"{b:02x}" for b in i.to_bytes(4, "big"))
@@ -0,0 +1,246 @@
+# bench/replay.py
+"""
+Reinyecta una captura pcap en la cadena de callbacks de canal, sin NIC,
+para perfilar la recepción (files, messaging, groups) con tráfico real.
+
+  python bench/replay.py cap.pcap                      # a máxima velocidad
+  python bench/replay.py cap.pcap --speed 1            # al ritmo original
+  python bench/replay.py cap.pcap --profile recv.prof  # cProfile (pstats)
+  python bench/replay.py cap.pcap --record --size 4194304 --loss 0.01
+
+Las capturas salen de LINKCHAT_PCAP (ethernet) o de --record, que graba
+una transferencia sobre linksim. El nodo que recibe es --local (por
+defecto el destino unicast más frecuente): se le entregan las tramas
+LinkChat dirigidas a él o a broadcast/multicast que no envió él mismo, y
+sus respuestas (ACK, NACK...) van a un enlace sin otros nodos. El JSON
+lleva el commit para comparar el camino de recepción entre versiones.
+"""
+import argparse
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from linksim import Link, Node, mac_for  # noqa: E402  (agrega src/ al path)
+
+import protocol  # noqa: E402
+from pcap import read_pcap  # noqa: E402
+from suite import _git  # noqa: E402
+
+ETH_P_LINKCHAT = 0x1234
+
+Frame = Tuple[float, str, bytes]  # (timestamp, mac origen, payload)
+
+
+def _mac(raw: bytes) -> str:
+    return ":".join(f"{b:02x}" for b in raw)
+
+
+def load_capture(path: str, local: Optional[str] = None) -> Tuple[str, List[Frame]]:
+    """
+    Lee la captura y devuelve (mac local, tramas a entregar). Sin `local`
+    se toma el destino unicast más frecuente de las tramas LinkChat.
+    """
+    linkchat = []
+    dests: Counter = Counter()
+    for ts, raw in read_pcap(path):
+        if len(raw) < 14 or raw[12:14] != ETH_P_LINKCHAT.to_bytes(2, "big"):
+            continue
+        linkchat.append((ts, raw))
+        if not raw[0] & 1:
+            dests[raw[:6]] += 1
+    if local is None:
+        if not dests:
+            raise SystemExit("la captura no tiene tramas unicast: indica --local")
+        local = _mac(dests.most_common(1)[0][0])
+    local = local.lower()
+    frames = []
+    for ts, raw in linkchat:
+        dest, src = _mac(raw[:6]), _mac(raw[6:12])
+        if src == local or (dest != local and not raw[0] & 1):
+            continue
+        frames.append((ts, src, raw[14:]))
+    return local, frames
+
+
+def _receiver(local: str, recv_dir: str):
+    """Nodo `local` con su copia de files/folders/messaging/groups escuchando."""
+    node = Node(Link(), local)
+    files = node.load("files")
+    # files importa folders al recibir partes de carpeta
+    sys.modules["folders"] = node.load("folders", files=files)
+    os.environ["RECV_DIR"] = recv_dir
+    messaging = node.load("messaging", presence=node.load("presence"))
+    groups = node.load("groups")
+    outcome: Counter = Counter()
+
+    files.start_file_loop(lambda s, path, status: outcome.update([status]), local)
+    messaging.start_message_loop(lambda s, text: outcome.update(["message"]))
+    groups.start_group_loop(local, lambda *a: outcome.update(["group_message"]))
+    return node, files, outcome
+
+
+def replay(
+    frames: List[Frame],
+    local: str,
+    speed: float = 0.0,
+    profiler: Optional[cProfile.Profile] = None,
+) -> Dict:
+    """
+    Entrega las tramas al nodo en el hilo actual. speed=0: lo más rápido
+    posible; speed=1: respetando los tiempos de la captura (2 = el doble
+    de rápido...).
+    """
+    work = tempfile.mkdtemp(prefix="lcreplay-")
+    node, files, outcome = _receiver(local, os.path.join(work, "recv"))
+    per_channel: Dict[int, List[float]] = {}
+    lag = 0.0
+    nbytes = 0
+    base_ts = frames[0][0] if frames else 0.0
+    clock = time.perf_counter
+    start = clock()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        for ts, src, payload in frames:
+            if speed > 0:
+                due = start + (ts - base_ts) / speed
+                wait = due - clock()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    lag = max(lag, -wait)
+            t0 = clock()
+            node.dispatch(src, payload)
+            channel = payload[2] if len(payload) > 2 else 0
+            stats = per_channel.setdefault(channel, [0, 0])
+            stats[0] += 1
+            stats[1] += clock() - t0
+            nbytes += 14 + len(payload)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    elapsed = clock() - start
+    files.stop_file_loop()
+    sys.modules.pop("folders", None)
+    shutil.rmtree(work, ignore_errors=True)
+    return {
+        "frames": len(frames),
+        "bytes": nbytes,
+        "elapsed_s": round(elapsed, 4),
+        "frames_per_s": round(len(frames) / elapsed, 1) if elapsed else None,
+        "mb_per_s": round(nbytes / elapsed / 1e6, 3) if elapsed else None,
+        "max_lag_ms": round(lag * 1000, 3) if speed > 0 else None,
+        "channels": {
+            protocol.CHANNEL_NAMES.get(ch, str(ch)): {
+                "frames": n,
+                "callback_s": round(t, 4),
+                "us_per_frame": round(t / n * 1e6, 2),
+            }
+            for ch, (n, t) in sorted(per_channel.items())
+        },
+        "outcome": dict(outcome),
+        "replies": node.link.frames,
+    }
+
+
+def record(path: str, size: int, loss: float, messages: int) -> None:
+    """Graba en `path` una transferencia de `size` bytes y `messages` mensajes."""
+    work = tempfile.mkdtemp(prefix="lcrecord-")
+    try:
+        link = Link(loss=loss, capture=path)
+        a, b = Node(link, mac_for(1)), Node(link, mac_for(2))
+        fa, fb = a.load("files"), b.load("files")
+        os.environ["RECV_DIR"] = os.path.join(work, "recv")
+        ma = a.load("messaging", presence=a.load("presence"))
+        mb = b.load("messaging", presence=b.load("presence"))
+        got: List[str] = []
+        fb.start_file_loop(lambda s, p, status: got.append(status), b.mac)
+        fa.start_file_loop(lambda s, p, status: None, a.mac)
+        mb.start_message_loop(lambda s, text: got.append("message"))
+        ma.start_message_loop(lambda s, text: None)
+        src = os.path.join(work, "payload.bin")
+        with open(src, "wb") as fh:
+            fh.write(os.urandom(size))
+        for i in range(messages):
+            ma.send_message(b.mac, f"mensaje {i}")
+        fa.send_file(b.mac, src, timeout=0.05, retries=50)
+        deadline = time.time() + 10
+        while got.count("message") < messages and time.time() < deadline:
+            time.sleep(0.01)
+        fa.stop_file_loop()
+        fb.stop_file_loop()
+        link.capture.close()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("capture", help="archivo pcap")
+    ap.add_argument("--local", help="MAC del nodo que recibe")
+    ap.add_argument(
+        "--speed", type=float, default=0.0, help="0 = máxima, 1 = ritmo original"
+    )
+    ap.add_argument("--repeat", type=int, default=1, help="rondas (nodo nuevo c/u)")
+    ap.add_argument("--profile", help="guarda el cProfile de todas las rondas")
+    ap.add_argument("--out", help="archivo JSON de salida (por defecto stdout)")
+    ap.add_argument("--verbose", action="store_true", help="no descartar los logs")
+    ap.add_argument("--record", action="store_true", help="grabar antes la captura")
+    ap.add_argument("--size", type=int, default=1024 * 1024, help="con --record")
+    ap.add_argument("--loss", type=float, default=0.0, help="con --record")
+    ap.add_argument("--messages", type=int, default=50, help="con --record")
+    args = ap.parse_args()
+
+    sink = sys.stdout if args.verbose else open(os.devnull, "w")
+    if args.record:
+        print(f"[replay] grabando {args.capture}...", file=sys.stderr, flush=True)
+        with contextlib.redirect_stdout(sink):
+            record(args.capture, args.size, args.loss, args.messages)
+
+    local, frames = load_capture(args.capture, args.local)
+    print(
+        f"[replay] {len(frames)} tramas hacia {local}", file=sys.stderr, flush=True
+    )
+    profiler = cProfile.Profile() if args.profile else None
+    rounds = []
+    with contextlib.redirect_stdout(sink):
+        for _ in range(max(1, args.repeat)):
+            rounds.append(replay(frames, local, args.speed, profiler))
+
+    report = {
+        "meta": {
+            "commit": _git("rev-parse", "--short", "HEAD") or None,
+            "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+            "capture": os.path.abspath(args.capture),
+            "local": local,
+            "speed": args.speed,
+        },
+        "rounds": rounds,
+        "best_frames_per_s": max(r["frames_per_s"] or 0 for r in rounds),
+    }
+    if profiler is not None:
+        profiler.dump_stats(args.profile)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats("cumulative").print_stats(15)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as fh:
+            fh.write(text + "\n")
+        print(f"[replay] resultado en {args.out}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
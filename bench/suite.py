@@ -0,0 +1,465 @@
+# bench/suite.py
+"""
+Benchmarks reproducibles de LinkChat, sin root ni NIC real.
+
+  python bench/suite.py                       # todo, resultado JSON a stdout
+  python bench/suite.py --quick --out r.json  # grilla reducida, a archivo
+  python bench/suite.py --only codec files
+
+Secciones:
+  codec      build/parse de headers, rangos de NACK y clasificación (ns/op)
+  chat       latencia de mensajes fiables (p50/p90/p99) según pérdida y RTT
+  files      throughput de send_file según tamaño, pérdida y RTT
+  folders    send_folder con muchos archivos pequeños
+  discovery  costo de presence según el número de nodos (bench/discovery.py)
+  flask      endpoints de la web con clientes concurrentes (WSGI en proceso)
+
+Todo corre sobre linksim (enlace en memoria); el JSON lleva el commit y la
+plataforma para comparar corridas entre commits. Los logs de los módulos
+se descartan mientras se mide.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from linksim import Link, Node, mac_for  # noqa: E402  (agrega src/ al path)
+
+import protocol  # noqa: E402
+
+SECTIONS = ("codec", "chat", "files", "folders", "discovery", "flask")
+
+# grillas por defecto y reducidas (--quick)
+GRIDS = {
+    "full": {
+        "chat_count": 500,
+        "chat_loss": [0.0, 0.05],
+        "chat_rtt": [0.0, 0.01],
+        "file_sizes": [64 * 1024, 1024 * 1024, 4 * 1024 * 1024],
+        "file_loss": [0.0, 0.01],
+        "file_rtt": [0.0, 0.002],
+        "folder_files": 500,
+        "discovery_nodes": [4, 8, 16, 32],
+        "discovery_duration": 4.0,
+        "flask_clients": [1, 4, 16],
+        "flask_requests": 200,
+    },
+    "quick": {
+        "chat_count": 200,
+        "chat_loss": [0.0, 0.05],
+        "chat_rtt": [0.0],
+        "file_sizes": [64 * 1024, 1024 * 1024],
+        "file_loss": [0.0, 0.01],
+        "file_rtt": [0.0],
+        "folder_files": 150,
+        "discovery_nodes": [4, 8],
+        "discovery_duration": 2.0,
+        "flask_clients": [1, 8],
+        "flask_requests": 50,
+    },
+}
+
+
+def percentiles(values: List[float], scale: float = 1000.0) -> Dict[str, float]:
+    """p50/p90/p99/max por rango más cercano (en ms con la escala por defecto)."""
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        idx = min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))
+        return round(ordered[idx] * scale, 3)
+
+    return {
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": round(ordered[-1] * scale, 3),
+    }
+
+
+def _wait_for(cond: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.005)
+    return cond()
+
+
+def _isolated(fn: Callable[..., Dict], **params) -> Dict:
+    """Corre un caso; si falla queda el error en el JSON y se sigue."""
+    try:
+        return fn(**params)
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        return {**params, "error": f"{type(e).__name__}: {e}"}
+
+
+# --- codec -------------------------------------------------------------------
+
+
+def _ns_per_op(fn: Callable[[], object], number: int, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return round(best / number * 1e9, 1)
+
+
+def bench_codec(grid: Dict) -> List[Dict]:
+    import scheduler
+
+    payload = os.urandom(1400)
+    fid = protocol.new_file_id()
+    frame = protocol.build_header(
+        protocol.FILE_CHUNK, payload, channel=protocol.FILE_CHANNEL, seq=7, file_id=fid
+    )
+    ranges = [(i * 10 + 1, i * 10 + 5) for i in range(100)]
+    packed = protocol.pack_ranges(ranges, max_len=1400)
+    cases = {
+        "build_header_1400": lambda: protocol.build_header(
+            protocol.FILE_CHUNK,
+            payload,
+            channel=protocol.FILE_CHANNEL,
+            seq=7,
+            file_id=fid,
+        ),
+        "parse_header_1400": lambda: protocol.parse_header(frame),
+        "pack_ranges_100": lambda: protocol.pack_ranges(ranges, max_len=1400),
+        "unpack_ranges_100": lambda: protocol.unpack_ranges(packed),
+        "classify": lambda: scheduler.classify(frame),
+    }
+    return [
+        {"op": name, "ns_per_op": _ns_per_op(fn, 20000)} for name, fn in cases.items()
+    ]
+
+
+# --- chat --------------------------------------------------------------------
+
+
+def bench_chat_case(count: int, loss: float, rtt: float) -> Dict:
+    link = Link(loss=loss, delay=rtt / 2)
+    a, b = Node(link, mac_for(1)), Node(link, mac_for(2))
+    ma = a.load("messaging", presence=a.load("presence"))
+    mb = b.load("messaging", presence=b.load("presence"))
+    sent_at: Dict[str, float] = {}
+    latencies: List[float] = []
+
+    def on_message(src: str, text: str) -> None:
+        latencies.append(time.perf_counter() - sent_at[text])
+
+    mb.start_message_loop(on_message)
+    ma.start_message_loop(lambda src, text: None)
+    ma._reliable_peers.add(b.mac)  # sin presence: forzar el modo fiable
+
+    start = time.perf_counter()
+    for i in range(count):
+        text = f"bench:{i}"
+        sent_at[text] = time.perf_counter()
+        ma.send_message(b.mac, text)
+        time.sleep(0.001)  # ~1000 msg/s: latencia, no caudal
+    _wait_for(lambda: len(latencies) >= count, timeout=30 + count * rtt)
+    elapsed = time.perf_counter() - start
+    return {
+        "messages": count,
+        "loss": loss,
+        "rtt_ms": rtt * 1000,
+        "delivered": len(latencies),
+        "latency_ms": percentiles(latencies),
+        "frames": link.frames,
+        "elapsed_s": round(elapsed, 3),
+    }
+
+
+def bench_chat(grid: Dict) -> List[Dict]:
+    return [
+        _isolated(bench_chat_case, count=grid["chat_count"], loss=loss, rtt=rtt)
+        for loss in grid["chat_loss"]
+        for rtt in grid["chat_rtt"]
+    ]
+
+
+# --- files y folders ---------------------------------------------------------
+
+
+def _file_pair(loss: float, rtt: float, recv_dir: str):
+    """Emisor y receptor con su copia de files/folders sobre un Link nuevo."""
+    link = Link(loss=loss, delay=rtt / 2)
+    a, b = Node(link, mac_for(1)), Node(link, mac_for(2))
+    fa, fb = a.load("files"), b.load("files")
+    fola = a.load("folders", files=fa)
+    folb = b.load("folders", files=fb)
+    # files importa folders al recibir partes de carpeta: la del receptor
+    sys.modules["folders"] = folb
+    os.environ["RECV_DIR"] = recv_dir
+    return link, a, b, fa, fb, fola
+
+
+def bench_file_case(size: int, loss: float, rtt: float) -> Dict:
+    work = tempfile.mkdtemp(prefix="lcbench-")
+    recv_dir = os.path.join(work, "recv")
+    src = os.path.join(work, "payload.bin")
+    data = os.urandom(size)
+    with open(src, "wb") as fh:
+        fh.write(data)
+
+    link, a, b, fa, fb, _ = _file_pair(loss, rtt, recv_dir)
+    done: Dict[str, str] = {}
+    fb.start_file_loop(lambda s, path, status: done.setdefault(status, path), b.mac)
+    fa.start_file_loop(lambda s, path, status: None, a.mac)
+
+    try:
+        start = time.perf_counter()
+        fa.send_file(b.mac, src, timeout=max(0.05, 4 * rtt + 0.02), retries=50)
+        _wait_for(lambda: "completed" in done or "finished" in done, timeout=10)
+        elapsed = time.perf_counter() - start
+    finally:
+        fa.stop_file_loop()
+        fb.stop_file_loop()
+    path = done.get("completed") or done.get("finished")
+    ok = False
+    if path:
+        with open(path, "rb") as fh:
+            ok = hashlib.sha256(fh.read()).digest() == hashlib.sha256(data).digest()
+    chunks = (size + fa.CHUNK_SIZE - 1) // fa.CHUNK_SIZE
+    data_frames = link.by_type.get(protocol.FILE_CHUNK, 0)
+    return {
+        "size": size,
+        "loss": loss,
+        "rtt_ms": rtt * 1000,
+        "ok": ok,
+        "elapsed_s": round(elapsed, 3),
+        "mb_per_s": round(size / elapsed / 1e6, 3),
+        "frames": link.frames,
+        "retransmitted_chunks": max(0, data_frames - chunks),
+    }
+
+
+def bench_files(grid: Dict) -> List[Dict]:
+    return [
+        _isolated(bench_file_case, size=size, loss=loss, rtt=rtt)
+        for size in grid["file_sizes"]
+        for loss in grid["file_loss"]
+        for rtt in grid["file_rtt"]
+    ]
+
+
+def bench_folders(grid: Dict) -> List[Dict]:
+    count = grid["folder_files"]
+    work = tempfile.mkdtemp(prefix="lcbench-")
+    root = os.path.join(work, "arbol")
+    total = 0
+    for i in range(count):
+        sub = os.path.join(root, f"d{i % 10}", f"s{i % 3}")
+        os.makedirs(sub, exist_ok=True)
+        blob = os.urandom(1024 + (i * 37) % 3072)
+        total += len(blob)
+        with open(os.path.join(sub, f"f{i}.txt"), "wb") as fh:
+            fh.write(blob)
+
+    link, a, b, fa, fb, fola = _file_pair(0.0, 0.0, os.path.join(work, "recv"))
+    received: List[str] = []
+    fb.start_file_loop(
+        lambda s, path, status: received.append(path)
+        if status in ("completed", "finished")
+        else None,
+        b.mac,
+    )
+    fa.start_file_loop(lambda s, path, status: None, a.mac)
+
+    start = time.perf_counter()
+    fola.send_folder(b.mac, root, timeout=0.05, retries=50)
+    _wait_for(lambda: len(received) >= count, timeout=30)
+    elapsed = time.perf_counter() - start
+    fa.stop_file_loop()
+    fb.stop_file_loop()
+    sys.modules.pop("folders", None)
+    return [
+        {
+            "files": count,
+            "bytes": total,
+            "received": len(received),
+            "elapsed_s": round(elapsed, 3),
+            "files_per_s": round(len(received) / elapsed, 1),
+            "frames": link.frames,
+        }
+    ]
+
+
+# --- discovery ---------------------------------------------------------------
+
+
+def bench_discovery(grid: Dict) -> List[Dict]:
+    from discovery import run
+
+    return [
+        _isolated(run, n=n, duration=grid["discovery_duration"], beacon=1.0)
+        for n in grid["discovery_nodes"]
+    ]
+
+
+# --- flask -------------------------------------------------------------------
+
+
+def bench_flask(grid: Dict) -> List[Dict]:
+    """
+    Clientes WSGI de prueba en hilos contra la app real (sin red: el backend
+    no se arranca). Mide historial completo, sincronización con ETag (304),
+    búsqueda y lista de usuarios.
+    """
+    work = tempfile.mkdtemp(prefix="lcbench-")
+    os.environ["LINKCHAT_CHAT_DB"] = os.path.join(work, "chat.db")
+    sys.path.insert(0, os.path.join(ROOT_DIR, "web"))
+    cwd = os.getcwd()
+    os.chdir(work)  # la app crea send_files/, recv_files/ y secret_keys/ aquí
+    try:
+        import app as webapp
+    finally:
+        os.chdir(cwd)
+
+    me, peer = "02:00:00:00:00:01", "02:00:00:00:00:02"
+    chat_id = "-".join(sorted([me, peer]))
+    store = webapp.chat_store
+    for i in range(2000):
+        sender = peer if i % 2 else me
+        store.add(chat_id, sender, f"mensaje {i} sobre el informe {i % 97}")
+    store.flush()
+    etag = f'"{chat_id}-{store.chat_rev(chat_id)}"'
+    cursor = store.chat_rev(chat_id)
+    endpoints = {
+        "get_messages": (f"/get_messages/{peer}", {}),
+        "get_messages_304": (
+            f"/get_messages/{peer}?after={cursor}",
+            {"If-None-Match": etag},
+        ),
+        "search": ("/search?q=informe 4", {}),
+        "get_users": ("/get_users", {}),
+    }
+
+    results = []
+    for name, (url, headers) in endpoints.items():
+        for clients in grid["flask_clients"]:
+            latencies: List[float] = []
+            statuses: Dict[int, int] = {}
+            lock = threading.Lock()
+
+            def worker() -> None:
+                client = webapp.app.test_client()
+                with client.session_transaction() as sess:
+                    sess["mac"] = me
+                local = []
+                for _ in range(grid["flask_requests"]):
+                    t0 = time.perf_counter()
+                    rv = client.get(url, headers=headers)
+                    local.append(time.perf_counter() - t0)
+                    with lock:
+                        statuses[rv.status_code] = statuses.get(rv.status_code, 0) + 1
+                with lock:
+                    latencies.extend(local)
+
+            threads = [threading.Thread(target=worker) for _ in range(clients)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            results.append(
+                {
+                    "endpoint": name,
+                    "clients": clients,
+                    "requests": len(latencies),
+                    "req_per_s": round(len(latencies) / elapsed, 1),
+                    "latency_ms": percentiles(latencies),
+                    "status": statuses,
+                }
+            )
+    store.close()
+    return results
+
+
+# --- main --------------------------------------------------------------------
+
+RUNNERS = {
+    "codec": bench_codec,
+    "chat": bench_chat,
+    "files": bench_files,
+    "folders": bench_folders,
+    "discovery": bench_discovery,
+    "flask": bench_flask,
+}
+
+
+def _git(*args: str) -> str:
+    try:
+        out = subprocess.run(
+            ["git", *args], cwd=ROOT_DIR, capture_output=True, text=True, timeout=10
+        )
+        return out.stdout.strip()
+    except Exception:
+        return ""
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--only", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    ap.add_argument("--quick", action="store_true", help="grilla reducida")
+    ap.add_argument("--out", help="archivo JSON de salida (por defecto stdout)")
+    ap.add_argument("--verbose", action="store_true", help="no descartar los logs")
+    args = ap.parse_args()
+
+    grid = GRIDS["quick" if args.quick else "full"]
+    report = {
+        "meta": {
+            "commit": _git("rev-parse", "--short", "HEAD") or None,
+            "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "grid": "quick" if args.quick else "full",
+            "section_s": {},
+        },
+        "results": {},
+    }
+    real_stdout = sys.stdout
+    for section in args.only:
+        print(f"[bench] {section}...", file=sys.stderr, flush=True)
+        started = time.perf_counter()
+        sink = real_stdout if args.verbose else open(os.devnull, "w")
+        with contextlib.redirect_stdout(sink):
+            try:
+                report["results"][section] = RUNNERS[section](grid)
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                report["results"][section] = {"error": f"{type(e).__name__}: {e}"}
+        elapsed = round(time.perf_counter() - started, 2)
+        report["meta"]["section_s"][section] = elapsed
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as fh:
+            fh.write(text + "\n")
+        print(f"[bench] resultado en {args.out}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
+import atexit
 import socket
 import struct
 import threading
 import time
 import os
-from typing import Callable, Optional, Dict, List
+from typing import Callable, Optional, Dict, List, Tuple
+
+import metrics
+from pcap import PcapWriter
+from protocol import CHANNEL_NAMES, TYPE_NAMES
 
 
 # --- CONFIGURACIÓN AUTOMÁTICA DE INTERFAZ ---
@@ -52,6 +57,110 @@ def register_channel_callback(channel: int, callback: Callable[[str, bytes], Non
     _channel_callbacks[channel].append(callback)
 
 
+# Observadores de todas las tramas LinkChat (e.g. presencia pasiva)
+_frame_observers: List[Callable[[str], None]] = []
+
+
+def register_frame_observer(callback: Callable[[str], None]):
+    """Registrar callback(src_mac) llamado por cada trama recibida (debe ser barato)"""
+    _frame_observers.append(callback)
+
+
+# Métricas por trama. Los hijos de cada (tipo, canal) se resuelven una vez
+# y quedan en caché, así el camino por trama es una búsqueda y dos inc.
+_FRAMES_OUT = metrics.counter(
+    "linkchat_frames_sent_total", "Tramas enviadas", ("channel", "type")
+)
+_BYTES_OUT = metrics.counter(
+    "linkchat_bytes_sent_total", "Bytes enviados (trama Ethernet)", ("channel", "type")
+)
+_FRAMES_IN = metrics.counter(
+    "linkchat_frames_received_total", "Tramas recibidas", ("channel", "type")
+)
+_BYTES_IN = metrics.counter(
+    "linkchat_bytes_received_total",
+    "Bytes recibidos (trama Ethernet)",
+    ("channel", "type"),
+)
+_FILTERED = metrics.counter(
+    "linkchat_frames_filtered_total",
+    "Tramas ignoradas antes de parsear (cortas o de otro EtherType)",
+    ("reason",),
+)
+_DROPPED = metrics.counter(
+    "linkchat_frames_dropped_total",
+    "Tramas LinkChat que no llegaron a un callback de canal",
+    ("reason",),
+)
+_SEND_ERRORS = metrics.counter(
+    "linkchat_send_errors_total", "Errores del socket al enviar"
+)
+_CALLBACK_SECONDS = metrics.histogram(
+    "linkchat_callback_seconds",
+    "Tiempo de los callbacks de recepción por canal",
+    ("channel",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0),
+)
+_FILTERED_SHORT = _FILTERED.labels("short")
+_FILTERED_ETHERTYPE = _FILTERED.labels("ethertype")
+_DROPPED_MALFORMED = _DROPPED.labels("malformed")
+_DROPPED_NO_HANDLER = _DROPPED.labels("no_handler")
+_DROPPED_CALLBACK_ERROR = _DROPPED.labels("callback_error")
+_out_metrics: Dict[bytes, Tuple] = {}
+_in_metrics: Dict[bytes, Tuple] = {}
+_callback_metrics: Dict[int, object] = {}
+
+
+def _frame_metrics(cache: Dict[bytes, Tuple], frames, nbytes, payload: bytes):
+    """(contador de tramas, contador de bytes) según tipo y canal del header."""
+    key = payload[1:3]
+    pair = cache.get(key)
+    if pair is None:
+        if len(key) == 2:
+            typ = TYPE_NAMES.get(key[0], "other")
+            channel = CHANNEL_NAMES.get(key[1], "other")
+        else:
+            typ = channel = "other"
+        pair = cache[key] = (frames.labels(channel, typ), nbytes.labels(channel, typ))
+    return pair
+
+
+def _callback_histogram(channel: int):
+    child = _callback_metrics.get(channel)
+    if child is None:
+        child = _callback_metrics[channel] = _CALLBACK_SECONDS.labels(
+            CHANNEL_NAMES.get(channel, "other")
+        )
+    return child
+
+
+# Captura: LINKCHAT_PCAP=ruta graba cada trama LinkChat (enviada o recibida)
+# con su timestamp en formato pcap; se reinyecta con bench/replay.py.
+PCAP_PATH = os.getenv("LINKCHAT_PCAP", "")
+_capture: Optional[PcapWriter] = None
+
+
+def start_capture(path: str) -> None:
+    """Empieza a grabar las tramas LinkChat en `path` (reemplaza la captura actual)."""
+    global _capture
+    stop_capture()
+    _capture = PcapWriter(path)
+    print(f"[ethernet] capturando tramas en {path}")
+
+
+def stop_capture() -> None:
+    global _capture
+    cap, _capture = _capture, None
+    if cap is not None:
+        cap.close()
+        print(f"[ethernet] captura cerrada: {cap.frames} tramas en {cap.path}")
+
+
+atexit.register(stop_capture)
+if PCAP_PATH:
+    start_capture(PCAP_PATH)
+
+
 def _mac_str_to_bytes(mac: str) -> bytes:
     return bytes.fromhex(mac.replace(":", ""))
 
@@ -76,8 +185,57 @@ def _ensure_send_socket():
         _send_sock.bind((INTERFACE, 0))
 
 
+# Planificador de transmisión (ver scheduler.py). LINKCHAT_TX_SCHED=0 lo
+# desactiva y send_frame vuelve a enviar en el hilo que llama.
+TX_SCHED = os.getenv("LINKCHAT_TX_SCHED", "1") != "0"
+TX_RATE = float(os.getenv("LINKCHAT_TX_RATE", "0"))  # bytes/s, 0 = sin límite
+TX_PEER_RATE = float(os.getenv("LINKCHAT_TX_PEER_RATE", "0"))
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Planificador compartido (se crea al primer envío); None si está desactivado."""
+    global _scheduler
+    if not TX_SCHED:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            from scheduler import TxScheduler
+
+            _scheduler = TxScheduler(_send_now, rate=TX_RATE, peer_rate=TX_PEER_RATE)
+    return _scheduler
+
+
+def flush_tx(timeout: float = 2.0) -> bool:
+    """Espera a que salgan las tramas encoladas (p. ej. antes de terminar)."""
+    sched = _scheduler
+    return sched.flush(timeout) if sched is not None else True
+
+
+def set_tx_weight(file_id: bytes, weight: float) -> None:
+    """Peso de una transferencia en el reparto entre flujos BULK (1 = normal)."""
+    sched = get_scheduler()
+    if sched is not None:
+        sched.set_weight(file_id, weight)
+
+
 def send_frame(dest_mac: str, payload: bytes, eth_type: int = ETH_P_LINKCHAT) -> None:
-    """Envía una trama Ethernet: dest(6) + src(6) + eth_type(2) + payload."""
+    """
+    Envía una trama Ethernet: dest(6) + src(6) + eth_type(2) + payload.
+    Con el planificador activo la trama se encola según su prioridad y el
+    envío real ocurre en su hilo; los errores del socket se ven aquí igual
+    porque el socket se abre antes de encolar.
+    """
+    _ensure_send_socket()
+    sched = get_scheduler()
+    if sched is not None:
+        sched.submit(dest_mac, payload, eth_type)
+        return
+    _send_now(dest_mac, payload, eth_type)
+
+
+def _send_now(dest_mac: str, payload: bytes, eth_type: int = ETH_P_LINKCHAT) -> None:
     _ensure_send_socket()
 
     dest = _mac_str_to_bytes(dest_mac)
@@ -92,11 +250,19 @@ def send_frame(dest_mac: str, payload: bytes, eth_type: int = ETH_P_LINKCHAT) ->
 
     try:
         sent = _send_sock.send(frame)
+        cap = _capture
+        if cap is not None:
+            cap.write(frame)
+        frames, nbytes = _frame_metrics(_out_metrics, _FRAMES_OUT, _BYTES_OUT, payload)
+        frames.inc()
+        nbytes.inc(sent)
         print(f"[ethernet] enviado {sent} bytes a {dest_mac} via {INTERFACE}")
     except PermissionError:
+        _SEND_ERRORS.inc()
         print("[ethernet] permiso denegado: ejecuta con sudo")
         raise
     except Exception as e:
+        _SEND_ERRORS.inc()
         print(f"[ethernet] error enviando: {e}")
         raise
 
@@ -130,48 +296,79 @@ def recv_one(eth_type: int = ETH_P_LINKCHAT) -> tuple[str, bytes]:
         return src_mac_str, payload
 
 
+def _dispatch_frame(
+    src_mac_str: str, payload: bytes, callback: Callable[[str, bytes], None]
+) -> None:
+    """Entrega una trama LinkChat ya filtrada a observadores y callbacks."""
+    from protocol import parse_header
+
+    frames, nbytes = _frame_metrics(_in_metrics, _FRAMES_IN, _BYTES_IN, payload)
+    frames.inc()
+    nbytes.inc(14 + len(payload))
+
+    for observer in _frame_observers:
+        try:
+            observer(src_mac_str)
+        except Exception:
+            pass
+
+    try:
+        # Intentar parsear header para routing por canal
+        info = parse_header(payload)
+        channel = info["channel"]
+    except Exception:
+        # Si no se puede parsear, solo callback general
+        _DROPPED_MALFORMED.inc()
+        callback(src_mac_str, payload)
+        return
+
+    try:
+        # Llamar callbacks específicos del canal
+        if channel in _channel_callbacks:
+            t0 = time.perf_counter()
+            for cb in _channel_callbacks[channel]:
+                cb(src_mac_str, payload)
+            _callback_histogram(channel).observe(time.perf_counter() - t0)
+        else:
+            _DROPPED_NO_HANDLER.inc()
+
+        # También llamar callback general
+        callback(src_mac_str, payload)
+
+    except Exception:
+        _DROPPED_CALLBACK_ERROR.inc()
+        callback(src_mac_str, payload)
+
+
 def _recv_loop(callback: Callable[[str, bytes], None], eth_type: int):
     """Loop que corre en hilo: recibe paquetes y routea por canal."""
     global _recv_running
     _ensure_recv_socket(eth_type)
     _recv_running = True
 
-    from protocol import parse_header
-
     try:
         while _recv_running:
             try:
-                raw, _ = _recv_sock.recvfrom(65535)
+                raw, addr = _recv_sock.recvfrom(65535)
             except OSError:
                 break
             if len(raw) < 14:
+                _FILTERED_SHORT.inc()
                 continue
             try:
                 pkt_eth_type = struct.unpack("!H", raw[12:14])[0]
             except Exception:
                 continue
             if pkt_eth_type != eth_type:
+                _FILTERED_ETHERTYPE.inc()
                 continue
             src = raw[6:12]
             payload = raw[14:]
             src_mac_str = ":".join(f"{b:02x}" for b in src)
-
-            try:
-                # Intentar parsear header para routing por canal
-                info = parse_header(payload)
-                channel = info["channel"]
-
-                # Llamar callbacks específicos del canal
-                if channel in _channel_callbacks:
-                    for cb in _channel_callbacks[channel]:
-                        cb(src_mac_str, payload)
-
-                # También llamar callback general
-                callback(src_mac_str, payload)
-
-            except Exception:
-                # Si no se puede parsear, solo callback general
-                callback(src_mac_str, payload)
+            cap = _capture
+            if cap is not None and addr[2] != socket.PACKET_OUTGOING:
+                cap.write(raw)  # las propias ya las grabó _send_now
+            _dispatch_frame(src_mac_str, payload, callback)
 
     finally:
         _recv_running = False
@@ -1,63 +1,188 @@
 # src/files.py
+import errno
 import os
 import hashlib
+import queue
+import random
+import struct
 import threading
 import time
-import socket
-import struct
-from typing import Callable, Optional, Dict, Tuple
+from collections import OrderedDict
+from typing import Callable, Optional, Dict, Tuple, List
 
+import merkle
+import metrics
+import transfers
 from protocol import (
     build_header,
     parse_header,
+    pack_ranges,
+    unpack_ranges,
     FILE_START,
     FILE_CHUNK,
     FILE_END,
+    FILE_POLL,
+    FILE_REJECT,
     ACK,
+    NACK,
+    HASH_REQ,
+    HASH_RESP,
     new_file_id,
     FILE_CHANNEL,
+    HEADER_LEN,
 )
 from ethernet import (
     send_frame,
+    set_tx_weight,
     start_recv_loop,
     stop_recv_loop,
-    ETH_P_LINKCHAT,
+    register_channel_callback,
+    get_interface_mac,
     INTERFACE,
 )
 
 CHUNK_SIZE = 1400
 BROADCAST_MAC = "ff:ff:ff:ff:ff:ff"
+STAGING_DIR = ".linkchat"  # dentro de RECV_DIR: manifiestos y packs de carpetas
+# prefijos de nombre de las transferencias internas de carpetas (ver folders)
+_FOLDER_KINDS = ("MANIFEST", "PACK", "SYNC", "SYNCREPLY")
+
+# envío a grupo (broadcast/multicast)
+GROUP_PACE = 0.0005  # pausa entre chunks en la pasada de datos (s)
+NACK_JITTER = 0.05  # retardo aleatorio máximo antes de responder a un POLL (s)
+_FINISHED_MAX = 256  # ids recién completados que se recuerdan para re-ACK/POLL
+
+# verificación Merkle por bloques (archivos grandes)
+MERKLE_BLOCK = CHUNK_SIZE * 749  # ~1 MiB, alineado a chunks
+MERKLE_MIN_SIZE = 8 * MERKLE_BLOCK
+MERKLE_VERIFY_TIMEOUT = 30.0  # espera del emisor al veredicto del receptor (s)
+MERKLE_MAX_ROUNDS = 3  # rondas de reparación antes de dar el archivo por corrupto
+_HASHES_PER_FRAME = (CHUNK_SIZE - 5) // merkle.HASH_LEN
+
+# límites de recepción (configurables por entorno)
+RECV_IDLE_TIMEOUT = float(os.getenv("LINKCHAT_RECV_IDLE_TIMEOUT", "30"))
+REAPER_INTERVAL = float(os.getenv("LINKCHAT_REAPER_INTERVAL", "5"))
+MAX_INCOMING = int(os.getenv("LINKCHAT_MAX_INCOMING", "64"))
+MAX_INCOMING_PER_PEER = int(os.getenv("LINKCHAT_MAX_INCOMING_PER_PEER", "8"))
+MAX_OPEN_HANDLES = int(os.getenv("LINKCHAT_MAX_OPEN_HANDLES", "32"))
+# admisión por espacio: bytes en vuelo (suma de tamaños anunciados de las
+# recepciones en curso, o de lo ya recibido si el tamaño es desconocido;
+# 0 = sin cuota) y margen libre que se respeta siempre
+RECV_QUOTA = int(os.getenv("LINKCHAT_RECV_QUOTA", "0"))
+RECV_QUOTA_PER_PEER = int(os.getenv("LINKCHAT_RECV_QUOTA_PER_PEER", "0"))
+RECV_MIN_FREE = int(os.getenv("LINKCHAT_RECV_MIN_FREE", str(256 * 1024 * 1024)))
+# tamaño desconocido: cada cuántos bytes recibidos se vuelve a mirar el disco
+_GROWTH_CHECK = 1024 * 1024
 
 # recepción en progreso
 _in_progress: Dict[bytes, Dict] = {}
+_finished: "OrderedDict[bytes, int]" = OrderedDict()
+# FILE_START rechazados: los POLL de grupo repetidos no los reabren
+_rejected: "OrderedDict[bytes, str]" = OrderedDict()
+# file_ids con handle abierto, en orden LRU (el primero se cierra antes)
+_open_handles: "OrderedDict[bytes, bool]" = OrderedDict()
 _lock = threading.Lock()
+# avisa a los lectores en streaming cuando avanza el prefijo contiguo
+_progress = threading.Condition(_lock)
 _user_cb: Optional[Callable[[str, str, str], None]] = None
 _recv_started = False
-_ack_sock: Optional[socket.socket] = None
+_handler_registered = False
+_reaper_thread: Optional[threading.Thread] = None
+_reaper_stop = threading.Event()
+
+# esperas del emisor: ACKs por (file_id, seq) y colas de respuestas
+# (NACK / HASH_REQ / HASH_RESP / ACK sin espera) por file_id
+_ack_waiters: Dict[Tuple[bytes, int], threading.Event] = {}
+_reply_queues: Dict[bytes, "queue.Queue"] = {}
+# FILE_REJECT recibidos para envíos propios: file_id -> motivo
+_refusals: "OrderedDict[bytes, str]" = OrderedDict()
+_waiters_lock = threading.Lock()
+
+# métricas compartidas con messaging (etiqueta layer)
+_ACK_TIMEOUTS = metrics.counter(
+    "linkchat_ack_timeouts_total", "Esperas de ACK vencidas", ("layer",)
+).labels("file")
+_ACK_RTT = metrics.histogram(
+    "linkchat_ack_rtt_seconds",
+    "RTT de las tramas confirmadas al primer intento",
+    ("layer",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+).labels("file")
+_REJECTS = metrics.counter(
+    "linkchat_file_rejects_total", "FILE_START rechazados por motivo", ("reason",)
+)
 
 # nueva variable para comparar MAC propia
 _my_mac: Optional[str] = None
 
 
-def _safe_meta_decode(payload: bytes) -> Tuple[str, int]:
-    """payload: b'filename|filesize'"""
+class TransferCancelled(Exception):
+    """El envío se interrumpió porque se activó su cancel_event."""
+
+
+class TransferRejected(Exception):
+    """El receptor rechazó el FILE_START (espacio, cuota o límite)."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"rechazado por el receptor: {reason}")
+        self.reason = reason
+
+
+def _safe_meta_decode(payload: bytes) -> Tuple[str, int, Dict[str, str]]:
+    """payload: b'filename|filesize[|clave=valor...]'"""
     try:
         txt = payload.decode("utf-8", errors="replace")
-        name, size_s = txt.split("|", 1)
-        return name, int(size_s)
+        parts = txt.split("|")
+        opts = {}
+        for p in parts[2:]:
+            k, _, v = p.partition("=")
+            opts[k] = v
+        return parts[0], int(parts[1]), opts
     except Exception:
-        return "received_file", 0
+        return "received_file", 0, {}
 
 
-def _get_ack_socket(timeout: float) -> socket.socket:
-    global _ack_sock
-    if _ack_sock is None:
-        _ack_sock = socket.socket(
-            socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003)
-        )
-        _ack_sock.bind((INTERFACE, 0))
-    _ack_sock.settimeout(timeout)
-    return _ack_sock
+def safe_relpath(rel: str) -> Optional[str]:
+    """Normaliza una ruta relativa recibida; None si intenta salir de RECV_DIR."""
+    rel_norm = os.path.normpath(rel).replace("\\", "/")
+    if os.path.isabs(rel_norm) or rel_norm.startswith(".."):
+        return None
+    return rel_norm
+
+
+def unique_path(path: str) -> str:
+    """Si ya existe un archivo con el mismo nombre, agrega un sufijo _N."""
+    if not os.path.exists(path):
+        return path
+    base, ext = os.path.splitext(path)
+    i = 1
+    while os.path.exists(f"{base}_{i}{ext}"):
+        i += 1
+    return f"{base}_{i}{ext}"
+
+
+def _build_meta(filename: str, filesize: int, **opts) -> bytes:
+    meta = filename + "|" + str(filesize)
+    for k, v in opts.items():
+        meta += f"|{k}={v}"
+    return meta.encode("utf-8")
+
+
+def _ensure_receiver() -> None:
+    """
+    Garantiza que los frames de FILE_CHANNEL se despachan a
+    _file_recv_internal (necesario para recibir ACK/NACK al enviar).
+    """
+    global _handler_registered, _my_mac
+    if _my_mac is None:
+        try:
+            _my_mac = ":".join(f"{b:02x}" for b in get_interface_mac(INTERFACE))
+        except Exception:
+            pass
+    if not _handler_registered:
+        register_channel_callback(FILE_CHANNEL, _file_recv_internal)
+        _handler_registered = True
+    start_recv_loop(lambda src, payload: None)
 
 
 def _send_and_wait_ack(
@@ -67,33 +192,331 @@ def _send_and_wait_ack(
     seq: int,
     retries: int = 5,
     timeout: float = 1.0,
+    resend: Optional[bytes] = None,
+    data: bool = True,
 ) -> bool:
-    dest_bytes = bytes.fromhex(dest_mac.replace(":", ""))
-    for attempt in range(1, retries + 1):
-        s = _get_ack_socket(timeout)
-        send_frame(dest_mac, frame_bytes)
-        start = time.time()
-        while True:
+    """
+    Envía la trama hasta recibir su ACK. `resend` se repite antes de cada
+    reintento (el FILE_START, que no tiene ACK propio, con el primer chunk).
+    data=False: trama de control (FILE_END), no suma bytes a la telemetría.
+    """
+    key = (file_id, seq)
+    nbytes = len(frame_bytes) - HEADER_LEN if data else 0
+    event = threading.Event()
+    with _waiters_lock:
+        _ack_waiters[key] = event
+    try:
+        for attempt in range(1, retries + 1):
+            if resend is not None and attempt > 1:
+                send_frame(dest_mac, resend)
+            sent_at = time.time()
+            send_frame(dest_mac, frame_bytes)
+            transfers.on_sent(file_id, nbytes, retransmit=attempt > 1)
+            if event.wait(timeout):
+                _raise_if_refused(file_id)
+                rtt = time.time() - sent_at
+                if attempt == 1:
+                    _ACK_RTT.observe(rtt)  # tras un reenvío el RTT es ambiguo
+                transfers.on_acked(file_id, nbytes, rtt=rtt)
+                return True
+            _ACK_TIMEOUTS.inc()
+            _raise_if_refused(file_id)
+        return False
+    finally:
+        with _waiters_lock:
+            _ack_waiters.pop(key, None)
+
+
+def _raise_if_refused(file_id: bytes) -> None:
+    with _waiters_lock:
+        reason = _refusals.pop(file_id, None)
+    if reason is not None:
+        raise TransferRejected(reason)
+
+
+def _missing_ranges(have: bytearray) -> List[Tuple[int, int]]:
+    """Rangos inclusivos de seqs (base 1) cuyo byte en `have` es 0."""
+    ranges = []
+    pos = have.find(0)
+    while pos != -1:
+        end = have.find(1, pos)
+        if end == -1:
+            end = len(have)
+        ranges.append((pos + 1, end))
+        pos = have.find(0, end)
+    return ranges
+
+
+def _remember_finished(fid: bytes, end_reply: int = 0) -> None:
+    """
+    end_reply: tipo (ACK o NACK) con el que se respondió al FILE_END; si
+    esa respuesta se pierde, el FILE_END repetido la vuelve a recibir.
+    """
+    _finished[fid] = end_reply
+    while len(_finished) > _FINISHED_MAX:
+        _finished.popitem(last=False)
+
+
+def _committed(entry: Dict) -> int:
+    """Bytes que ocupa una recepción en curso para las cuotas."""
+    return max(entry["expected"], entry["received"])
+
+
+def _admit(src_mac: str, expected: int, recv_dir: str) -> Optional[str]:
+    """
+    Control de admisión de un FILE_START (llamar con _lock tomado).
+    Devuelve el motivo del rechazo o None. Además de los límites de
+    recepciones simultáneas mira las cuotas de bytes en vuelo y el espacio
+    libre de recv_dir, descontando lo prometido a recepciones que no se
+    pudieron preasignar y dejando siempre RECV_MIN_FREE libres.
+    """
+    entries = list(_in_progress.values())
+    if len(entries) >= MAX_INCOMING:
+        return "limit"
+    mine = [e for e in entries if e["src"] == src_mac]
+    if len(mine) >= MAX_INCOMING_PER_PEER:
+        return "peer_limit"
+    if RECV_QUOTA and sum(map(_committed, entries)) + expected > RECV_QUOTA:
+        return "quota"
+    if (
+        RECV_QUOTA_PER_PEER
+        and sum(map(_committed, mine)) + expected > RECV_QUOTA_PER_PEER
+    ):
+        return "peer_quota"
+    try:
+        st = os.statvfs(recv_dir)
+    except (AttributeError, OSError):
+        return None  # sin statvfs (p. ej. Windows): solo cuotas
+    free = st.f_bavail * st.f_frsize
+    promised = sum(
+        max(0, e["expected"] - e["received"]) for e in entries if not e["reserved"]
+    )
+    if free - promised - expected < RECV_MIN_FREE:
+        return "disk"
+    return None
+
+
+def _check_growth(src_mac: str, entry: Dict, extra: int) -> Optional[str]:
+    """
+    Admisión continua de una recepción de tamaño desconocido, que _admit
+    dejó pasar sin contar bytes (llamar con _lock tomado antes de escribir
+    `extra` bytes más). Las cuotas se miran con cada chunk y el espacio
+    libre cada _GROWTH_CHECK bytes. Devuelve el motivo del corte o None.
+    """
+    size = entry["received"] + extra
+    others = [e for e in _in_progress.values() if e is not entry]
+    if RECV_QUOTA and sum(map(_committed, others)) + size > RECV_QUOTA:
+        return "quota"
+    if RECV_QUOTA_PER_PEER and (
+        sum(_committed(e) for e in others if e["src"] == src_mac) + size
+        > RECV_QUOTA_PER_PEER
+    ):
+        return "peer_quota"
+    if entry["received"] // _GROWTH_CHECK == size // _GROWTH_CHECK:
+        return None
+    try:
+        st = os.statvfs(os.path.dirname(entry["path"]))
+    except (AttributeError, OSError):
+        return None
+    promised = sum(
+        max(0, e["expected"] - e["received"]) for e in others if not e["reserved"]
+    )
+    if st.f_bavail * st.f_frsize - promised - extra < RECV_MIN_FREE:
+        return "disk"
+    return None
+
+
+def _abort_incoming(src_mac: str, fid: bytes, entry: Dict, reason: str) -> None:
+    """
+    Corta una recepción en curso que superó los límites (llamar con _lock
+    tomado): borra el parcial y responde FILE_REJECT como en la admisión.
+    El usuario recibe la misma ruta que se le anunció con 'started'.
+    """
+    _close_entry(fid, entry, f"rejected:{reason}")
+    try:
+        os.remove(entry["path"])
+    except OSError:
+        pass
+    transfers.finish(fid, "rejected")
+    _reject(src_mac, fid, entry.get("final") or entry["path"], reason)
+
+
+def _reject(src_mac: str, fid: bytes, fname: str, reason: str) -> None:
+    """Responde FILE_REJECT al emisor y avisa al usuario (con _lock tomado)."""
+    print(f"[files] Rechazado envío de {src_mac} ({fname}): {reason}")
+    _REJECTS.labels(reason).inc()
+    _rejected[fid] = reason
+    while len(_rejected) > _FINISHED_MAX:
+        _rejected.popitem(last=False)
+    try:
+        send_frame(
+            src_mac,
+            build_header(
+                FILE_REJECT,
+                reason.encode("utf-8"),
+                channel=FILE_CHANNEL,
+                seq=0,
+                file_id=fid,
+            ),
+        )
+    except Exception as e:
+        print(f"[files] Error enviando FILE_REJECT: {e}")
+    if _user_cb:
+        try:
+            _user_cb(src_mac, fname, f"rejected:{reason}")
+        except Exception as e:
+            print(f"[files] error en callback del usuario: {e}")
+
+
+def _entry_handle(fid: bytes, entry: Dict):
+    """
+    Devuelve el handle de la entrada, reabriéndolo si se cerró por el
+    límite de handles abiertos (llamar con _lock tomado).
+    """
+    if entry["handle"] is None:
+        entry["handle"] = open(entry["path"], "r+b")
+        if not entry["total"]:
+            entry["handle"].seek(0, os.SEEK_END)
+    _open_handles[fid] = True
+    _open_handles.move_to_end(fid)
+    while len(_open_handles) > MAX_OPEN_HANDLES:
+        old_fid, _ = _open_handles.popitem(last=False)
+        old = _in_progress.get(old_fid)
+        if old and old["handle"] is not None:
             try:
-                raw, _ = s.recvfrom(65535)
-            except socket.timeout:
-                break
-            if len(raw) < 14:
-                continue
-            pkt_type = struct.unpack("!H", raw[12:14])[0]
-            if pkt_type != ETH_P_LINKCHAT:
-                continue
-            if raw[6:12] != dest_bytes:
+                old["handle"].close()
+            except Exception:
+                pass
+            old["handle"] = None
+    return entry["handle"]
+
+
+def _close_entry(fid: bytes, entry: Dict, status: str = "closed") -> None:
+    """Cierra el handle (si está abierto) y saca la entrada de _in_progress."""
+    _open_handles.pop(fid, None)
+    if entry.get("handle") is not None:
+        try:
+            entry["handle"].close()
+        except Exception:
+            pass
+        entry["handle"] = None
+    _in_progress.pop(fid, None)
+    entry["status"] = status
+    if entry.get("watchers"):
+        _progress.notify_all()
+
+
+def _advance_contiguous(entry: Dict) -> None:
+    """Avanza el prefijo contiguo recibido y despierta a los lectores."""
+    if entry["total"]:
+        have = entry["have"]
+        idx = entry["contiguous"] // CHUNK_SIZE
+        nxt = have.find(0, idx)
+        if nxt == -1:
+            nxt = entry["total"]
+        if nxt == idx:
+            return
+        entry["contiguous"] = min(nxt * CHUNK_SIZE, entry["expected"])
+    else:
+        entry["contiguous"] = entry["received"]
+    if entry.get("watchers"):
+        # los lectores leen el archivo por otro descriptor: vaciar buffer
+        if entry["handle"] is not None:
+            entry["handle"].flush()
+        _progress.notify_all()
+
+
+def stream_incoming(path: str, block_size: int = 65536, timeout: Optional[float] = None):
+    """
+    Genera el contenido de `path` mientras se recibe: entrega el prefijo
+    contiguo ya escrito y se bloquea hasta que llegan más datos. Si el
+    archivo no está en recepción, simplemente lo lee completo.
+    Termina si la transferencia se descarta o no avanza en `timeout` s.
+    """
+    if timeout is None:
+        timeout = RECV_IDLE_TIMEOUT
+    with _lock:
+        entry = next((e for e in _in_progress.values() if e["path"] == path), None)
+        if entry is not None:
+            entry["watchers"] = entry.get("watchers", 0) + 1
+            if entry["handle"] is not None:
+                entry["handle"].flush()
+    try:
+        with open(path, "rb") as f:
+            pos = 0
+            while entry is not None:
+                with _progress:
+                    deadline = time.time() + timeout
+                    while entry["contiguous"] <= pos and "status" not in entry:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        _progress.wait(remaining)
+                    available = entry["contiguous"]
+                    status = entry.get("status")
+                    if available <= pos and status is None:
+                        return  # sin avance dentro del timeout
+                if status == "reaped":
+                    return
+                if status is not None:
+                    break  # terminada: el resto se lee hasta EOF
+                while pos < available:
+                    data = f.read(min(block_size, available - pos))
+                    if not data:
+                        break
+                    pos += len(data)
+                    yield data
+            for data in iter(lambda: f.read(block_size), b""):
+                yield data
+    finally:
+        if entry is not None:
+            with _lock:
+                entry["watchers"] -= 1
+
+
+def _reap_stale(now: Optional[float] = None) -> int:
+    """
+    Descarta las recepciones sin actividad durante RECV_IDLE_TIMEOUT:
+    cierra el handle, borra el archivo parcial y avisa con estado 'reaped'.
+    """
+    if now is None:
+        now = time.time()
+    reaped = 0
+    with _lock:
+        for fid, entry in list(_in_progress.items()):
+            if entry["verifying"] or now - entry["last_activity"] < RECV_IDLE_TIMEOUT:
                 continue
+            _close_entry(fid, entry, "reaped")
             try:
-                info = parse_header(raw[14:])
+                os.remove(entry["path"])
             except Exception:
-                continue
-            if info["type"] == ACK and info["id"] == file_id and info["seq"] == seq:
-                return True
-            if (time.time() - start) >= timeout:
-                break
-    return False
+                pass
+            transfers.finish(fid, "reaped")
+            print(f"[files] REAPED id={fid.hex()} de {entry['src']} ({entry['path']})")
+            reaped += 1
+            if _user_cb:
+                try:
+                    _user_cb(entry["src"], entry["final"] or entry["path"], "reaped")
+                except Exception as e:
+                    print(f"[files] error en callback del usuario: {e}")
+    return reaped
+
+
+def _reaper_loop() -> None:
+    while not _reaper_stop.wait(REAPER_INTERVAL):
+        try:
+            _reap_stale()
+        except Exception as e:
+            print(f"[files] Error en reaper: {e}")
+
+
+def _start_reaper() -> None:
+    global _reaper_thread
+    if _reaper_thread and _reaper_thread.is_alive():
+        return
+    _reaper_stop.clear()
+    _reaper_thread = threading.Thread(target=_reaper_loop, daemon=True)
+    _reaper_thread.start()
 
 
 def send_file(
@@ -103,15 +526,23 @@ def send_file(
     retries: int = 5,
     timeout: float = 1.0,
     remote_name: Optional[str] = None,
-) -> None:
+    replace: bool = False,
+    cancel_event: Optional[threading.Event] = None,
+    weight: float = 1.0,
+) -> str:
     """
     Envía un archivo con STOP-AND-WAIT por canal FILE_CHANNEL.
     remote_name: si se pasa, será el 'nombre' (puede incluir subcarpetas con '/')
     que se enviará como metadata y que el receptor usará para crear rutas.
+    replace: el receptor sobrescribe (al completar) un archivo existente con
+    ese nombre en lugar de agregar un sufijo.
+    cancel_event: si se activa, el envío se corta antes del siguiente chunk
+    con TransferCancelled.
+    weight: peso en el planificador frente a otros envíos (0.5 = la mitad
+    de caudal cuando compiten).
+    Devuelve el file_id (hex) con el que se puede consultar `transfers`.
     """
     print(f"send_file hacai {dest_mac} en {path} (remote_name={remote_name})")
-    if not dest_mac:
-        dest_mac = BROADCAST_MAC
     if not os.path.isfile(path):
         print("FileNotFound")
         raise FileNotFoundError(path)
@@ -119,29 +550,97 @@ def send_file(
     filesize = os.path.getsize(path)
     # usar nombre remoto si se provee (permite rutas relativas dentro de la carpeta)
     filename = remote_name if remote_name else os.path.basename(path)
-    filename_bytes = filename.encode("utf-8")
+    with open(path, "rb") as f:
+        return send_stream(
+            dest_mac,
+            f,
+            filename,
+            filesize,
+            use_ack=use_ack,
+            retries=retries,
+            timeout=timeout,
+            path=path,
+            replace=replace,
+            cancel_event=cancel_event,
+            weight=weight,
+        )
+
+
+def send_stream(
+    dest_mac: str,
+    stream,
+    remote_name: str,
+    filesize: int,
+    use_ack: bool = True,
+    retries: int = 5,
+    timeout: float = 1.0,
+    path: Optional[str] = None,
+    replace: bool = False,
+    cancel_event: Optional[threading.Event] = None,
+    weight: float = 1.0,
+) -> str:
+    """
+    Igual que send_file pero leyendo de cualquier objeto con read(n).
+    filesize: tamaño anunciado en FILE_START (0 = desconocido, el receptor
+    cierra con FILE_END). path: ruta en disco del contenido, si existe;
+    habilita la verificación Merkle de archivos grandes.
+    """
+    if not dest_mac:
+        dest_mac = BROADCAST_MAC
+    filename = remote_name
 
     file_id = new_file_id()
+    if weight != 1.0:
+        set_tx_weight(file_id, weight)
+    if use_ack:
+        _ensure_receiver()
+
+    # árbol Merkle para archivos grandes: la raíz viaja en FILE_START
+    levels = None
+    opts = {}
+    if use_ack and path and filesize >= MERKLE_MIN_SIZE:
+        levels = merkle.build_levels(merkle.leaf_hashes(path, MERKLE_BLOCK))
+        opts = {"merkle": merkle.root(levels).hex(), "mb": MERKLE_BLOCK}
+    if replace:
+        opts["replace"] = 1
 
-    meta = filename_bytes.decode("utf-8", errors="replace") + "|" + str(filesize)
+    meta = _build_meta(filename, filesize, **opts)
     pkt_start = build_header(
-        FILE_START, meta.encode("utf-8"), channel=FILE_CHANNEL, seq=0, file_id=file_id
+        FILE_START, meta, channel=FILE_CHANNEL, seq=0, file_id=file_id
     )
+    transfers.start(file_id, "send", dest_mac, filename, filesize)
     send_frame(dest_mac, pkt_start)
-    time.sleep(0.05)
+    if not use_ack:
+        # sin ACK no hay reintento si el primer chunk adelanta al FILE_START
+        time.sleep(0.05)
 
     seq = 1
-    with open(path, "rb") as f:
+    sha256 = hashlib.sha256()
+    try:
         while True:
-            chunk = f.read(CHUNK_SIZE)
+            if cancel_event is not None and cancel_event.is_set():
+                # el receptor descarta lo parcial al vencer RECV_IDLE_TIMEOUT
+                raise TransferCancelled(f"{filename}: cancelado en seq={seq}")
+            if not use_ack:
+                _raise_if_refused(file_id)  # con ACK lo detecta la espera
+            chunk = stream.read(CHUNK_SIZE)
             if not chunk:
                 break
+            sha256.update(chunk)
             pkt = build_header(
                 FILE_CHUNK, chunk, channel=FILE_CHANNEL, seq=seq, file_id=file_id
             )
             if use_ack:
+                # si se perdió el FILE_START el primer chunk no tiene ACK:
+                # se repite junto con él (el receptor ignora el duplicado)
                 ok = _send_and_wait_ack(
-                    dest_mac, pkt, file_id, seq, retries=retries, timeout=timeout
+                    dest_mac,
+                    pkt,
+                    file_id,
+                    seq,
+                    retries=retries,
+                    timeout=timeout,
+                    resend=pkt_start if seq == 1 else None,
                 )
                 if not ok:
                     raise TimeoutError(
@@ -149,12 +648,20 @@ def send_file(
                     )
             else:
                 send_frame(dest_mac, pkt)
+                transfers.on_sent(file_id, len(chunk))
+                transfers.on_acked(file_id, len(chunk))
             seq += 1
+    except TransferCancelled:
+        transfers.finish(file_id, "cancelled")
+        raise
+    except TransferRejected as e:
+        print(f"[files] {filename}: {e}")
+        transfers.finish(file_id, "rejected")
+        raise
+    except Exception:
+        transfers.finish(file_id, "failed")
+        raise
 
-    sha256 = hashlib.sha256()
-    with open(path, "rb") as fh:
-        for b in iter(lambda: fh.read(65536), b""):
-            sha256.update(b)
     pkt_end = build_header(
         FILE_END,
         sha256.hexdigest().encode("utf-8"),
@@ -162,121 +669,785 @@ def send_file(
         seq=seq,
         file_id=file_id,
     )
-    send_frame(dest_mac, pkt_end)
+    if levels is None:
+        if not use_ack or filesize:
+            send_frame(dest_mac, pkt_end)
+            transfers.finish(file_id, "completed")
+            return file_id.hex()
+        # tamaño desconocido: solo FILE_END cierra la recepción, así que se
+        # confirma y reintenta como un chunk (si se pierde, el reaper
+        # descartaría el archivo mientras el emisor lo da por enviado)
+        try:
+            ok = _send_and_wait_ack(
+                dest_mac,
+                pkt_end,
+                file_id,
+                seq,
+                retries=retries,
+                timeout=timeout,
+                data=False,
+            )
+        except TransferRejected as e:
+            print(f"[files] {filename}: {e}")
+            transfers.finish(file_id, "rejected")
+            raise
+        if not ok:
+            transfers.finish(file_id, "failed")
+            raise TimeoutError(f"No ACK para FILE_END después de {retries} intentos")
+        transfers.finish(file_id, "completed")
+        return file_id.hex()
 
+    rq: "queue.Queue" = queue.Queue()
+    with _waiters_lock:
+        _reply_queues[file_id] = rq
+    try:
+        send_frame(dest_mac, pkt_end)
+        ok = _serve_merkle(
+            dest_mac,
+            path,
+            file_id,
+            pkt_end,
+            seq,
+            levels,
+            rq,
+            retries=retries,
+            timeout=timeout,
+        )
+    except Exception:
+        transfers.finish(file_id, "failed")
+        raise
+    finally:
+        with _waiters_lock:
+            _reply_queues.pop(file_id, None)
+    transfers.finish(file_id, "completed" if ok else "unverified")
+    return file_id.hex()
 
-def _file_recv_internal(src_mac: str, raw_payload: bytes):
+
+def _serve_merkle(
+    dest_mac: str,
+    path: str,
+    file_id: bytes,
+    pkt_end: bytes,
+    end_seq: int,
+    levels: List[List[bytes]],
+    rq: "queue.Queue",
+    retries: int,
+    timeout: float,
+) -> bool:
     """
-    Callback interno: parsea header y maneja FILE_START / FILE_CHUNK / FILE_END.
+    Tras FILE_END atiende al receptor mientras verifica: responde HASH_REQ
+    con hashes del árbol y reenvía los chunks de los bloques pedidos por NACK.
+    Devuelve True cuando el receptor confirma (ACK seq=end_seq) y lanza
+    IOError si informa que no pudo verificar (NACK vacío seq=end_seq). Los
+    ACK de chunks que llegan tarde o duplicados se ignoran. Tras `timeout`
+    sin noticias se repite el FILE_END: si el veredicto se perdió, el
+    receptor lo reenvía (mientras verifica, lo ignora).
     """
-    global _user_cb
-    # IGNORAR paquetes que vienen de mi propia MAC (evita crear archivos propios)
-    if _my_mac and src_mac == _my_mac:
-        return
+    deadline = time.time() + MERKLE_VERIFY_TIMEOUT
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            print(f"[files] Sin veredicto Merkle para id={file_id.hex()}")
+            return False
+        try:
+            src, typ, seq, payload = rq.get(timeout=min(remaining, timeout))
+        except queue.Empty:
+            send_frame(dest_mac, pkt_end)
+            continue
+        if src != dest_mac:
+            continue
+        if typ == ACK:
+            if seq == end_seq:
+                return True
+            continue  # ACK tardío de un chunk, no es el veredicto
+        if typ == NACK and seq == end_seq and not payload:
+            raise IOError(f"el receptor no pudo verificar id={file_id.hex()}")
+        deadline = time.time() + MERKLE_VERIFY_TIMEOUT
 
+        if typ == HASH_REQ and len(payload) >= 9:
+            level, start, count = struct.unpack("!BII", payload[:9])
+            if level >= len(levels):
+                continue
+            hashes = levels[level][start : start + min(count, _HASHES_PER_FRAME)]
+            resp = build_header(
+                HASH_RESP,
+                struct.pack("!BI", level, start) + b"".join(hashes),
+                channel=FILE_CHANNEL,
+                seq=0,
+                file_id=file_id,
+            )
+            send_frame(dest_mac, resp)
+
+        elif typ == NACK:
+            # bloques corruptos: reenviar solo sus chunks
+            with open(path, "rb") as f:
+                for start, end in unpack_ranges(payload):
+                    for seq in range(max(1, start), min(end, end_seq - 1) + 1):
+                        f.seek((seq - 1) * CHUNK_SIZE)
+                        pkt = build_header(
+                            FILE_CHUNK,
+                            f.read(CHUNK_SIZE),
+                            channel=FILE_CHANNEL,
+                            seq=seq,
+                            file_id=file_id,
+                        )
+                        if not _send_and_wait_ack(
+                            dest_mac, pkt, file_id, seq, retries=retries, timeout=timeout
+                        ):
+                            raise TimeoutError(
+                                f"No ACK para seq={seq} después de {retries} intentos"
+                            )
+
+
+def _collect_nacks(
+    nq: "queue.Queue",
+    pending: set,
+    window: float,
+    rejected: Optional[Dict[str, str]] = None,
+) -> Tuple[set, Dict[str, List[Tuple[int, int]]]]:
+    """
+    Recoge NACKs durante `window` segundos (o hasta que respondan todos
+    los `pending` si se conocen). Devuelve (macs completos, {mac: rangos}).
+    Los FILE_REJECT se anotan en `rejected` ({mac: motivo}).
+    """
+    done = set()
+    missing: Dict[str, List[Tuple[int, int]]] = {}
+    deadline = time.time() + window
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            src, typ, _, payload = nq.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if typ == FILE_REJECT and rejected is not None:
+            rejected[src] = payload.decode("utf-8", errors="replace")
+            done.discard(src)
+            missing.pop(src, None)
+            pending = pending - {src}
+            if pending and pending <= (done | set(missing)):
+                break
+            continue
+        if typ != NACK:
+            continue
+        ranges = unpack_ranges(payload)
+        if ranges:
+            missing.setdefault(src, []).extend(ranges)
+            done.discard(src)
+        else:
+            done.add(src)
+            missing.pop(src, None)
+        if pending and pending <= (done | set(missing)):
+            break
+    return done, missing
+
+
+def send_file_group(
+    path: str,
+    group_mac: str = BROADCAST_MAC,
+    receivers: Optional[List[str]] = None,
+    *,
+    rounds: int = 10,
+    poll_timeout: float = 0.5,
+    pace: float = GROUP_PACE,
+    remote_name: Optional[str] = None,
+) -> Dict:
+    """
+    Envía un archivo una sola vez a una dirección broadcast/multicast.
+    Cada chunk se transmite una vez; tras la pasada de datos se envía un
+    FILE_POLL y los receptores responden con NACK de los rangos que les
+    faltan (NACK vacío = completo). Se retransmite la unión de rangos
+    perdidos y se repite hasta que nadie pida nada o se agoten `rounds`.
+    receivers: MACs esperadas; si se pasa, se termina en cuanto todas
+    confirman y el informe indica quién quedó incompleto y quién rechazó el
+    archivo con FILE_REJECT (sin espacio, cuota o límite).
+    Devuelve {"file_id", "complete", "incomplete", "rejected", "rounds",
+    "repaired"}.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+    _ensure_receiver()
+
+    filesize = os.path.getsize(path)
+    filename = remote_name if remote_name else os.path.basename(path)
+    total = (filesize + CHUNK_SIZE - 1) // CHUNK_SIZE
+    file_id = new_file_id()
+    meta = _build_meta(filename, filesize, mode="group")
+    pending = set(m.lower() for m in receivers) if receivers else set()
+
+    nq: "queue.Queue" = queue.Queue()
+    with _waiters_lock:
+        _reply_queues[file_id] = nq
+
+    report = {
+        "file_id": file_id.hex(),
+        "complete": [],
+        "incomplete": {},
+        "rejected": {},
+        "rounds": 0,
+        "repaired": 0,
+    }
+    transfers.start(file_id, "send", group_mac, filename, filesize)
     try:
-        info = parse_header(raw_payload)
+        pkt_start = build_header(
+            FILE_START, meta, channel=FILE_CHANNEL, seq=0, file_id=file_id
+        )
+        send_frame(group_mac, pkt_start)
+        time.sleep(0.05)
+
+        sha256 = hashlib.sha256()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            for seq in range(1, total + 1):
+                chunk = os.pread(fd, CHUNK_SIZE, (seq - 1) * CHUNK_SIZE)
+                sha256.update(chunk)
+                send_frame(
+                    group_mac,
+                    build_header(
+                        FILE_CHUNK, chunk, channel=FILE_CHANNEL, seq=seq, file_id=file_id
+                    ),
+                )
+                transfers.on_sent(file_id, len(chunk))
+                if pace:
+                    time.sleep(pace)
+
+            # fase de reparación: POLL -> NACKs -> re-multicast de la unión
+            poll = build_header(
+                FILE_POLL,
+                total.to_bytes(4, "big") + meta,
+                channel=FILE_CHANNEL,
+                seq=total + 1,
+                file_id=file_id,
+            )
+            done: set = set()
+            missing: Dict[str, List[Tuple[int, int]]] = {}
+            for rnd in range(1, rounds + 1):
+                report["rounds"] = rnd
+                send_frame(group_mac, poll)
+                got_done, missing = _collect_nacks(
+                    nq,
+                    pending - done - set(report["rejected"]),
+                    poll_timeout + NACK_JITTER,
+                    report["rejected"],
+                )
+                done |= got_done
+                done -= set(missing)
+
+                union = set()
+                for ranges in missing.values():
+                    for start, end in ranges:
+                        union.update(range(max(1, start), min(end, total) + 1))
+                if not union:
+                    if not pending or pending <= done | set(report["rejected"]):
+                        break
+                    continue
+                for seq in sorted(union):
+                    chunk = os.pread(fd, CHUNK_SIZE, (seq - 1) * CHUNK_SIZE)
+                    send_frame(
+                        group_mac,
+                        build_header(
+                            FILE_CHUNK,
+                            chunk,
+                            channel=FILE_CHANNEL,
+                            seq=seq,
+                            file_id=file_id,
+                        ),
+                    )
+                    transfers.on_sent(file_id, len(chunk), retransmit=True)
+                    if pace:
+                        time.sleep(pace)
+                report["repaired"] += len(union)
+        finally:
+            os.close(fd)
+
+        pkt_end = build_header(
+            FILE_END,
+            sha256.hexdigest().encode("utf-8"),
+            channel=FILE_CHANNEL,
+            seq=total + 1,
+            file_id=file_id,
+        )
+        send_frame(group_mac, pkt_end)
     except Exception:
+        transfers.finish(file_id, "failed")
+        raise
+    finally:
+        with _waiters_lock:
+            _reply_queues.pop(file_id, None)
+            _refusals.pop(file_id, None)
+
+    report["complete"] = sorted(done)
+    incomplete = {mac: sum(e - s + 1 for s, e in r) for mac, r in missing.items()}
+    for mac in pending - done - set(report["rejected"]):
+        incomplete.setdefault(mac, -1)  # -1: sin respuesta
+    report["incomplete"] = incomplete
+    # en grupo solo se considera confirmado lo que llegó a todos
+    ok = not incomplete and not report["rejected"]
+    transfers.on_acked(file_id, filesize if ok else 0)
+    transfers.finish(file_id, "completed" if ok else "partial")
+    return report
+
+
+def _send_poll_reply(src_mac: str, fid: bytes, ranges: List[Tuple[int, int]]):
+    try:
+        nack = build_header(
+            NACK,
+            pack_ranges(ranges, max_len=CHUNK_SIZE),
+            channel=FILE_CHANNEL,
+            seq=0,
+            file_id=fid,
+        )
+        send_frame(src_mac, nack)
+    except Exception as e:
+        print(f"[files] Error enviando NACK: {e}")
+
+
+def _open_incoming(src_mac: str, fid: bytes, payload: bytes) -> None:
+    """Procesa la metadata de un FILE_START (llamar con _lock tomado)."""
+    if fid in _in_progress:
+        entry = _in_progress[fid]
+        # duplicado: envío a grupo (FILE_START repetido o vía POLL) o el
+        # emisor lo repitió porque no le llegó el ACK del primer chunk
+        if entry.get("group") or entry["src"] == src_mac:
+            return
+        _close_entry(fid, entry)
+    if fid in _rejected or fid in _finished:
+        return  # ya rechazado o terminado (FILE_START repetido)
+
+    fname, expected, opts = _safe_meta_decode(payload)
+
+    # Soporte para marcador de carpeta: metadata con prefijo DIR:
+    if isinstance(fname, str) and fname.startswith("DIR:"):
+        rel = fname[4:]
+        # normalizar y evitar traversal
+        rel_norm = safe_relpath(rel)
+        if rel_norm is None:
+            print(f"[files] Ignorando intento de traversal en DIR:{rel}")
+            return
+        RECV_DIR = os.getenv("RECV_DIR", "/app/recv_files")
+        dirpath = os.path.join(RECV_DIR, rel_norm)
+        try:
+            os.makedirs(dirpath, exist_ok=True)
+            print(f"[files] DIR_CREATED {dirpath} desde {src_mac}")
+            if _user_cb:
+                _user_cb(src_mac, dirpath, "dir_created")
+        except Exception as e:
+            print(f"[files] Error creando dir {dirpath}: {e}")
         return
 
-    typ = info["type"]
-    fid = info["id"]
-    payload = info["payload"]
-    seq = info["seq"]
+    # Directorio de archivos recibidos (archivo normal)
+    RECV_DIR = os.getenv("RECV_DIR", "/app/recv_files")
+    os.makedirs(RECV_DIR, exist_ok=True)
 
-    with _lock:
-        if typ == FILE_START:
-            if fid in _in_progress:
+    # Admisión: recepciones simultáneas, cuotas y espacio en disco
+    reason = _admit(src_mac, expected, RECV_DIR)
+    if reason is not None:
+        _reject(src_mac, fid, fname, reason)
+        return
+
+    # Manifiesto y packs de carpetas: se reciben en un área temporal
+    kind = None
+    final = None
+    staging = os.path.join(RECV_DIR, STAGING_DIR)
+    if fname.split(":", 1)[0] in _FOLDER_KINDS:
+        kind = fname.split(":", 1)[0].lower()
+        os.makedirs(staging, exist_ok=True)
+        outname = os.path.join(staging, fid.hex())
+    else:
+        # Sanitizar nombre/ruta y evitar path traversal
+        fname_norm = safe_relpath(fname)
+        if fname_norm is None:
+            print(f"[files] Ignorando intento de traversal en FILE:{fname}")
+            return
+
+        # 🔹 CAMBIO CLAVE: Usar la ruta completa con estructura de carpetas
+        outname = os.path.join(RECV_DIR, fname_norm)
+
+        # Asegurar directorio padre
+        parent = os.path.dirname(outname)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+
+        if opts.get("replace") == "1":
+            # se escribe aparte y reemplaza al destino solo si llega completo
+            final = outname
+            os.makedirs(staging, exist_ok=True)
+            outname = os.path.join(staging, fid.hex())
+        else:
+            # Si ya existe un archivo con el mismo nombre, agrega un sufijo
+            outname = unique_path(outname)
+
+    try:
+        fh = open(outname, "wb")
+    except Exception as e:
+        print(f"[files] Error abriendo {outname}: {e}")
+        return
+
+    # reservar el espacio anunciado: lo que pasó la admisión no se lo puede
+    # quitar otra recepción ni un proceso externo a mitad de camino
+    reserved = False
+    if expected and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fh.fileno(), 0, expected)
+            reserved = True
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                fh.close()
                 try:
-                    _in_progress[fid]["handle"].close()
-                except Exception:
+                    os.remove(outname)
+                except OSError:
                     pass
-                _in_progress.pop(fid, None)
+                _reject(src_mac, fid, fname, "disk")
+                return
+            # el sistema de archivos no preasigna: cuenta como prometido
 
-            fname, expected = _safe_meta_decode(payload)
+    total = (expected + CHUNK_SIZE - 1) // CHUNK_SIZE
+    _in_progress[fid] = {
+        "path": outname,
+        "handle": fh,
+        "expected": expected,
+        "received": 0,
+        "reserved": reserved,
+        "total": total,
+        # un byte por chunk: 1 si ya se escribió (permite duplicados y huecos)
+        "have": bytearray(total),
+        "count": 0,
+        "group": opts.get("mode") == "group",
+        "src": src_mac,
+        "last_activity": time.time(),
+        "contiguous": 0,
+        # tamaño desconocido: siguiente seq a escribir (llegan en orden)
+        "next_seq": 1,
+        "watchers": 0,
+        "merkle": None,
+        "verifying": False,
+        "kind": kind,
+        "name": fname,
+        "final": final,
+    }
+    if opts.get("merkle") and total:
+        try:
+            _in_progress[fid].update(
+                merkle=bytes.fromhex(opts["merkle"]),
+                mb=int(opts["mb"]),
+                leaves=None,
+                bad=None,
+                rounds=0,
+            )
+        except (KeyError, ValueError):
+            pass
+    _entry_handle(fid, _in_progress[fid])
+    transfers.start(fid, "recv", src_mac, fname, expected)
+    print(
+        f"[files] FILE_START de {src_mac} id={fid.hex()} fname={fname} expected={expected}"
+    )
+    if _user_cb and kind is None:
+        _user_cb(src_mac, final or outname, "started")
 
-            # Soporte para marcador de carpeta: metadata con prefijo DIR:
-            if isinstance(fname, str) and fname.startswith("DIR:"):
-                rel = fname[4:]
-                # normalizar y evitar traversal
-                rel_norm = os.path.normpath(rel).replace("\\", "/")
-                if os.path.isabs(rel_norm) or rel_norm.startswith(".."):
-                    print(f"[files] Ignorando intento de traversal en DIR:{rel}")
-                    return
-                RECV_DIR = os.getenv("RECV_DIR", "/app/recv_files")
-                dirpath = os.path.join(RECV_DIR, rel_norm)
+
+def _deliver(src_mac: str, entry: Dict, status: str) -> None:
+    """
+    Notifica el fin de una recepción (llamar con _lock tomado y el handle
+    ya cerrado). Manifiestos y packs de carpeta los procesa `folders`.
+    """
+    if entry["kind"] is not None:
+        from folders import on_folder_part
+
+        on_folder_part(src_mac, entry, status, _user_cb)
+        return
+    if entry.get("final"):
+        try:
+            if status in ("completed", "finished"):
+                os.replace(entry["path"], entry["final"])
+            else:
+                os.remove(entry["path"])
+        except OSError as e:
+            print(f"[files] Error reemplazando {entry['final']}: {e}")
+            status = f"error:{e}"
+        entry["path"] = entry["final"]
+    if _user_cb:
+        _user_cb(src_mac, entry["path"], status)
+
+
+def _request_hashes(
+    src_mac: str, fid: bytes, rq: "queue.Queue", level: int, indices: List[int]
+) -> Optional[Dict[int, bytes]]:
+    """Pide al emisor los hashes de `indices` en `level` (agrupados en rangos)."""
+    runs: List[List[int]] = []
+    for i in indices:
+        if runs and i == runs[-1][-1] + 1 and len(runs[-1]) < _HASHES_PER_FRAME:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+
+    result: Dict[int, bytes] = {}
+    for run in runs:
+        req = build_header(
+            HASH_REQ,
+            struct.pack("!BII", level, run[0], len(run)),
+            channel=FILE_CHANNEL,
+            seq=0,
+            file_id=fid,
+        )
+        for attempt in range(3):
+            send_frame(src_mac, req)
+            deadline = time.time() + 1.0
+            got = False
+            while not got:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
                 try:
-                    os.makedirs(dirpath, exist_ok=True)
-                    print(f"[files] DIR_CREATED {dirpath} desde {src_mac}")
-                    if _user_cb:
-                        _user_cb(src_mac, dirpath, "dir_created")
-                except Exception as e:
-                    print(f"[files] Error creando dir {dirpath}: {e}")
-                return
+                    src, typ, _, payload = rq.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if typ != HASH_RESP or len(payload) < 5:
+                    continue
+                r_level, r_start = struct.unpack("!BI", payload[:5])
+                if r_level != level or r_start != run[0]:
+                    continue
+                body = payload[5:]
+                for k in range(len(body) // merkle.HASH_LEN):
+                    result[r_start + k] = body[k * merkle.HASH_LEN : (k + 1) * merkle.HASH_LEN]
+                got = True
+            if got:
+                break
+        else:
+            return None
+    return result
 
-            # Directorio de archivos recibidos (archivo normal)
-            RECV_DIR = os.getenv("RECV_DIR", "/app/recv_files")
-            os.makedirs(RECV_DIR, exist_ok=True)
 
-            # Sanitizar nombre/ruta y evitar path traversal
-            fname_norm = os.path.normpath(fname).replace("\\", "/")
-            if os.path.isabs(fname_norm) or fname_norm.startswith(".."):
-                print(f"[files] Ignorando intento de traversal en FILE:{fname}")
-                return
+def _find_bad_blocks(
+    src_mac: str, fid: bytes, levels: List[List[bytes]]
+) -> Optional[List[int]]:
+    """
+    Desciende por el árbol pidiendo al emisor solo los hijos de los nodos
+    que no coinciden. Devuelve los índices de bloque corruptos.
+    """
+    rq: "queue.Queue" = queue.Queue()
+    with _waiters_lock:
+        _reply_queues[fid] = rq
+    try:
+        suspects = [0]
+        for level in range(len(levels) - 2, -1, -1):
+            idxs = [i for p in suspects for i in merkle.children(levels, level + 1, p)]
+            remote = _request_hashes(src_mac, fid, rq, level, idxs)
+            if remote is None:
+                return None
+            suspects = [i for i in idxs if remote.get(i) != levels[level][i]]
+        return suspects
+    finally:
+        with _waiters_lock:
+            _reply_queues.pop(fid, None)
 
-            # 🔹 CAMBIO CLAVE: Usar la ruta completa con estructura de carpetas
-            outname = os.path.join(RECV_DIR, fname_norm)
 
-            # Asegurar directorio padre
-            parent = os.path.dirname(outname)
-            if parent:
-                os.makedirs(parent, exist_ok=True)
+def _finish_verified(fid: bytes, entry: Dict, status: str, ok: bool) -> None:
+    """Cierra la recepción verificada y recuerda el veredicto para reenviarlo."""
+    with _lock:
+        entry["verifying"] = False
+        _close_entry(fid, entry, status)
+        transfers.finish(fid, status)
+        _deliver(entry["src"], entry, status)
+        _remember_finished(fid, ACK if ok else NACK)
 
-            # Si ya existe un archivo con el mismo nombre, agrega un sufijo
-            if os.path.exists(outname):
-                base, ext = os.path.splitext(outname)
-                i = 1
-                while os.path.exists(f"{base}_{i}{ext}"):
-                    i += 1
-                outname = f"{base}_{i}{ext}"
 
-            try:
-                fh = open(outname, "wb")
-            except Exception as e:
-                print(f"[files] Error abriendo {outname}: {e}")
-                return
+def _send_verdict(src: str, fid: bytes, entry: Dict, ok: bool) -> None:
+    """
+    Veredicto de la verificación Merkle al emisor, con seq = seq de
+    FILE_END: ACK si el archivo quedó bien, NACK sin rangos si no. Si se
+    pierde, el emisor repite el FILE_END y se vuelve a enviar.
+    """
+    _send_end_reply(src, fid, ACK if ok else NACK, entry["total"] + 1)
+
 
-            _in_progress[fid] = {
-                "path": outname,
-                "handle": fh,
-                "expected": expected,
-                "received": 0,
-            }
-            print(
-                f"[files] FILE_START de {src_mac} id={fid.hex()} fname={fname} expected={expected}"
+def _verify_merkle(fid: bytes, entry: Dict) -> None:
+    """
+    Verifica el archivo recibido contra la raíz Merkle de FILE_START.
+    Solo se re-hashean los bloques que se pidieron de nuevo; si la raíz no
+    coincide se localizan los bloques malos y se piden sus chunks por NACK.
+    """
+    src = entry["src"]
+    mb = entry["mb"]
+    try:
+        with _lock:
+            if entry["handle"] is not None:
+                entry["handle"].flush()
+            leaves = entry["leaves"]
+            bad = entry["bad"]
+        if leaves is None:
+            leaves = merkle.leaf_hashes(entry["path"], mb)
+        else:
+            idx = sorted(bad)
+            for i, h in zip(idx, merkle.leaf_hashes(entry["path"], mb, idx)):
+                leaves[i] = h
+        levels = merkle.build_levels(leaves)
+
+        if merkle.root(levels) == entry["merkle"]:
+            _finish_verified(fid, entry, "finished", ok=True)
+            _send_verdict(src, fid, entry, ok=True)
+            return
+
+        bad = None
+        if entry["rounds"] < MERKLE_MAX_ROUNDS:
+            bad = _find_bad_blocks(src, fid, levels)
+        if not bad:
+            _finish_verified(fid, entry, "finished_hash_mismatch", ok=False)
+            _send_verdict(src, fid, entry, ok=False)
+            return
+
+        per_block = mb // CHUNK_SIZE
+        ranges = [
+            (b * per_block + 1, min((b + 1) * per_block, entry["total"])) for b in bad
+        ]
+        print(f"[files] Merkle: {len(bad)} bloques corruptos en id={fid.hex()}")
+        with _lock:
+            for start, end in ranges:
+                entry["have"][start - 1 : end] = bytes(end - start + 1)
+                entry["count"] -= end - start + 1
+            entry["contiguous"] = min(entry["contiguous"], (ranges[0][0] - 1) * CHUNK_SIZE)
+            entry["leaves"] = leaves
+            entry["bad"] = set(bad)
+            entry["rounds"] += 1
+            entry["last_activity"] = time.time()
+            entry["verifying"] = False
+        per_frame = CHUNK_SIZE // 8
+        for i in range(0, len(ranges), per_frame):
+            send_frame(
+                src,
+                build_header(
+                    NACK,
+                    pack_ranges(ranges[i : i + per_frame]),
+                    channel=FILE_CHANNEL,
+                    seq=0,
+                    file_id=fid,
+                ),
             )
-            if _user_cb:
-                _user_cb(src_mac, outname, "started")
+    except Exception as e:
+        print(f"[files] Error verificando Merkle id={fid.hex()}: {e}")
+        _finish_verified(fid, entry, f"error:{e}", ok=False)
+        _send_verdict(src, fid, entry, ok=False)
+
+
+def _file_recv_internal(src_mac: str, raw_payload: bytes):
+    """
+    Callback interno: parsea header y maneja FILE_START / FILE_CHUNK /
+    FILE_END / FILE_POLL y los ACK / NACK dirigidos a envíos propios.
+    """
+    global _user_cb
+    # IGNORAR paquetes que vienen de mi propia MAC (evita crear archivos propios)
+    if _my_mac and src_mac == _my_mac:
+        return
+
+    try:
+        info = parse_header(raw_payload)
+    except Exception:
+        return
+
+    typ = info["type"]
+    fid = info["id"]
+    payload = info["payload"]
+    seq = info["seq"]
+
+    if typ == FILE_REJECT:
+        # el receptor no admitió un envío propio: despertar sus esperas
+        reason = payload.decode("utf-8", errors="replace") or "rejected"
+        with _waiters_lock:
+            _refusals[fid] = reason
+            while len(_refusals) > _FINISHED_MAX:
+                _refusals.popitem(last=False)
+            events = [e for (f, _), e in _ack_waiters.items() if f == fid]
+            rq = _reply_queues.get(fid)
+        for event in events:
+            event.set()
+        if rq:
+            rq.put((src_mac, typ, seq, payload))
+        return
+
+    # respuestas a envíos propios: no tocan el estado de recepción
+    if typ in (ACK, NACK, HASH_REQ, HASH_RESP):
+        with _waiters_lock:
+            event = _ack_waiters.get((fid, seq)) if typ == ACK else None
+            rq = _reply_queues.get(fid)
+        if event:
+            event.set()
+        elif rq:
+            rq.put((src_mac, typ, seq, payload))
+        return
+
+    with _lock:
+        if typ == FILE_START:
+            _open_incoming(src_mac, fid, payload)
 
         elif typ == FILE_CHUNK:
             if fid not in _in_progress:
-                return
-            entry = _in_progress[fid]
-            try:
-                entry["handle"].write(payload)
-                entry["received"] += len(payload)
-                if entry["expected"] and entry["received"] >= entry["expected"]:
+                # retransmisión de un chunk ya completado (ACK perdido)
+                if fid in _finished and seq:
                     try:
-                        entry["handle"].close()
+                        send_frame(
+                            src_mac,
+                            build_header(
+                                ACK, b"", channel=FILE_CHANNEL, seq=seq, file_id=fid
+                            ),
+                        )
                     except Exception:
                         pass
-                    if _user_cb:
-                        _user_cb(src_mac, entry["path"], "completed")
-                    _in_progress.pop(fid, None)
+                return
+            entry = _in_progress[fid]
+            entry["last_activity"] = time.time()
+            try:
+                idx = seq - 1
+                fresh = True
+                if 0 <= idx < entry["total"]:
+                    fresh = not entry["have"][idx]
+                    if fresh:
+                        fh = _entry_handle(fid, entry)
+                        fh.seek(idx * CHUNK_SIZE)
+                        fh.write(payload)
+                        entry["have"][idx] = 1
+                        entry["count"] += 1
+                elif not entry["total"]:
+                    # tamaño desconocido: escritura secuencial; un seq ya
+                    # escrito es una retransmisión (se perdió el ACK)
+                    fresh = seq == entry["next_seq"]
+                    if fresh:
+                        reason = _check_growth(src_mac, entry, len(payload))
+                        if reason is not None:
+                            _abort_incoming(src_mac, fid, entry, reason)
+                            return
+                        _entry_handle(fid, entry).write(payload)
+                        entry["next_seq"] += 1
+                if fresh:
+                    entry["received"] += len(payload)
+                    transfers.on_acked(fid, len(payload))
+                    _advance_contiguous(entry)
+                    if entry["kind"] == "pack":
+                        # desempaquetar los archivos pequeños ya completos
+                        from folders import on_folder_part
+
+                        entry["handle"].flush()
+                        on_folder_part(src_mac, entry, "progress", _user_cb)
+                if entry["total"] and entry["count"] >= entry["total"]:
+                    if entry["merkle"]:
+                        # verificar por bloques fuera del hilo de recepción
+                        if not entry["verifying"]:
+                            entry["verifying"] = True
+                            threading.Thread(
+                                target=_verify_merkle, args=(fid, entry), daemon=True
+                            ).start()
+                    else:
+                        _close_entry(fid, entry, "completed")
+                        transfers.finish(fid, "completed")
+                        _deliver(src_mac, entry, "completed")
+                        _remember_finished(fid)
             except Exception as e:
+                transfers.finish(fid, "error")
                 if _user_cb:
                     _user_cb(src_mac, entry.get("path", "unknown"), f"error:{e}")
                 return
+            if entry["group"]:
+                # en modo grupo no hay ACK por chunk: se piden huecos por NACK
+                return
             # enviar ACK para este seq
             try:
                 ack_pkt = build_header(
@@ -287,14 +1458,39 @@ def _file_recv_internal(src_mac: str, raw_payload: bytes):
             except Exception as e:
                 print(f"[files] Error enviando ACK: {e}")
 
+        elif typ == FILE_POLL:
+            if fid in _finished:
+                ranges = []
+            else:
+                if fid not in _in_progress:
+                    # se perdió el FILE_START: la metadata viaja en el POLL
+                    _open_incoming(src_mac, fid, payload[4:])
+                entry = _in_progress.get(fid)
+                if entry is None:
+                    return
+                entry["last_activity"] = time.time()
+                ranges = _missing_ranges(entry["have"])
+            # jitter para no saturar al emisor con todos los NACK a la vez
+            threading.Timer(
+                random.uniform(0, NACK_JITTER),
+                _send_poll_reply,
+                args=(src_mac, fid, ranges),
+            ).start()
+
         elif typ == FILE_END:
             if fid not in _in_progress:
+                reply = _finished.get(fid)
+                if reply:
+                    # FILE_END repetido: se perdió el ACK o el veredicto
+                    _send_end_reply(src_mac, fid, reply, seq)
                 return
             entry = _in_progress[fid]
-            try:
-                entry["handle"].close()
-            except Exception:
-                pass
+            if entry["merkle"]:
+                # se verifica con el árbol Merkle al completar los chunks
+                return
+            # tamaño desconocido con ACK: el emisor espera confirmación
+            end_ack = not entry["total"] and not entry["group"]
+            _close_entry(fid, entry, "finished")
             remote_hash = payload.decode("utf-8", errors="replace")
             local_path = entry["path"]
             sha256 = hashlib.sha256()
@@ -310,9 +1506,22 @@ def _file_recv_internal(src_mac: str, raw_payload: bytes):
             if remote_hash and local_hash and remote_hash != local_hash:
                 status = "finished_hash_mismatch"
 
-            if _user_cb:
-                _user_cb(src_mac, entry["path"], status)
-            _in_progress.pop(fid, None)
+            transfers.finish(fid, status)
+            _deliver(src_mac, entry, status)
+            _remember_finished(fid, ACK if end_ack else 0)
+            if end_ack:
+                _send_end_reply(src_mac, fid, ACK, seq)
+
+
+def _send_end_reply(src_mac: str, fid: bytes, typ: int, seq: int) -> None:
+    """Respuesta al FILE_END (ACK o veredicto Merkle), sin payload."""
+    try:
+        send_frame(
+            src_mac,
+            build_header(typ, b"", channel=FILE_CHANNEL, seq=seq, file_id=fid),
+        )
+    except Exception as e:
+        print(f"[files] Error respondiendo FILE_END: {e}")
 
 
 def start_file_loop(
@@ -320,17 +1529,14 @@ def start_file_loop(
 ) -> None:
     global _user_cb, _recv_started, _my_mac
     _user_cb = user_callback
-    _my_mac = my_mac
+    if my_mac:
+        _my_mac = my_mac
 
     if not _recv_started:
-        # Registrar callback para FILE_CHANNEL
-        from ethernet import register_channel_callback
-
-        register_channel_callback(FILE_CHANNEL, _file_recv_internal)
-
-        # Iniciar recv_loop solo una vez
-        start_recv_loop(lambda src, payload: None)
+        # Registrar callback para FILE_CHANNEL e iniciar recv_loop solo una vez
+        _ensure_receiver()
         _recv_started = True
+    _start_reaper()
 
 
 def stop_file_loop() -> None:
@@ -338,13 +1544,10 @@ def stop_file_loop() -> None:
     stop_recv_loop()
     _user_cb = None
     _recv_started = False
+    _reaper_stop.set()
     with _lock:
         for fid, entry in list(_in_progress.items()):
-            try:
-                entry["handle"].close()
-            except Exception:
-                pass
-            _in_progress.pop(fid, None)
+            _close_entry(fid, entry)
 
 
 def receive_file_blocking() -> Tuple[Optional[str], Optional[str]]:
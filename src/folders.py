@@ -1,22 +1,249 @@
+import io
 import os
-# from typing import Optional
+import json
+import uuid
+import zlib
+import hashlib
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from protocol import build_header, new_file_id, FILE_START, FILE_END, FILE_CHANNEL
-from ethernet import send_frame
-from files import send_file
+from files import (
+    STAGING_DIR,
+    safe_relpath,
+    send_file,
+    send_stream,
+    unique_path,
+)
 
+SMALL_FILE_MAX = 64 * 1024  # archivos menores viajan empaquetados
+PACK_SIZE = 4 * 1024 * 1024  # bytes por pack
+# hilos para listar directorios y hashear (hashlib libera el GIL al leer
+# bloques grandes y el escaneo en sistemas de red es sobre todo espera)
+SCAN_WORKERS = int(
+    os.getenv("LINKCHAT_SCAN_WORKERS", str(min(32, (os.cpu_count() or 2) * 4)))
+)
 
-def _send_dir_marker(dest_mac: str, relpath: str) -> None:
+# peso de las sincronizaciones en el planificador: corren de fondo y ceden
+# caudal a los envíos que pide el usuario
+SYNC_WEIGHT = float(os.getenv("LINKCHAT_SYNC_WEIGHT", "0.5"))
+
+_scan_executor: Optional[ThreadPoolExecutor] = None
+
+# claves de las entradas de archivo que no viajan en el manifiesto
+_LOCAL_KEYS = ("abs", "mt")
+
+# sesiones de carpeta en recepción: sid -> {"src", "root", "packs"}
+_sessions: Dict[str, Dict] = {}
+# sincronizaciones en espera de SYNCREPLY: sid -> {"event", "reply"}
+_sync_waiters: Dict[str, Dict] = {}
+
+
+def _file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for b in iter(lambda: fh.read(65536), b""):
+            sha256.update(b)
+    return sha256.hexdigest()
+
+
+class _PackReader:
     """
-    Envía un marcador DIR:<relpath>|0 como FILE_START para que el receptor cree directorios.
+    Lee como un único flujo la concatenación de varios archivos pequeños.
+    Cada archivo aporta exactamente el tamaño anotado en el manifiesto
+    (se rellena o recorta si cambió en disco) para que los offsets valgan.
     """
-    file_id = new_file_id()
-    meta = f"DIR:{relpath}|0".encode("utf-8")
-    pkt = build_header(FILE_START, meta, channel=FILE_CHANNEL, seq=0, file_id=file_id)
-    send_frame(dest_mac, pkt)
-    # opcional: enviar FILE_END breve para "cerrar" marker
-    pkt_end = build_header(FILE_END, b"", channel=FILE_CHANNEL, seq=0, file_id=file_id)
-    send_frame(dest_mac, pkt_end)
+
+    def __init__(self, items: List[Dict]):
+        self._items = items
+        self._idx = 0
+        self._fh = None
+        self._left = 0
+
+    def read(self, n: int) -> bytes:
+        out = bytearray()
+        while len(out) < n and self._idx < len(self._items):
+            if self._fh is None:
+                item = self._items[self._idx]
+                self._fh = open(item["abs"], "rb")
+                self._left = item["s"]
+            want = min(n - len(out), self._left)
+            data = self._fh.read(want)
+            out += data + b"\x00" * (want - len(data))  # el archivo se acortó
+            self._left -= want
+            if self._left == 0:
+                self._fh.close()
+                self._fh = None
+                self._idx += 1
+        return bytes(out)
+
+
+def _get_scan_executor() -> ThreadPoolExecutor:
+    global _scan_executor
+    if _scan_executor is None:
+        _scan_executor = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+    return _scan_executor
+
+
+def _scan_dir(abs_dir: str, rel_dir: str) -> Tuple[List[Tuple], List[Dict]]:
+    """
+    Lista un directorio con os.scandir. Devuelve (subdirs, archivos);
+    subdirs: (ruta absoluta, ruta remota, descender). Como os.walk, los
+    enlaces a directorios se crean pero no se recorren.
+    """
+    subdirs: List[Tuple] = []
+    files: List[Dict] = []
+    try:
+        with os.scandir(abs_dir) as it:
+            for de in it:
+                rel = f"{rel_dir}/{de.name}"
+                try:
+                    if de.is_dir():
+                        subdirs.append((de.path, rel, not de.is_symlink()))
+                        continue
+                    st = de.stat()
+                except OSError:
+                    continue
+                files.append(
+                    {
+                        "p": rel,
+                        "s": st.st_size,
+                        "m": st.st_mode & 0o777,
+                        "abs": de.path,
+                        "mt": st.st_mtime_ns,
+                    }
+                )
+    except OSError as e:
+        print(f"[folders] No se pudo leer {abs_dir}: {e}")
+    return subdirs, files
+
+
+def _hash_entry(entry: Dict) -> Tuple[List[Tuple], List[Dict]]:
+    try:
+        entry["h"] = _file_sha256(entry["abs"])
+    except OSError:
+        return [], []  # desapareció durante el escaneo
+    return [], [entry]
+
+
+def _scan_tree(
+    folder_path: str, base: str, hashes: bool
+) -> Iterator[Tuple[str, object]]:
+    """
+    Recorre la carpeta en paralelo: cada directorio (y cada hash, si
+    hashes=True) es una tarea del pool. Genera ("dir", ruta remota) y
+    ("file", entrada) en el orden en que terminan. Cada archivo lleva su
+    ruta remota "p", tamaño, modo y las claves locales "abs" y "mt".
+    """
+    pool = _get_scan_executor()
+    pending = {pool.submit(_scan_dir, folder_path, base)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            subdirs, files = fut.result()
+            for abs_dir, rel_dir, descend in subdirs:
+                yield "dir", rel_dir
+                if descend:
+                    pending.add(pool.submit(_scan_dir, abs_dir, rel_dir))
+            for entry in files:
+                # los grandes se verifican con el SHA-256 de su propio envío
+                if hashes and "h" not in entry and entry["s"] < SMALL_FILE_MAX:
+                    pending.add(pool.submit(_hash_entry, entry))
+                else:
+                    yield "file", entry
+
+
+def _scan_background(folder_path: str, base: str, hashes: bool) -> Iterator:
+    """
+    Ejecuta _scan_tree en su propio hilo para que el escaneo avance
+    mientras el llamador envía lo ya encontrado.
+    """
+    out: "queue.Queue" = queue.Queue()
+
+    def run() -> None:
+        try:
+            for item in _scan_tree(folder_path, base, hashes):
+                out.put(item)
+            out.put(None)
+        except Exception as e:
+            out.put(("error", e))
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        item = out.get()
+        if item is None:
+            return
+        if item[0] == "error":
+            raise item[1]
+        yield item
+
+
+def _scan_folder(
+    folder_path: str, base: str, hashes: bool
+) -> Tuple[List[str], List[Dict]]:
+    """Escaneo completo: devuelve (dirs, archivos)."""
+    dirs = [base]
+    entries: List[Dict] = []
+    for kind, item in _scan_tree(folder_path, base, hashes):
+        (dirs if kind == "dir" else entries).append(item)
+    return dirs, entries
+
+
+def _send_tree(
+    dest_mac: str,
+    base: str,
+    dirs: List[str],
+    entries: List[Dict],
+    opts: Dict,
+    replace: bool = False,
+    **extra,
+) -> None:
+    """
+    Envía el manifiesto, los packs de archivos pequeños y los archivos
+    grandes de `entries`. extra: claves adicionales del manifiesto.
+    """
+    sid = uuid.uuid4().hex[:12]
+    small = [e for e in entries if e["s"] < SMALL_FILE_MAX]
+    large = [e for e in entries if e["s"] >= SMALL_FILE_MAX]
+
+    # repartir los archivos pequeños en packs
+    packs: List[List[Dict]] = []
+    pack_len = PACK_SIZE
+    for entry in small:
+        if pack_len + entry["s"] > PACK_SIZE and (not packs or packs[-1]):
+            packs.append([])
+            pack_len = 0
+        entry["k"] = len(packs) - 1
+        entry["o"] = pack_len
+        packs[-1].append(entry)
+        pack_len += entry["s"]
+
+    manifest = {
+        "v": 1,
+        "root": base,
+        "dirs": dirs,
+        "files": [
+            {k: v for k, v in e.items() if k not in _LOCAL_KEYS} for e in small + large
+        ],
+        "packs": len(packs),
+    }
+    manifest.update(extra)
+    print(
+        f"[folders] {base}: {len(dirs)} dirs, {len(small)} archivos en "
+        f"{len(packs)} packs, {len(large)} archivos grandes"
+    )
+
+    _send_manifest(dest_mac, sid, manifest, opts)
+
+    for k, items in enumerate(packs):
+        size = sum(e["s"] for e in items)
+        send_stream(dest_mac, _PackReader(items), f"PACK:{sid}:{k}", size, **opts)
+
+    for entry in large:
+        send_file(
+            dest_mac, entry["abs"], remote_name=entry["p"], replace=replace, **opts
+        )
 
 
 def send_folder(
@@ -26,42 +253,517 @@ def send_folder(
     use_ack: bool = True,
     retries: int = 5,
     timeout: float = 1.0,
+    cancel_event: Optional[threading.Event] = None,
+    hashes: bool = False,
 ) -> None:
     """
-    Envía una carpeta recursivamente:
-      - envía marker para carpeta raíz y subcarpetas (DIR:...)
-      - envía cada archivo con remote_name relativo a la raíz (e.g. "miCarpeta/sub/archivo.txt")
+    Envía una carpeta recursivamente mientras se escanea (en paralelo):
+      - los archivos menores que SMALL_FILE_MAX se concatenan en packs de
+        ~PACK_SIZE bytes; cada pack va precedido de un tramo de manifiesto
+        comprimido con los directorios vistos hasta ahora y sus archivos
+        (ruta, tamaño, modo, offset y, si hashes=True, SHA-256)
+      - el resto sale en cuanto aparece, con send_file y remote_name
+        relativo a la raíz (e.g. "miCarpeta/sub/archivo.txt")
+    cancel_event se pasa a cada envío: al activarse, el siguiente chunk
+    lanza files.TransferCancelled.
     """
     if not os.path.isdir(folder_path):
         raise FileNotFoundError(folder_path)
 
     folder_path = os.path.abspath(folder_path)
     base = os.path.basename(folder_path.rstrip("/"))
+    opts = {
+        "use_ack": use_ack,
+        "retries": retries,
+        "timeout": timeout,
+        "cancel_event": cancel_event,
+    }
+
+    dirs = [base]
+    small: List[Dict] = []
+    small_len = 0
+    for kind, entry in _scan_background(folder_path, base, hashes):
+        if kind == "dir":
+            dirs.append(entry)
+        elif entry["s"] >= SMALL_FILE_MAX:
+            send_file(dest_mac, entry["abs"], remote_name=entry["p"], **opts)
+        else:
+            if small and small_len + entry["s"] > PACK_SIZE:
+                # pack lleno: sale un tramo de manifiesto con su pack
+                _send_tree(dest_mac, base, dirs, small, opts)
+                dirs, small, small_len = [base], [], 0
+            small.append(entry)
+            small_len += entry["s"]
+    # siempre hay al menos un tramo: con él el receptor anuncia la carpeta
+    _send_tree(dest_mac, base, dirs, small, opts)
+
+
+# --- Sincronización incremental ----------------------------------------------
+
+
+def _sync_dir() -> str:
+    return os.path.expanduser(os.getenv("LINKCHAT_SYNC_DIR", "~/.linkchat/sync"))
+
+
+def _index_path(dest_mac: str, base: str) -> str:
+    return os.path.join(_sync_dir(), f"{dest_mac.replace(':', '')}-{base}.json")
+
 
-    # enviar marker para la carpeta raíz
-    _send_dir_marker(dest_mac, base)
+def _load_index(path: str) -> Dict[str, List]:
+    """Índice persistido: ruta relativa -> [tamaño, mtime_ns, sha256]."""
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh).get("files", {})
+    except (OSError, ValueError):
+        return {}
 
-    for root, dirs, files in os.walk(folder_path):
-        rel_root = os.path.relpath(root, folder_path)
-        if rel_root == ".":
-            rel_dir = base
+
+def _save_index(path: str, files: Dict[str, List]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump({"v": 1, "files": files}, fh, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def _hash_with_index(entries: List[Dict], index: Dict[str, List], key) -> None:
+    """
+    Completa "h" en cada entrada; si tamaño y mtime coinciden con el índice
+    se reutiliza el hash guardado en vez de releer el archivo.
+    """
+    todo = []
+    for e in entries:
+        cached = index.get(key(e))
+        if cached and cached[0] == e["s"] and cached[1] == e["mt"]:
+            e["h"] = cached[2]
         else:
-            rel_dir = os.path.join(base, rel_root)
-
-        # crear marcadores para subdirectorios
-        for d in dirs:
-            relpath = os.path.join(rel_dir, d).replace(os.path.sep, "/")
-            _send_dir_marker(dest_mac, relpath)
-
-        # enviar archivos
-        for f in files:
-            abs_path = os.path.join(root, f)
-            remote_rel = os.path.join(rel_dir, f).replace(os.path.sep, "/")
-            send_file(
-                dest_mac,
-                abs_path,
-                use_ack=use_ack,
-                retries=retries,
-                timeout=timeout,
-                remote_name=remote_rel,
+            todo.append(e)
+    hashes = _get_scan_executor().map(_file_sha256, [e["abs"] for e in todo])
+    for e, h in zip(todo, hashes):
+        e["h"] = h
+
+
+def sync_folder(
+    dest_mac: str,
+    folder_path: str,
+    *,
+    delete: bool = False,
+    use_ack: bool = True,
+    retries: int = 5,
+    timeout: float = 1.0,
+    cancel_event: Optional[threading.Event] = None,
+    reply_timeout: float = 60.0,
+) -> Dict:
+    """
+    Sincroniza una carpeta con la copia que el peer tiene en RECV_DIR:
+      1. escanea la carpeta; el índice persistido por peer evita volver a
+         hashear archivos con igual tamaño y mtime
+      2. envía un manifiesto SYNC con (ruta, tamaño, hash) de cada archivo
+      3. el receptor compara con su disco y responde (SYNCREPLY) qué
+         archivos le faltan o difieren y cuáles sobran
+      4. se envían solo esos archivos (sobrescribiendo en destino) y, si
+         delete=True, se propagan los borrados
+    Los envíos usan SYNC_WEIGHT en el planificador de transmisión.
+    Devuelve {"sent", "unchanged", "deleted", "bytes"}.
+    """
+    if not os.path.isdir(folder_path):
+        raise FileNotFoundError(folder_path)
+
+    folder_path = os.path.abspath(folder_path)
+    base = os.path.basename(folder_path.rstrip("/"))
+    index_path = _index_path(dest_mac, base)
+    dirs, entries = _scan_folder(folder_path, base, hashes=False)
+    _hash_with_index(entries, _load_index(index_path), lambda e: e["p"])
+
+    opts = {
+        "use_ack": use_ack,
+        "retries": retries,
+        "timeout": timeout,
+        "cancel_event": cancel_event,
+        "weight": SYNC_WEIGHT,
+    }
+    sid = uuid.uuid4().hex[:12]
+    state = {
+        "v": 1,
+        "root": base,
+        "files": [{"p": e["p"], "s": e["s"], "h": e["h"]} for e in entries],
+    }
+    waiter = {"event": threading.Event(), "reply": None}
+    _sync_waiters[sid] = waiter
+    try:
+        data = zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+        send_stream(dest_mac, io.BytesIO(data), f"SYNC:{sid}", len(data), **opts)
+        if not waiter["event"].wait(reply_timeout):
+            raise TimeoutError(f"{dest_mac} no respondió al manifiesto de {base}")
+    finally:
+        _sync_waiters.pop(sid, None)
+
+    reply = waiter["reply"]
+    need = set(reply.get("need", []))
+    extra = reply.get("extra", []) if delete else []
+    todo = [e for e in entries if e["p"] in need]
+    print(
+        f"[folders] SYNC {base} -> {dest_mac}: {len(todo)} a enviar, "
+        f"{len(entries) - len(todo)} sin cambios, {len(extra)} a borrar"
+    )
+    if todo or extra:
+        _send_tree(
+            dest_mac, base, dirs, todo, opts, replace=True, sync=True, delete=extra
+        )
+
+    # el peer confirmó su estado y ya tiene lo enviado: persistir el índice
+    _save_index(index_path, {e["p"]: [e["s"], e["mt"], e["h"]] for e in entries})
+    return {
+        "sent": len(todo),
+        "unchanged": len(entries) - len(todo),
+        "deleted": len(extra),
+        "bytes": sum(e["s"] for e in todo),
+    }
+
+
+def _send_manifest(dest_mac: str, sid: str, manifest: Dict, opts: Dict) -> None:
+    data = zlib.compress(json.dumps(manifest, separators=(",", ":")).encode("utf-8"))
+    send_stream(dest_mac, io.BytesIO(data), f"MANIFEST:{sid}", len(data), **opts)
+
+
+class _PrefixedReader:
+    """Devuelve primero `head` (ya leído) y luego el resto de `reader`."""
+
+    def __init__(self, head: bytes, reader):
+        self._head = head
+        self._reader = reader
+
+    def read(self, n: int) -> bytes:
+        if self._head:
+            out, self._head = self._head[:n], self._head[n:]
+            return out
+        return self._reader.read(n)
+
+
+class _CountingReader:
+    def __init__(self, reader):
+        self._reader = reader
+        self.count = 0
+
+    def read(self, n: int) -> bytes:
+        data = self._reader.read(n)
+        self.count += len(data)
+        return data
+
+
+def _read_upto(reader, n: int) -> bytes:
+    out = bytearray()
+    while len(out) < n:
+        data = reader.read(n - len(out))
+        if not data:
+            break
+        out += data
+    return bytes(out)
+
+
+def send_folder_stream(
+    dest_mac: str,
+    base: str,
+    entries: Iterable[Tuple[str, object]],
+    *,
+    use_ack: bool = True,
+    retries: int = 5,
+    timeout: float = 1.0,
+    cancel_event: Optional[threading.Event] = None,
+) -> Dict:
+    """
+    Envía una carpeta cuyos archivos llegan como flujo (e.g. desde una
+    subida multipart) sin escribirlos antes a disco.
+    entries: pares (ruta relativa a la raíz, objeto con read(n)), que se
+    consumen en orden y una sola vez.
+      - los archivos pequeños se acumulan en memoria; al llenar un pack
+        (o al terminar) se envía un manifiesto con esos archivos y su pack
+      - los grandes se envían al vuelo con send_stream de tamaño desconocido
+    """
+    opts = {
+        "use_ack": use_ack,
+        "retries": retries,
+        "timeout": timeout,
+        "cancel_event": cancel_event,
+    }
+    stats = {"files": 0, "bytes": 0, "packs": 0}
+    items: List[Dict] = []
+    pack = bytearray()
+
+    def flush() -> None:
+        dirs = {base}
+        for e in items:
+            parent = os.path.dirname(e["p"])
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        manifest = {
+            "v": 1,
+            "root": base,
+            "dirs": sorted(dirs),
+            "files": items,
+            "packs": 1 if items else 0,
+        }
+        sid = uuid.uuid4().hex[:12]
+        _send_manifest(dest_mac, sid, manifest, opts)
+        if items:
+            send_stream(
+                dest_mac, io.BytesIO(bytes(pack)), f"PACK:{sid}:0", len(pack), **opts
+            )
+            stats["packs"] += 1
+        items.clear()
+        pack.clear()
+
+    for rel, reader in entries:
+        path = f"{base}/{rel}"
+        head = _read_upto(reader, SMALL_FILE_MAX)
+        stats["files"] += 1
+        if len(head) < SMALL_FILE_MAX:
+            if len(pack) + len(head) > PACK_SIZE:
+                flush()
+            items.append(
+                {"p": path, "s": len(head), "m": 0o644, "k": 0, "o": len(pack)}
+            )
+            pack += head
+            stats["bytes"] += len(head)
+            continue
+        if items:
+            # los pequeños ya leídos no esperan a que termine el grande
+            flush()
+        # el receptor crea los directorios intermedios de la ruta
+        counter = _CountingReader(_PrefixedReader(head, reader))
+        send_stream(dest_mac, counter, path, 0, **opts)
+        stats["bytes"] += counter.count
+
+    if items or not stats["packs"]:
+        # siempre al menos un manifiesto: el receptor anuncia la carpeta con él
+        flush()
+    print(
+        f"[folders] {base}: {stats['files']} archivos ({stats['bytes']} bytes) "
+        f"enviados en flujo, {stats['packs']} packs"
+    )
+    return stats
+
+
+# --- Recepción -------------------------------------------------------------
+
+
+def _recv_dir() -> str:
+    return os.getenv("RECV_DIR", "/app/recv_files")
+
+
+def _apply_manifest(src_mac: str, path: str) -> Optional[Dict]:
+    """Crea el árbol de directorios en una pasada y prepara los packs."""
+    with open(path, "rb") as fh:
+        manifest = json.loads(zlib.decompress(fh.read()))
+
+    recv_dir = _recv_dir()
+    root = safe_relpath(manifest["root"])
+    if root is None:
+        print(f"[folders] Ignorando manifiesto con raíz inválida: {manifest['root']}")
+        return None
+
+    for d in manifest["dirs"]:
+        rel = safe_relpath(d)
+        if rel is None:
+            continue
+        os.makedirs(os.path.join(recv_dir, rel), exist_ok=True)
+
+    replace = bool(manifest.get("sync"))
+    for d in manifest.get("delete", []):
+        rel = safe_relpath(d)
+        if rel is None or not rel.startswith(root + "/"):
+            continue
+        try:
+            os.remove(os.path.join(recv_dir, rel))
+            print(f"[folders] SYNC borrado {rel}")
+        except OSError:
+            pass
+
+    packs: Dict[int, List[Dict]] = {}
+    for e in manifest["files"]:
+        rel = safe_relpath(e["p"])
+        if rel is None:
+            print(f"[folders] Ignorando intento de traversal en {e['p']}")
+            continue
+        target = os.path.join(recv_dir, rel)
+        if "k" in e:
+            packs.setdefault(e["k"], []).append(
+                dict(e, target=target, replace=replace)
             )
+        # los archivos grandes llegan como transferencias normales
+
+    for items in packs.values():
+        items.sort(key=lambda e: e["o"])
+
+    return {"src": src_mac, "root": os.path.join(recv_dir, root), "packs": packs}
+
+
+def _unpack_ready(
+    src_mac: str,
+    entry: Dict,
+    limit: int,
+    user_cb: Optional[Callable[[str, str, str], None]],
+) -> None:
+    """Escribe los archivos del pack cuyo rango ya está dentro de `limit`."""
+    sid, k = entry["name"][len("PACK:") :].rsplit(":", 1)
+    session = _sessions.get(sid)
+    if session is None:
+        return
+    items = session["packs"].get(int(k), [])
+    idx = entry.get("unpacked", 0)
+    if idx >= len(items) or items[idx]["o"] + items[idx]["s"] > limit:
+        return
+
+    fd = os.open(entry["path"], os.O_RDONLY)
+    try:
+        while idx < len(items) and items[idx]["o"] + items[idx]["s"] <= limit:
+            item = items[idx]
+            data = os.pread(fd, item["s"], item["o"])
+            if item["replace"]:
+                # sincronización: sobrescribir de forma atómica
+                target = item["target"]
+                tmp = target + ".linkchat-tmp"
+            else:
+                target = tmp = unique_path(item["target"])
+            status = "finished"
+            try:
+                with open(tmp, "wb") as out:
+                    out.write(data)
+                os.chmod(tmp, item.get("m", 0o644))
+                if tmp != target:
+                    os.replace(tmp, target)
+                if "h" in item and hashlib.sha256(data).hexdigest() != item["h"]:
+                    status = "finished_hash_mismatch"
+            except Exception as e:
+                status = f"error:{e}"
+            if user_cb:
+                user_cb(src_mac, target, status)
+            idx += 1
+    finally:
+        os.close(fd)
+    entry["unpacked"] = idx
+
+
+def _compare_sync(state: Dict) -> Optional[Tuple[List[str], List[str]]]:
+    """
+    Compara el estado anunciado en un manifiesto SYNC con la copia local:
+    devuelve (archivos que faltan o difieren, archivos que sobran). Solo
+    se hashean los archivos locales con el mismo tamaño que el remoto,
+    y el hash se cachea por tamaño y mtime entre sincronizaciones.
+    """
+    recv_dir = _recv_dir()
+    root = safe_relpath(state["root"])
+    if root is None or root == "." or "/" in root:
+        print(f"[folders] Ignorando SYNC con raíz inválida: {state['root']}")
+        return None
+
+    local: Dict[str, Dict] = {}
+    root_abs = os.path.join(recv_dir, root)
+    if os.path.isdir(root_abs):
+        _, entries = _scan_folder(root_abs, root, hashes=False)
+        local = {e["p"]: e for e in entries}
+
+    cache_path = os.path.join(recv_dir, STAGING_DIR, f"sync-{root}.json")
+    cache = _load_index(cache_path)
+    need = []
+    compared = []
+    for f in state["files"]:
+        e = local.get(f["p"])
+        if e is None or e["s"] != f["s"]:
+            need.append(f["p"])
+            continue
+        _hash_with_index([e], cache, lambda e: e["p"])
+        compared.append(e)
+        if e["h"] != f["h"]:
+            need.append(f["p"])
+    remote = {f["p"] for f in state["files"]}
+    extra = [p for p in local if p not in remote]
+    try:
+        _save_index(cache_path, {e["p"]: [e["s"], e["mt"], e["h"]] for e in compared})
+    except OSError as e:
+        print(f"[folders] No se pudo guardar la caché de sync: {e}")
+    return need, extra
+
+
+def _answer_sync(src_mac: str, sid: str, state: Dict) -> None:
+    """Responde un manifiesto SYNC (en su propio hilo: hashea y espera ACKs)."""
+    try:
+        result = _compare_sync(state)
+    except Exception as e:
+        print(f"[folders] Error comparando SYNC de {src_mac}: {e}")
+        return
+    if result is None:
+        return
+    need, extra = result
+    print(
+        f"[folders] SYNCREPLY a {src_mac}: {len(need)} necesarios, "
+        f"{len(extra)} sobrantes"
+    )
+    reply = {"need": need, "extra": extra}
+    data = zlib.compress(json.dumps(reply, separators=(",", ":")).encode("utf-8"))
+    try:
+        send_stream(src_mac, io.BytesIO(data), f"SYNCREPLY:{sid}", len(data))
+    except Exception as e:
+        print(f"[folders] Error enviando SYNCREPLY a {src_mac}: {e}")
+
+
+def on_folder_part(
+    src_mac: str,
+    entry: Dict,
+    status: str,
+    user_cb: Optional[Callable[[str, str, str], None]],
+) -> None:
+    """
+    Llamado por files (con su lock tomado) para manifiestos, packs y
+    mensajes de sincronización: status 'progress' a medida que crece el
+    prefijo contiguo de un pack, o el estado final de la recepción.
+    """
+    try:
+        if entry["kind"] == "manifest":
+            if status in ("completed", "finished"):
+                sid = entry["name"][len("MANIFEST:") :]
+                session = _apply_manifest(src_mac, entry["path"])
+                if session:
+                    if session["packs"]:
+                        _sessions[sid] = session
+                    print(f"[folders] DIR_TREE {session['root']} desde {src_mac}")
+                    if user_cb:
+                        user_cb(src_mac, session["root"], "dir_created")
+            os.remove(entry["path"])
+
+        elif entry["kind"] == "sync":
+            if status in ("completed", "finished"):
+                sid = entry["name"][len("SYNC:") :]
+                with open(entry["path"], "rb") as fh:
+                    state = json.loads(zlib.decompress(fh.read()))
+                threading.Thread(
+                    target=_answer_sync, args=(src_mac, sid, state), daemon=True
+                ).start()
+            os.remove(entry["path"])
+
+        elif entry["kind"] == "syncreply":
+            if status in ("completed", "finished"):
+                sid = entry["name"][len("SYNCREPLY:") :]
+                waiter = _sync_waiters.get(sid)
+                if waiter is not None:
+                    with open(entry["path"], "rb") as fh:
+                        waiter["reply"] = json.loads(zlib.decompress(fh.read()))
+                    waiter["event"].set()
+            os.remove(entry["path"])
+
+        elif entry["kind"] == "pack":
+            if status == "progress":
+                _unpack_ready(src_mac, entry, entry["contiguous"], user_cb)
+                return
+            if status in ("completed", "finished"):
+                _unpack_ready(src_mac, entry, entry["expected"], user_cb)
+            sid, k = entry["name"][len("PACK:") :].rsplit(":", 1)
+            session = _sessions.get(sid)
+            if session:
+                session["packs"].pop(int(k), None)
+                if not session["packs"]:
+                    _sessions.pop(sid, None)
+            os.remove(entry["path"])
+    except Exception as e:
+        print(f"[folders] Error procesando {entry['name']}: {e}")
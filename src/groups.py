@@ -0,0 +1,275 @@
+# src/groups.py
+"""
+Mensajería de grupo sobre CHAT_CHANNEL.
+Un grupo se identifica por gid = sha256(nombre)[:16], que viaja en el campo
+file_id del header. Cada mensaje sale una sola vez por broadcast:
+  - GROUP_INFO: nombre|mac1,mac2,...  (alta o cambio de miembros)
+  - GROUP_MSG: texto, seq = número de mensaje del emisor
+  - GROUP_RECEIPT: acuse unicast de cada miembro (mismo seq y gid)
+Los receptores descartan los grupos ajenos mirando solo el gid, antes de
+decodificar. Los acuses llegan con un retraso al azar (evita la implosión
+de respuestas) y a los miembros que faltan se les repite el mensaje en
+hasta REPAIR_ROUNDS rondas, otra vez con un único broadcast precedido del
+GROUP_INFO (un miembro que lo perdió descarta los GROUP_MSG del grupo).
+El seq arranca en un valor al azar en cada proceso: tras un reinicio del
+emisor sus mensajes no chocan con los (src, gid, seq) que los receptores
+ya recuerdan como vistos.
+"""
+import hashlib
+import random
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from protocol import (
+    CHAT_CHANNEL,
+    GROUP_INFO,
+    GROUP_MSG,
+    GROUP_RECEIPT,
+    build_header,
+    parse_header,
+)
+from ethernet import register_channel_callback, send_frame, start_recv_loop
+
+BROADCAST_MAC = "ff:ff:ff:ff:ff:ff"
+RECEIPT_JITTER = 0.05  # s máximos de espera antes de enviar un acuse
+RECEIPT_TIMEOUT = 1.0  # s de espera de acuses por ronda
+REPAIR_ROUNDS = 2
+_SEEN_MAX = 1024
+_DONE_MAX = 256
+_GROUP_TYPES = (GROUP_MSG, GROUP_RECEIPT, GROUP_INFO)
+_ID_SLICE = slice(7, 23)  # posición del file_id en el header
+
+# gid -> {"name", "members": set de MACs, "info": payload del GROUP_INFO}
+_groups: Dict[bytes, Dict] = {}
+# (gid, seq) -> {"members", "delivered", "event", "frame"}
+_pending: Dict[Tuple[bytes, int], Dict] = {}
+# entregas ya cerradas, para consultarlas después
+_done: "OrderedDict[Tuple[bytes, int], Dict]" = OrderedDict()
+# mensajes ya entregados al usuario: (src, gid, seq)
+_seen: "OrderedDict[Tuple[str, bytes, int], bool]" = OrderedDict()
+_lock = threading.Lock()
+_seq = random.randint(0, 0xFFFFFFFE)
+_my_mac: Optional[str] = None
+_registered = False
+
+# on_message(src_mac, gid_hex, texto, seq)
+_message_cb: Optional[Callable[[str, str, str, int], None]] = None
+# on_receipt(gid_hex, seq, mac_miembro)
+_receipt_cb: Optional[Callable[[str, int, str], None]] = None
+
+
+def group_id(name: str) -> bytes:
+    return hashlib.sha256(name.encode("utf-8")).digest()[:16]
+
+
+def _broadcast(msg_type: int, payload: bytes, gid: bytes, seq: int = 0) -> bytes:
+    frame = build_header(
+        msg_type, payload, channel=CHAT_CHANNEL, seq=seq, file_id=gid
+    )
+    send_frame(BROADCAST_MAC, frame)
+    return frame
+
+
+# --- Miembros ----------------------------------------------------------------
+
+
+def create_group(name: str, members: Iterable[str]) -> str:
+    """
+    Crea (o redefine) un grupo y anuncia sus miembros con un GROUP_INFO;
+    los miembros lo incorporan al recibirlo. Devuelve el gid en hex.
+    """
+    gid = group_id(name)
+    members = {m.lower() for m in members}
+    if _my_mac:
+        members.add(_my_mac)
+    payload = f"{name}|{','.join(sorted(members))}".encode("utf-8")
+    with _lock:
+        _groups[gid] = {"name": name, "members": members, "info": payload}
+    _broadcast(GROUP_INFO, payload, gid)
+    print(f"[groups] Grupo {name} ({gid.hex()}) con {len(members)} miembros")
+    return gid.hex()
+
+
+def leave_group(gid_hex: str) -> None:
+    with _lock:
+        _groups.pop(bytes.fromhex(gid_hex), None)
+
+
+def list_groups() -> List[Dict]:
+    with _lock:
+        return [
+            {"id": gid.hex(), "name": g["name"], "members": sorted(g["members"])}
+            for gid, g in _groups.items()
+        ]
+
+
+# --- Envío -------------------------------------------------------------------
+
+
+def send_group_message(gid_hex: str, text: str) -> int:
+    """
+    Envía `text` al grupo con un único broadcast y devuelve su seq. Los
+    acuses se recogen en segundo plano (ver receipts / on_receipt).
+    """
+    global _seq
+    gid = bytes.fromhex(gid_hex)
+    with _lock:
+        group = _groups.get(gid)
+        if group is None:
+            raise KeyError(f"grupo desconocido: {gid_hex}")
+        _seq = _seq % 0xFFFFFFFF + 1
+        seq = _seq
+        members = set(group["members"]) - {_my_mac}
+        state = {
+            "members": members,
+            "delivered": set(),
+            "event": threading.Event(),
+            "frame": None,
+        }
+        _pending[(gid, seq)] = state
+    state["frame"] = _broadcast(GROUP_MSG, text.encode("utf-8"), gid, seq)
+    if members:
+        threading.Thread(target=_collect, args=(gid, seq), daemon=True).start()
+    else:
+        _close(gid, seq)
+    return seq
+
+
+def _collect(gid: bytes, seq: int) -> None:
+    """Espera acuses; repite el broadcast mientras falten miembros."""
+    state = _pending[(gid, seq)]
+    for round_no in range(REPAIR_ROUNDS + 1):
+        if state["event"].wait(RECEIPT_TIMEOUT):
+            break
+        if round_no == REPAIR_ROUNDS:
+            break
+        missing = state["members"] - state["delivered"]
+        print(f"[groups] seq={seq}: reenviando, faltan {len(missing)} acuses")
+        with _lock:
+            info = _groups.get(gid, {}).get("info")
+        if info:
+            _broadcast(GROUP_INFO, info, gid)
+        send_frame(BROADCAST_MAC, state["frame"])
+    _close(gid, seq)
+
+
+def _close(gid: bytes, seq: int) -> None:
+    with _lock:
+        state = _pending.pop((gid, seq), None)
+        if state is None:
+            return
+        _done[(gid, seq)] = state
+        while len(_done) > _DONE_MAX:
+            _done.popitem(last=False)
+
+
+def receipts(gid_hex: str, seq: int) -> Optional[Dict]:
+    """{"members", "delivered", "pending", "complete"} de un mensaje enviado."""
+    key = (bytes.fromhex(gid_hex), seq)
+    with _lock:
+        state = _pending.get(key) or _done.get(key)
+        if state is None:
+            return None
+        return {
+            "members": sorted(state["members"]),
+            "delivered": sorted(state["delivered"]),
+            "pending": key in _pending,
+            "complete": state["delivered"] >= state["members"],
+        }
+
+
+# --- Recepción ---------------------------------------------------------------
+
+
+def _send_receipt(dest_mac: str, gid: bytes, seq: int) -> None:
+    frame = build_header(
+        GROUP_RECEIPT, b"", channel=CHAT_CHANNEL, seq=seq, file_id=gid
+    )
+    try:
+        send_frame(dest_mac, frame)
+    except Exception as e:
+        print(f"[groups] Error enviando acuse: {e}")
+
+
+def _internal_cb(src_mac: str, raw: bytes) -> None:
+    # filtrado barato: tipo y gid sin decodificar el resto
+    if len(raw) < 25 or raw[1] not in _GROUP_TYPES or src_mac == _my_mac:
+        return
+    gid = raw[_ID_SLICE]
+    if raw[1] != GROUP_INFO and gid not in _groups:
+        return
+    try:
+        info = parse_header(raw)
+    except Exception:
+        return
+    seq = info["seq"]
+
+    if info["type"] == GROUP_MSG:
+        key = (src_mac, gid, seq)
+        with _lock:
+            fresh = key not in _seen
+            if fresh:
+                _seen[key] = True
+                while len(_seen) > _SEEN_MAX:
+                    _seen.popitem(last=False)
+        # se acusa también un duplicado: el acuse anterior pudo perderse
+        threading.Timer(
+            random.uniform(0, RECEIPT_JITTER),
+            _send_receipt,
+            args=(src_mac, gid, seq),
+        ).start()
+        if fresh and _message_cb:
+            text = info["payload"].decode("utf-8", errors="replace")
+            try:
+                _message_cb(src_mac, gid.hex(), text, seq)
+            except Exception as e:
+                print(f"[groups] error en callback del usuario: {e}")
+
+    elif info["type"] == GROUP_RECEIPT:
+        with _lock:
+            state = _pending.get((gid, seq))
+            if state is None or src_mac not in state["members"]:
+                return
+            if src_mac in state["delivered"]:
+                return
+            state["delivered"].add(src_mac)
+            if state["delivered"] >= state["members"]:
+                state["event"].set()
+        if _receipt_cb:
+            try:
+                _receipt_cb(gid.hex(), seq, src_mac)
+            except Exception as e:
+                print(f"[groups] error en callback de acuse: {e}")
+
+    elif info["type"] == GROUP_INFO:
+        text = info["payload"].decode("utf-8", errors="replace")
+        name, _, macs = text.partition("|")
+        members: Set[str] = {m for m in macs.split(",") if m}
+        if group_id(name) != gid:
+            return
+        with _lock:
+            if _my_mac in members:
+                _groups[gid] = {
+                    "name": name,
+                    "members": members,
+                    "info": info["payload"],
+                }
+            else:
+                _groups.pop(gid, None)
+        print(f"[groups] GROUP_INFO {name} de {src_mac}: {len(members)} miembros")
+
+
+def start_group_loop(
+    my_mac: str,
+    on_message: Callable[[str, str, str, int], None],
+    on_receipt: Optional[Callable[[str, int, str], None]] = None,
+) -> None:
+    global _my_mac, _message_cb, _receipt_cb, _registered
+    _my_mac = my_mac.lower()
+    _message_cb = on_message
+    _receipt_cb = on_receipt
+    if not _registered:
+        register_channel_callback(CHAT_CHANNEL, _internal_cb)
+        _registered = True
+    start_recv_loop(lambda src, payload: None)  # El routing se hace por canales
@@ -0,0 +1,81 @@
+# src/merkle.py
+"""
+Árbol Merkle sobre bloques de tamaño fijo de un archivo.
+levels[0] son las hojas (un hash por bloque) y levels[-1] = [raíz].
+Un nodo sin hermano sube tal cual al nivel superior.
+Las hojas se calculan en paralelo: hashlib libera el GIL con buffers grandes.
+"""
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional
+
+HASH_LEN = 32
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 2)
+    return _executor
+
+
+def hash_leaf(data: bytes) -> bytes:
+    h = hashlib.sha256(b"\x00")
+    h.update(data)
+    return h.digest()
+
+
+def hash_node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+def block_count(size: int, block_size: int) -> int:
+    return max(1, (size + block_size - 1) // block_size)
+
+
+def _hash_block(fd: int, index: int, block_size: int) -> bytes:
+    return hash_leaf(os.pread(fd, block_size, index * block_size))
+
+
+def leaf_hashes(
+    path: str, block_size: int, indices: Optional[Iterable[int]] = None
+) -> List[bytes]:
+    """
+    Hash de cada bloque de `path` (o solo de `indices`, en ese orden),
+    repartido en el pool de hilos.
+    """
+    size = os.path.getsize(path)
+    if indices is None:
+        indices = range(block_count(size, block_size))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        futures = [
+            _get_executor().submit(_hash_block, fd, i, block_size) for i in indices
+        ]
+        return [f.result() for f in futures]
+    finally:
+        os.close(fd)
+
+
+def build_levels(leaves: List[bytes]) -> List[List[bytes]]:
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        prev = levels[-1]
+        nxt = [hash_node(prev[i], prev[i + 1]) for i in range(0, len(prev) - 1, 2)]
+        if len(prev) % 2:
+            nxt.append(prev[-1])
+        levels.append(nxt)
+    return levels
+
+
+def root(levels: List[List[bytes]]) -> bytes:
+    return levels[-1][0]
+
+
+def children(levels: List[List[bytes]], level: int, index: int) -> List[int]:
+    """Índices en levels[level - 1] de los hijos del nodo (level, index)."""
+    below = len(levels[level - 1])
+    return [i for i in (2 * index, 2 * index + 1) if i < below]
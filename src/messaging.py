@@ -1,24 +1,288 @@
 # src/messaging.py
-from protocol import build_header, parse_header, MSG, CHAT_CHANNEL
-from ethernet import send_frame, recv_one, start_recv_loop, stop_recv_loop
-from typing import Callable, Optional
+from protocol import build_header, parse_header, MSG, ACK, CHAT_CHANNEL
+from ethernet import (
+    get_interface_mac,
+    register_channel_callback,
+    recv_one,
+    send_frame,
+    start_recv_loop,
+    stop_recv_loop,
+)
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Set
+import random
 import socket
 import struct
+import threading
 import time
-import os
 from ethernet import INTERFACE, ETH_P_LINKCHAT
+import metrics
+from presence import get_peers, local_name
 
 BROADCAST_MAC = "ff:ff:ff:ff:ff:ff"
 DISCOVER_REQ = "__LINKCHAT_DISCOVER_REQ__"
 DISCOVER_REPLY_PREFIX = "__LINKCHAT_DISCOVER_RPLY__|"
 
 
-def send_message(dest_mac: str, text: str, seq: int = 0) -> None:
-    print("Mandando mensaje")
+# --- Entrega fiable -----------------------------------------------------------
+# Los MSG unicast llevan seq >= 1 por peer y en file_id 4 enteros:
+#   epoch del flujo | epoch del flujo que se confirma | último seq en orden | 0
+# La epoch (al azar por flujo emisor->peer) distingue un flujo nuevo (un
+# reinicio, o uno abandonado por falta de ACK) de un duplicado.
+# El ACK va a caballo en el siguiente MSG hacia ese peer o, si no hay
+# ninguno en ACK_DELAY, en una trama ACK sola. seq=0 es el modo antiguo
+# (sin ACK): broadcast, discovery y peers que no hablan este protocolo.
+# Si llega un MSG con seq > 1 de una epoch desconocida (el receptor se
+# reinició a mitad del flujo, o se perdió el seq 1) el receptor no puede
+# saber qué faltó: responde un ACK con ACK_RESET en el cuarto entero y el
+# emisor reenvía sus pendientes en un flujo nuevo. Las tramas que aún
+# lleguen de la epoch abandonada se ignoran.
+WINDOW = 32  # mensajes sin confirmar por peer
+ACK_DELAY = 0.02
+RTO_INITIAL = 0.3
+RTO_MAX = 3.0
+MAX_RETRIES = 8
+ACK_RESET = 1  # flag del ACK: epoch desconocida, empezar un flujo nuevo
+_STALE_MAX = 8  # epochs abandonadas que se recuerdan por peer
+
+# peer -> {"epoch", "next_seq", "unacked": OrderedDict seq -> {...}, "queue"}
+_tx: Dict[str, Dict] = {}
+# peer -> {"epoch", "expected", "buffer": {seq: texto}, "ack_due"}
+_rx: Dict[str, Dict] = {}
+# peer -> epochs a las que se respondió ACK_RESET (sus tramas se ignoran)
+_stale: Dict[str, "OrderedDict[int, bool]"] = {}
+# peers que ya demostraron hablar el protocolo fiable
+_reliable_peers: Set[str] = set()
+_rel_lock = threading.Lock()
+_rel_cond = threading.Condition(_rel_lock)
+_rel_thread: Optional[threading.Thread] = None
+
+_RETRANSMITS = metrics.counter(
+    "linkchat_retransmits_total", "Tramas reenviadas", ("layer",)
+).labels("chat")
+_ACK_TIMEOUTS = metrics.counter(
+    "linkchat_ack_timeouts_total", "Esperas de ACK vencidas", ("layer",)
+).labels("chat")
+_ACK_RTT = metrics.histogram(
+    "linkchat_ack_rtt_seconds",
+    "RTT de las tramas confirmadas al primer intento",
+    ("layer",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+).labels("chat")
+_GIVEUPS = metrics.counter(
+    "linkchat_messages_dropped_total",
+    "Mensajes fiables descartados tras MAX_RETRIES sin ACK",
+)
+
+
+def _ack_fields(peer: str) -> bytes:
+    """file_id con la epoch del flujo y el ACK acumulado para `peer` (con lock)."""
+    tx = _tx.get(peer)
+    epoch = tx["epoch"] if tx else 0
+    rx = _rx.get(peer)
+    if rx is None:
+        return struct.pack("!IIII", epoch, 0, 0, 0)
+    rx["ack_due"] = None  # va a caballo
+    return struct.pack("!IIII", epoch, rx["epoch"], rx["expected"] - 1, 0)
+
+
+def _supports_reliable(peer: str) -> bool:
+    if peer in _reliable_peers:
+        return True
+    # los peers con nombre en presence usan la versión actual del protocolo
+    p = get_peers().get(peer)
+    return bool(p and p.get("named"))
+
+
+def _transmit(peer: str, seq: int, entry: Dict) -> None:
+    """Envía (o reenvía) un MSG fiable; llamar con _rel_lock tomado."""
+    pkt = build_header(
+        MSG,
+        entry["payload"],
+        channel=CHAT_CHANNEL,
+        seq=seq,
+        file_id=_ack_fields(peer),
+    )
+    if entry["tries"]:
+        _RETRANSMITS.inc()
+    entry["tries"] += 1
+    entry["sent_at"] = time.time()
+    entry["deadline"] = entry["sent_at"] + min(
+        RTO_INITIAL * 2 ** (entry["tries"] - 1), RTO_MAX
+    )
+    try:
+        send_frame(peer, pkt)
+    except Exception as e:
+        print(f"[messaging] Error enviando seq={seq} a {peer}: {e}")
+
+
+def _fill_window(peer: str) -> None:
+    tx = _tx[peer]
+    while tx["queue"] and len(tx["unacked"]) < WINDOW:
+        seq = tx["next_seq"]
+        tx["next_seq"] += 1
+        entry = {"payload": tx["queue"].popleft(), "tries": 0, "deadline": 0.0}
+        tx["unacked"][seq] = entry
+        _transmit(peer, seq, entry)
+    _rel_cond.notify()
+
+
+def _new_stream(peer: str, queue: Optional[deque] = None) -> Dict:
+    _tx[peer] = {
+        "epoch": random.randint(1, 0xFFFFFFFF),
+        "next_seq": 1,
+        "unacked": OrderedDict(),
+        "queue": queue if queue is not None else deque(),
+    }
+    return _tx[peer]
+
+
+def _send_reliable(dest_mac: str, payload: bytes) -> None:
+    with _rel_lock:
+        tx = _tx.get(dest_mac) or _new_stream(dest_mac)
+        tx["queue"].append(payload)
+        _fill_window(dest_mac)
+    _ensure_rel_thread()
+
+
+def _restart_stream(peer: str, epoch: int) -> None:
+    """
+    El receptor no conoce la epoch `epoch` (con _rel_lock tomado): los
+    pendientes y la cola salen otra vez, en orden, en un flujo nuevo.
+    """
+    tx = _tx.get(peer)
+    if tx is None or tx["epoch"] != epoch:
+        return  # ya se reinició (llegan varios ACK_RESET por ventana)
+    payloads = [e["payload"] for e in tx["unacked"].values()]
+    print(f"[messaging] {peer} no conoce el flujo: reenviando {len(payloads)}")
+    _new_stream(peer, deque(payloads + list(tx["queue"])))
+    _fill_window(peer)
+
+
+def _send_reset(peer: str, epoch: int) -> None:
+    """ACK_RESET para la epoch `epoch` de `peer` (con _rel_lock tomado)."""
+    stale = _stale.setdefault(peer, OrderedDict())
+    stale[epoch] = True
+    while len(stale) > _STALE_MAX:
+        stale.popitem(last=False)
+    tx = _tx.get(peer)
+    fields = struct.pack("!IIII", tx["epoch"] if tx else 0, epoch, 0, ACK_RESET)
+    pkt = build_header(ACK, b"", channel=CHAT_CHANNEL, file_id=fields)
+    try:
+        send_frame(peer, pkt)
+    except Exception as e:
+        print(f"[messaging] Error enviando ACK_RESET a {peer}: {e}")
+
+
+def _on_ack(peer: str, ack_epoch: int, ack_seq: int) -> None:
+    """ACK acumulado de `peer` (con _rel_lock tomado)."""
+    tx = _tx.get(peer)
+    if tx is None or ack_epoch != tx["epoch"]:
+        return
+    unacked = tx["unacked"]
+    now = time.time()
+    while unacked and next(iter(unacked)) <= ack_seq:
+        _, entry = unacked.popitem(last=False)
+        if entry["tries"] == 1:
+            _ACK_RTT.observe(now - entry["sent_at"])
+    _fill_window(peer)
+
+
+def _on_reliable_msg(peer: str, epoch: int, seq: int, text: str) -> List[str]:
+    """
+    Registra un MSG fiable y devuelve los textos que quedan listos para
+    entregar en orden (con _rel_lock tomado).
+    """
+    rx = _rx.get(peer)
+    if rx is None or rx["epoch"] != epoch:
+        if epoch in _stale.get(peer, ()) or seq != 1:
+            # flujo a medias que no conocemos: que el emisor empiece otro
+            _send_reset(peer, epoch)
+            return []
+        # peer nuevo o reiniciado: empieza de cero
+        rx = {"epoch": epoch, "expected": 1, "buffer": {}, "ack_due": None}
+        _rx[peer] = rx
+    ready: List[str] = []
+    if seq == rx["expected"]:
+        ready.append(text)
+        rx["expected"] += 1
+        while rx["expected"] in rx["buffer"]:
+            ready.append(rx["buffer"].pop(rx["expected"]))
+            rx["expected"] += 1
+    elif rx["expected"] < seq < rx["expected"] + 2 * WINDOW:
+        rx["buffer"].setdefault(seq, text)  # llegó antes de tiempo
+    # duplicado o no: hay que confirmar (el ACK anterior pudo perderse)
+    if rx["ack_due"] is None:
+        rx["ack_due"] = time.time() + ACK_DELAY
+        _rel_cond.notify()
+    return ready
+
+
+def _rel_loop() -> None:
+    """Reenvía los MSG vencidos y emite los ACK que no fueron a caballo."""
+    with _rel_lock:
+        while True:
+            now = time.time()
+            wake = now + 1.0
+            for peer, tx in list(_tx.items()):
+                if any(
+                    e["tries"] >= MAX_RETRIES and e["deadline"] <= now
+                    for e in tx["unacked"].values()
+                ):
+                    # el peer no responde: se pierden los pendientes y los
+                    # que esperan salen en un flujo nuevo (el receptor no
+                    # se queda esperando un hueco que nunca llegará)
+                    print(
+                        f"[messaging] Sin ACK de {peer}: descartados "
+                        f"{len(tx['unacked'])} mensajes"
+                    )
+                    _GIVEUPS.inc(len(tx["unacked"]))
+                    tx = _new_stream(peer, tx["queue"])
+                for seq, entry in tx["unacked"].items():
+                    if entry["deadline"] <= now:
+                        _ACK_TIMEOUTS.inc()
+                        _transmit(peer, seq, entry)
+                    wake = min(wake, entry["deadline"])
+                if tx["queue"] and len(tx["unacked"]) < WINDOW:
+                    _fill_window(peer)
+            for peer, rx in _rx.items():
+                due = rx["ack_due"]
+                if due is None:
+                    continue
+                if due <= now:
+                    pkt = build_header(
+                        ACK, b"", channel=CHAT_CHANNEL, file_id=_ack_fields(peer)
+                    )
+                    try:
+                        send_frame(peer, pkt)
+                    except Exception as e:
+                        print(f"[messaging] Error enviando ACK a {peer}: {e}")
+                else:
+                    wake = min(wake, due)
+            _rel_cond.wait(max(0.0, wake - time.time()))
+
+
+def _ensure_rel_thread() -> None:
+    global _rel_thread
+    with _rel_lock:
+        if _rel_thread is None:
+            _rel_thread = threading.Thread(target=_rel_loop, daemon=True)
+            _rel_thread.start()
+
+
+def send_message(dest_mac: str, text: str, reliable: bool = True) -> None:
+    """
+    Envía un mensaje de chat sin bloquear. A un peer concreto que habla el
+    protocolo fiable se entrega exactamente una vez y en orden (con ACK y
+    reenvíos en segundo plano); en broadcast o con reliable=False, seq=0.
+    """
     if not dest_mac:
         dest_mac = BROADCAST_MAC
     payload = text.encode("utf-8")
-    pkt = build_header(MSG, payload, channel=CHAT_CHANNEL, seq=seq)
+    if reliable and dest_mac != BROADCAST_MAC and _supports_reliable(dest_mac):
+        _send_reliable(dest_mac, payload)
+        return
+    pkt = build_header(MSG, payload, channel=CHAT_CHANNEL, seq=0)
     send_frame(dest_mac, pkt)
 
 
@@ -40,6 +304,8 @@ def receive_message_blocking() -> tuple[str, str]:
 
 # Background loop
 _message_loop_callback: Optional[Callable[[str, str], None]] = None
+# MAC propia: el socket ETH_P_ALL también ve las tramas que envía este nodo
+_my_mac: Optional[str] = None
 
 
 def _internal_cb(src_mac: str, raw_payload: bytes):
@@ -51,27 +317,48 @@ def _internal_cb(src_mac: str, raw_payload: bytes):
         info = parse_header(raw_payload)
     except Exception:
         return
+    if _my_mac and src_mac == _my_mac:
+        return  # trama propia (PACKET_OUTGOING): ni ACK ni flujo consigo mismo
+    if info["type"] == ACK:
+        epoch, ack_epoch, ack_seq, flags = struct.unpack("!IIII", info["id"])
+        with _rel_lock:
+            _reliable_peers.add(src_mac)
+            if flags & ACK_RESET:
+                _restart_stream(src_mac, ack_epoch)
+            else:
+                _on_ack(src_mac, ack_epoch, ack_seq)
+        _ensure_rel_thread()
+        return
     if info["type"] != MSG:
         return
     text = info["payload"].decode("utf-8", errors="replace")
 
+    if info["seq"]:
+        # MSG fiable: ACK a caballo, dedup y reordenamiento
+        epoch, ack_epoch, ack_seq, _ = struct.unpack("!IIII", info["id"])
+        with _rel_lock:
+            _reliable_peers.add(src_mac)
+            if ack_epoch:
+                _on_ack(src_mac, ack_epoch, ack_seq)
+            ready = _on_reliable_msg(src_mac, epoch, info["seq"], text)
+        _ensure_rel_thread()
+        for text in ready:
+            _deliver(src_mac, text)
+        return
+
     # Auto-responder a petición de discovery (unicast al solicitante)
+    # (discovery antiguo: los nodos actuales usan presence en DISCOVERY_CHANNEL)
     if text == DISCOVER_REQ:
+        reply = DISCOVER_REPLY_PREFIX + local_name()
         try:
-            user = os.environ.get("USER") or os.getlogin()
-        except Exception:
-            user = "user"
-        try:
-            host = socket.gethostname()
-        except Exception:
-            host = "host"
-        name = f"{user}@{host}"
-        reply = DISCOVER_REPLY_PREFIX + name
-        try:
-            send_message(src_mac, reply)
+            send_message(src_mac, reply, reliable=False)
         except Exception:
             pass
 
+    _deliver(src_mac, text)
+
+
+def _deliver(src_mac: str, text: str) -> None:
     # Llamar al callback de mensajes normales si existe
     if _message_loop_callback:
         try:
@@ -80,14 +367,21 @@ def _internal_cb(src_mac: str, raw_payload: bytes):
             print(f"[messaging] error en callback del usuario: {e}")
 
 
-def start_message_loop(user_callback: Callable[[str, str], None]) -> None:
-    global _message_loop_callback
+def start_message_loop(
+    user_callback: Callable[[str, str], None], my_mac: Optional[str] = None
+) -> None:
+    global _message_loop_callback, _my_mac
     _message_loop_callback = user_callback
+    if my_mac:
+        _my_mac = my_mac.lower()
+    elif _my_mac is None:
+        try:
+            _my_mac = ":".join(f"{b:02x}" for b in get_interface_mac(INTERFACE))
+        except Exception:
+            pass
 
     # En lugar de start_recv_loop(_internal_cb)
     # Registrar callback para CHAT_CHANNEL
-    from ethernet import register_channel_callback
-
     register_channel_callback(CHAT_CHANNEL, _internal_cb)
 
     # Iniciar recv_loop solo una vez (con un callback dummy)
@@ -110,7 +404,7 @@ def discover_peers(timeout: float = 2.0) -> list:
         s.bind((INTERFACE, 0))
         s.settimeout(0.5)
         # enviar petición de discovery (broadcast)
-        send_message(BROADCAST_MAC, DISCOVER_REQ)
+        send_message(BROADCAST_MAC, DISCOVER_REQ, reliable=False)
         start = time.time()
         while (time.time() - start) < timeout:
             try:
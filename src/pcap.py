@@ -0,0 +1,88 @@
+# src/pcap.py
+"""
+Lectura y escritura de capturas en formato pcap clásico (LINKTYPE_ETHERNET),
+legibles con tcpdump / Wireshark. ethernet las usa para grabar el tráfico
+LinkChat (LINKCHAT_PCAP) y bench/replay.py para reinyectarlo.
+"""
+import struct
+import threading
+import time
+from typing import Iterator, Optional, Tuple
+
+LINKTYPE_ETHERNET = 1
+SNAPLEN = 65535
+
+_MAGIC_US = 0xA1B2C3D4  # timestamps en microsegundos
+_MAGIC_NS = 0xA1B23C4D  # timestamps en nanosegundos
+_GLOBAL_HEADER = struct.Struct("<IHHiIII")
+_RECORD_HEADER = struct.Struct("<IIII")
+
+
+class PcapWriter:
+    """Escritor con buffer; write() es seguro entre hilos."""
+
+    def __init__(self, path: str, snaplen: int = SNAPLEN):
+        self.path = path
+        self.snaplen = snaplen
+        self.frames = 0
+        self._fh = open(path, "wb", buffering=1024 * 1024)
+        self._fh.write(
+            _GLOBAL_HEADER.pack(_MAGIC_US, 2, 4, 0, 0, snaplen, LINKTYPE_ETHERNET)
+        )
+        self._lock = threading.Lock()
+
+    def write(self, frame: bytes, ts: Optional[float] = None) -> None:
+        if ts is None:
+            ts = time.time()
+        sec = int(ts)
+        usec = int((ts - sec) * 1_000_000)
+        data = frame[: self.snaplen]
+        with self._lock:
+            if self._fh is None:
+                return
+            self._fh.write(_RECORD_HEADER.pack(sec, usec, len(data), len(frame)))
+            self._fh.write(data)
+            self.frames += 1
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def read_pcap(path: str) -> Iterator[Tuple[float, bytes]]:
+    """
+    Genera (timestamp, trama) de una captura pcap Ethernet en cualquier
+    orden de bytes y con timestamps en µs o ns. Un último registro
+    truncado (captura cortada) se ignora.
+    """
+    with open(path, "rb") as fh:
+        head = fh.read(_GLOBAL_HEADER.size)
+        if len(head) < _GLOBAL_HEADER.size:
+            raise ValueError(f"{path}: no es una captura pcap")
+        for endian in ("<", ">"):
+            magic = struct.unpack(endian + "I", head[:4])[0]
+            if magic in (_MAGIC_US, _MAGIC_NS):
+                break
+        else:
+            raise ValueError(f"{path}: magic pcap desconocido (¿pcapng?)")
+        linktype = struct.unpack(endian + "I", head[20:24])[0]
+        if linktype != LINKTYPE_ETHERNET:
+            raise ValueError(f"{path}: linktype {linktype}, se esperaba Ethernet")
+        scale = 1e-9 if magic == _MAGIC_NS else 1e-6
+        record = struct.Struct(endian + "IIII")
+        while True:
+            rec = fh.read(record.size)
+            if len(rec) < record.size:
+                return
+            sec, frac, incl_len, _ = record.unpack(rec)
+            frame = fh.read(incl_len)
+            if len(frame) < incl_len:
+                return
+            yield sec + frac * scale, frame
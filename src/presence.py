@@ -0,0 +1,375 @@
+# src/presence.py
+"""
+Servicio de presencia sobre DISCOVERY_CHANNEL.
+  - DISCOVER_RESP (anuncio): payload b"nombre|ttl". Cada nodo lo difunde en
+    broadcast cada ~BEACON_INTERVAL (con jitter) y al responder consultas;
+    ttl=0 es una despedida.
+  - DISCOVER (consulta): payload = MACs (6 bytes c/u) que quien pregunta ya
+    conoce con TTL de sobra; esos nodos no responden (known-answer).
+Las respuestas se retrasan al azar y se limitan a una cada
+ANNOUNCE_MIN_INTERVAL, así una ráfaga de consultas cuesta un anuncio por
+nodo. Además cualquier trama recibida refresca al peer que la envió, y los
+peers se guardan en disco para arrancar con la lista ya poblada.
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from protocol import (
+    DISCOVER,
+    DISCOVER_RESP,
+    DISCOVERY_CHANNEL,
+    build_header,
+    parse_header,
+)
+from ethernet import (
+    flush_tx,
+    register_channel_callback,
+    register_frame_observer,
+    send_frame,
+    start_recv_loop,
+)
+
+BROADCAST_MAC = "ff:ff:ff:ff:ff:ff"
+
+BEACON_INTERVAL = float(os.getenv("LINKCHAT_BEACON_INTERVAL", "20"))
+BEACON_JITTER = 0.25  # fracción del intervalo
+PEER_TTL = float(os.getenv("LINKCHAT_PEER_TTL", str(BEACON_INTERVAL * 3 + 5)))
+RESPONSE_DELAY_MAX = 0.5  # s de espera al azar antes de responder una consulta
+ANNOUNCE_MIN_INTERVAL = 1.0  # s mínimos entre anuncios propios
+QUERY_MIN_INTERVAL = 5.0  # s mínimos entre consultas a un mismo destino
+SWEEP_INTERVAL = 1.0
+CACHE_PATH = os.path.expanduser(
+    os.getenv("LINKCHAT_PEER_CACHE", "~/.linkchat/peers.json")
+)
+CACHE_SAVE_INTERVAL = 10.0
+
+# mac -> {"name", "last_seen", "ttl", "named"}
+_peers: Dict[str, Dict] = {}
+_lock = threading.Lock()
+_wake = threading.Event()
+_thread: Optional[threading.Thread] = None
+_running = False
+_registered = False
+
+_my_mac: Optional[str] = None
+_my_name = ""
+_on_change: Optional[Callable[[Dict[str, Dict]], None]] = None
+
+_last_announce = 0.0
+_pending_announce: Optional[float] = None
+_next_beacon = 0.0
+_last_query: Dict[str, float] = {}  # destino -> última consulta enviada u oída
+_dirty = False
+_last_save = 0.0
+
+
+def local_name() -> str:
+    try:
+        user = os.environ.get("USER") or os.getlogin()
+    except Exception:
+        user = "user"
+    try:
+        host = socket.gethostname()
+    except Exception:
+        host = "host"
+    return f"{user}@{host}"
+
+
+def _mac_bytes(mac: str) -> bytes:
+    return bytes.fromhex(mac.replace(":", ""))
+
+
+def _notify() -> None:
+    if _on_change:
+        try:
+            _on_change(get_peers())
+        except Exception as e:
+            print(f"[presence] error en callback: {e}")
+
+
+# --- Envío -------------------------------------------------------------------
+
+
+def _announce(ttl: Optional[float] = None) -> None:
+    global _last_announce, _pending_announce, _next_beacon
+    ttl = PEER_TTL if ttl is None else ttl
+    payload = f"{_my_name}|{int(ttl)}".encode("utf-8")
+    try:
+        send_frame(
+            BROADCAST_MAC,
+            build_header(DISCOVER_RESP, payload, channel=DISCOVERY_CHANNEL),
+        )
+    except Exception as e:
+        print(f"[presence] Error enviando anuncio: {e}")
+    now = time.time()
+    _last_announce = now
+    _pending_announce = None
+    # un anuncio cuenta como beacon
+    _next_beacon = now + BEACON_INTERVAL * random.uniform(
+        1 - BEACON_JITTER, 1 + BEACON_JITTER
+    )
+
+
+def query(dest_mac: str = BROADCAST_MAC) -> bool:
+    """
+    Pide anuncios a `dest_mac` (broadcast por defecto). Incluye los peers
+    conocidos con más de la mitad del TTL por delante para que no respondan.
+    Devuelve False si se omitió por límite de frecuencia.
+    """
+    now = time.time()
+    with _lock:
+        if now - _last_query.get(dest_mac, 0.0) < QUERY_MIN_INTERVAL:
+            return False
+        _last_query[dest_mac] = now
+        known = b""
+        if dest_mac == BROADCAST_MAC:
+            known = b"".join(
+                _mac_bytes(mac)
+                for mac, p in _peers.items()
+                if p["named"] and p["last_seen"] + p["ttl"] / 2 > now
+            )
+    # que quepa en una trama
+    known = known[: (1500 - 25) // 6 * 6]
+    try:
+        send_frame(dest_mac, build_header(DISCOVER, known, channel=DISCOVERY_CHANNEL))
+    except Exception as e:
+        print(f"[presence] Error enviando consulta: {e}")
+    return True
+
+
+# --- Recepción ---------------------------------------------------------------
+
+
+def _learn(mac: str, name: Optional[str], ttl: float, now: float) -> bool:
+    """Actualiza un peer (llamar con _lock tomado). True si cambió la lista."""
+    peer = _peers.get(mac)
+    if peer is None:
+        _peers[mac] = {
+            "name": name or f"User_{mac.replace(':', '')[-6:]}",
+            "last_seen": now,
+            "ttl": ttl,
+            "named": name is not None,
+        }
+        return True
+    peer["last_seen"] = now
+    if name is None:
+        return False
+    peer["ttl"] = ttl
+    changed = not peer["named"] or peer["name"] != name
+    peer["name"] = name
+    peer["named"] = True
+    return changed
+
+
+def observe(src_mac: str) -> None:
+    """Aprendizaje pasivo: cualquier trama de src_mac prueba que está vivo."""
+    global _dirty
+    if src_mac == _my_mac or not _running:
+        return
+    now = time.time()
+    with _lock:
+        peer = _peers.get(src_mac)
+        if peer is not None:
+            peer["last_seen"] = now
+            return
+        _learn(src_mac, None, PEER_TTL, now)
+        _dirty = True
+    # peer nuevo sin nombre: si no se anuncia enseguida, preguntarle a él
+    threading.Timer(
+        2 * RESPONSE_DELAY_MAX, _query_if_unnamed, args=(src_mac,)
+    ).start()
+    _notify()
+
+
+def _query_if_unnamed(mac: str) -> None:
+    with _lock:
+        peer = _peers.get(mac)
+        if peer is None or peer["named"]:
+            return
+    query(mac)
+
+
+def _on_frame(src_mac: str, raw: bytes) -> None:
+    global _pending_announce, _dirty
+    if src_mac == _my_mac or not _running:
+        return
+    try:
+        info = parse_header(raw)
+    except Exception:
+        return
+    now = time.time()
+
+    if info["type"] == DISCOVER_RESP:
+        text = info["payload"].decode("utf-8", errors="replace")
+        name, _, ttl = text.rpartition("|")
+        try:
+            ttl = float(ttl)
+        except ValueError:
+            name, ttl = text, PEER_TTL
+        with _lock:
+            if ttl <= 0:
+                changed = _peers.pop(src_mac, None) is not None
+            else:
+                changed = _learn(src_mac, name, ttl, now)
+            _dirty = _dirty or changed
+        if changed:
+            print(f"[presence] {'BYE' if ttl <= 0 else 'PEER'} {src_mac} {name}")
+            _notify()
+
+    elif info["type"] == DISCOVER:
+        with _lock:
+            _last_query[BROADCAST_MAC] = now  # otra consulta ya está en el aire
+        known = info["payload"]
+        mine = _mac_bytes(_my_mac)
+        if any(known[i : i + 6] == mine for i in range(0, len(known) - 5, 6)):
+            return  # quien pregunta ya nos conoce
+        due = now + random.uniform(0, RESPONSE_DELAY_MAX)
+        due = max(due, _last_announce + ANNOUNCE_MIN_INTERVAL)
+        if _pending_announce is None or due < _pending_announce:
+            _pending_announce = due
+            _wake.set()
+
+
+# --- Hilo de mantenimiento ---------------------------------------------------
+
+
+def _expire(now: float) -> List[str]:
+    with _lock:
+        gone = [m for m, p in _peers.items() if now - p["last_seen"] > p["ttl"]]
+        for mac in gone:
+            del _peers[mac]
+    return gone
+
+
+def _loop() -> None:
+    global _dirty
+    next_sweep = 0.0
+    while _running:
+        now = time.time()
+        if _pending_announce is not None and now >= _pending_announce:
+            _announce()
+        elif now >= _next_beacon:
+            _announce()
+        if now >= next_sweep:
+            next_sweep = now + SWEEP_INTERVAL
+            gone = _expire(now)
+            if gone:
+                print(f"[presence] Expirados: {', '.join(gone)}")
+                _dirty = True
+                _notify()
+            if _dirty and now - _last_save >= CACHE_SAVE_INTERVAL:
+                _save_cache()
+
+        deadline = min(_next_beacon, next_sweep)
+        if _pending_announce is not None:
+            deadline = min(deadline, _pending_announce)
+        _wake.wait(max(0.0, deadline - time.time()))
+        _wake.clear()
+
+
+# --- Caché persistente -------------------------------------------------------
+
+
+def _load_cache() -> None:
+    """Arranque en caliente: peers vistos hace menos de su TTL."""
+    try:
+        with open(CACHE_PATH, "r", encoding="utf-8") as fh:
+            cached = json.load(fh)
+    except (OSError, ValueError):
+        return
+    now = time.time()
+    with _lock:
+        for mac, p in cached.items():
+            if mac == _my_mac or now - p["last_seen"] > p["ttl"]:
+                continue
+            _peers[mac] = {
+                "name": p["name"],
+                "last_seen": p["last_seen"],
+                "ttl": p["ttl"],
+                "named": True,
+            }
+    print(f"[presence] {len(_peers)} peers desde la caché")
+
+
+def _save_cache() -> None:
+    global _dirty, _last_save
+    with _lock:
+        data = {
+            mac: {"name": p["name"], "last_seen": p["last_seen"], "ttl": p["ttl"]}
+            for mac, p in _peers.items()
+            if p["named"]
+        }
+        _dirty = False
+    _last_save = time.time()
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        tmp = CACHE_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(data, fh)
+        os.replace(tmp, CACHE_PATH)
+    except OSError as e:
+        print(f"[presence] No se pudo guardar la caché: {e}")
+
+
+# --- API ---------------------------------------------------------------------
+
+
+def get_peers() -> Dict[str, Dict]:
+    """
+    Copia de los peers vivos: mac -> {"name", "last_seen", "ttl", "named"}.
+    named=False: visto pasivamente, todavía sin anuncio con su nombre.
+    """
+    with _lock:
+        return {mac: dict(p) for mac, p in _peers.items()}
+
+
+def start(
+    my_mac: str,
+    name: Optional[str] = None,
+    on_change: Optional[Callable[[Dict[str, Dict]], None]] = None,
+) -> None:
+    """
+    Arranca el servicio: carga la caché, se anuncia y hace una consulta
+    inicial tras un jitter (se omite si otro nodo consultó entretanto).
+    on_change(peers) se llama cuando entra, cambia o expira un peer.
+    """
+    global _my_mac, _my_name, _on_change, _running, _thread, _registered
+    global _next_beacon, _pending_announce
+    if _running:
+        return
+    _my_mac = my_mac.lower()
+    _my_name = (name or local_name()).replace("|", "_")
+    _on_change = on_change
+    _load_cache()
+
+    if not _registered:
+        register_channel_callback(DISCOVERY_CHANNEL, _on_frame)
+        register_frame_observer(observe)
+        _registered = True
+    start_recv_loop(lambda src, payload: None)  # El routing se hace por canales
+
+    _running = True
+    _pending_announce = time.time() + random.uniform(0, RESPONSE_DELAY_MAX)
+    _next_beacon = _pending_announce
+    _thread = threading.Thread(target=_loop, daemon=True)
+    _thread.start()
+    threading.Timer(random.uniform(0, RESPONSE_DELAY_MAX), query).start()
+    if _peers:
+        _notify()
+
+
+def stop() -> None:
+    """Se despide (ttl=0) para que los demás lo quiten ya, y guarda la caché."""
+    global _running
+    if not _running:
+        return
+    _running = False
+    _wake.set()
+    _announce(ttl=0)
+    flush_tx()
+    _save_cache()
@@ -10,12 +10,44 @@ FILE_END = 0x04
 ACK = 0x05
 DISCOVER = 0x06
 DISCOVER_RESP = 0x07
+NACK = 0x08
+FILE_POLL = 0x09
+HASH_REQ = 0x0A
+HASH_RESP = 0x0B
+GROUP_MSG = 0x0C
+GROUP_RECEIPT = 0x0D
+GROUP_INFO = 0x0E
+FILE_REJECT = 0x0F  # el receptor rechaza un FILE_START (payload: motivo)
 
 # Canales para routing
 CHAT_CHANNEL = 0x01
 FILE_CHANNEL = 0x02
 DISCOVERY_CHANNEL = 0x03
 
+# nombres para logs y métricas
+TYPE_NAMES = {
+    MSG: "msg",
+    FILE_START: "file_start",
+    FILE_CHUNK: "file_chunk",
+    FILE_END: "file_end",
+    ACK: "ack",
+    DISCOVER: "discover",
+    DISCOVER_RESP: "discover_resp",
+    NACK: "nack",
+    FILE_POLL: "file_poll",
+    HASH_REQ: "hash_req",
+    HASH_RESP: "hash_resp",
+    GROUP_MSG: "group_msg",
+    GROUP_RECEIPT: "group_receipt",
+    GROUP_INFO: "group_info",
+    FILE_REJECT: "file_reject",
+}
+CHANNEL_NAMES = {
+    CHAT_CHANNEL: "chat",
+    FILE_CHANNEL: "file",
+    DISCOVERY_CHANNEL: "discovery",
+}
+
 VERSION = 1
 HEADER_LEN = 25  # 1 + 1 + 1 + 4 + 16 + 2
 
@@ -89,3 +121,28 @@ def parse_header(data: bytes) -> dict:
         "payload_len": payload_len,
         "payload": payload,
     }
+
+
+RANGE_LEN = 8  # start(4) + end(4)
+
+
+def pack_ranges(ranges, max_len: int = 0xFFFF) -> bytes:
+    """
+    Codifica una lista de rangos inclusivos [(start, end), ...] de seqs
+    como pares uint32. Si no caben en max_len bytes se truncan (el resto
+    se pedirá en la siguiente ronda).
+    """
+    out = bytearray()
+    for start, end in ranges:
+        if len(out) + RANGE_LEN > max_len:
+            break
+        out += struct.pack("!II", start, end)
+    return bytes(out)
+
+
+def unpack_ranges(payload: bytes) -> list:
+    """Inverso de pack_ranges: devuelve [(start, end), ...]."""
+    n = len(payload) // RANGE_LEN
+    return [
+        struct.unpack_from("!II", payload, i * RANGE_LEN) for i in range(n)
+    ]
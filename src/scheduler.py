@@ -0,0 +1,320 @@
+# src/scheduler.py
+"""
+Planificador de transmisión: todas las tramas salen por un único hilo que
+elige la siguiente según su clase.
+  - CONTROL: ACK, NACK, hashes, discovery, rechazo de archivo, acuses y
+    altas de grupo (respuestas que no dependen del orden)
+  - CHAT:    MSG y GROUP_MSG
+  - BULK:    FILE_START, FILE_CHUNK, FILE_END y FILE_POLL
+Prioridad estricta CONTROL > CHAT > BULK. Todas las tramas de una
+transferencia van en su flujo BULK (destino + file_id), en orden: un
+FILE_END o FILE_POLL no adelanta a los chunks aún encolados. Entre los
+flujos se reparte con Deficit Round Robin ponderado (set_weight), así dos
+envíos simultáneos avanzan a la par salvo que uno pida más peso.
+Opcionalmente se limita el caudal con token buckets (global y por peer):
+el límite frena solo a BULK; CONTROL y CHAT consumen tokens pero no
+esperan, para que el chat no pierda latencia.
+"""
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from protocol import (
+    ACK,
+    DISCOVER,
+    DISCOVER_RESP,
+    FILE_CHUNK,
+    FILE_END,
+    FILE_POLL,
+    FILE_REJECT,
+    FILE_START,
+    GROUP_INFO,
+    GROUP_RECEIPT,
+    HASH_REQ,
+    HASH_RESP,
+    HEADER_LEN,
+    NACK,
+)
+
+CONTROL = 0
+CHAT = 1
+BULK = 2
+
+_CONTROL_TYPES = frozenset(
+    (
+        ACK,
+        NACK,
+        HASH_REQ,
+        HASH_RESP,
+        DISCOVER,
+        DISCOVER_RESP,
+        FILE_REJECT,
+        GROUP_RECEIPT,
+        GROUP_INFO,
+    )
+)
+# tramas del emisor de una transferencia: comparten flujo con sus chunks
+_FLOW_TYPES = frozenset((FILE_START, FILE_CHUNK, FILE_END, FILE_POLL))
+_ID_SLICE = slice(7, 23)  # posición del file_id en el header
+
+QUANTUM = 1514  # bytes por ronda DRR con peso 1 (una trama completa)
+BULK_QUEUE_MAX = 64  # tramas encoladas por flujo antes de bloquear al emisor
+FLOW_IDLE_FORGET = 60.0  # s tras los que se olvida el peso de un flujo
+
+Item = Tuple[str, bytes, int]  # (dest_mac, payload, eth_type)
+
+
+def classify(payload: bytes) -> int:
+    """Clase de una trama mirando solo el byte de tipo del header."""
+    if len(payload) < HEADER_LEN:
+        return CHAT
+    msg_type = payload[1]
+    if msg_type in _FLOW_TYPES:
+        return BULK
+    if msg_type in _CONTROL_TYPES:
+        return CONTROL
+    return CHAT
+
+
+class TokenBucket:
+    """rate en bytes/s; burst en bytes (por defecto ~50 ms de caudal)."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(self.rate * 0.05, 2 * QUANTUM))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, n: int, now: float) -> float:
+        """Segundos hasta poder enviar n bytes (0 si ya se puede)."""
+        self._refill(now)
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def charge(self, n: int) -> None:
+        # puede quedar en negativo: CONTROL y CHAT no esperan
+        self.tokens -= n
+
+
+class TxScheduler:
+    """
+    send_fn(dest_mac, payload, eth_type) hace el envío real; se llama solo
+    desde el hilo del planificador. rate / peer_rate en bytes/s (0 = sin
+    límite).
+    """
+
+    def __init__(
+        self,
+        send_fn: Callable[[str, bytes, int], None],
+        rate: float = 0,
+        peer_rate: float = 0,
+        quantum: int = QUANTUM,
+    ):
+        self._send = send_fn
+        self.quantum = quantum
+        self._bucket = TokenBucket(rate) if rate > 0 else None
+        self.peer_rate = peer_rate
+        self._peer_buckets: Dict[str, TokenBucket] = {}
+
+        self._queues: Dict[int, Deque[Item]] = {CONTROL: deque(), CHAT: deque()}
+        # (dest, file_id) -> {"queue", "deficit", "granted"}
+        self._flows: Dict[Tuple[str, bytes], Dict] = {}
+        self._active: Deque[Tuple[str, bytes]] = deque()
+        # pesos explícitos: file_id -> (peso, último uso)
+        self._weights: "OrderedDict[bytes, Tuple[float, float]]" = OrderedDict()
+
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._stats = {CONTROL: 0, CHAT: 0, BULK: 0}
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    # --- API -----------------------------------------------------------------
+
+    def submit(self, dest_mac: str, payload: bytes, eth_type: int) -> None:
+        """
+        Encola una trama. Para BULK bloquea mientras el flujo tenga
+        BULK_QUEUE_MAX tramas pendientes (contrapresión al emisor).
+        """
+        cls = classify(payload)
+        item = (dest_mac, payload, eth_type)
+        with self._cond:
+            if cls == BULK:
+                key = (dest_mac, bytes(payload[_ID_SLICE]))
+                while True:
+                    # se busca otra vez tras cada espera: el hilo pudo vaciar
+                    # el flujo y borrarlo mientras tanto
+                    flow = self._flows.get(key)
+                    if flow is None:
+                        flow = {"queue": deque(), "deficit": 0, "granted": False}
+                        self._flows[key] = flow
+                    if len(flow["queue"]) < BULK_QUEUE_MAX:
+                        break
+                    self._cond.wait()
+                if not flow["queue"]:
+                    self._active.append(key)
+                flow["queue"].append(item)
+            else:
+                self._queues[cls].append(item)
+            self._pending += 1
+            self._cond.notify_all()
+
+    def set_weight(self, file_id: bytes, weight: float) -> None:
+        """Peso DRR de una transferencia (1 por defecto; 2 = el doble de caudal)."""
+        with self._cond:
+            self._weights[file_id] = (max(weight, 0.01), time.monotonic())
+            self._weights.move_to_end(file_id)
+
+    def flush(self, timeout: float = 2.0) -> bool:
+        """Espera a que se vacíen las colas. False si venció el timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "control": self._stats[CONTROL],
+                "chat": self._stats[CHAT],
+                "bulk": self._stats[BULK],
+                "pending": self._pending,
+                "flows": len(self._active),
+            }
+
+    # --- Selección -----------------------------------------------------------
+
+    def _peer_bucket(self, dest_mac: str) -> Optional[TokenBucket]:
+        if self.peer_rate <= 0:
+            return None
+        bucket = self._peer_buckets.get(dest_mac)
+        if bucket is None:
+            bucket = self._peer_buckets[dest_mac] = TokenBucket(self.peer_rate)
+        return bucket
+
+    def _rate_wait(self, dest_mac: str, size: int, now: float) -> float:
+        wait = 0.0
+        if self._bucket is not None:
+            wait = self._bucket.wait_time(size, now)
+        bucket = self._peer_bucket(dest_mac)
+        if bucket is not None:
+            wait = max(wait, bucket.wait_time(size, now))
+        return wait
+
+    def _weight(self, file_id: bytes) -> float:
+        entry = self._weights.get(file_id)
+        return entry[0] if entry else 1.0
+
+    def _next_bulk(self, now: float) -> Tuple[Optional[Item], float]:
+        """
+        Siguiente trama BULK según DRR, saltando los flujos frenados por su
+        token bucket. Devuelve (item, 0) o (None, segundos de espera).
+        """
+        min_wait = float("inf")
+        skipped = 0
+        while self._active and skipped < len(self._active):
+            key = self._active[0]
+            flow = self._flows.get(key)
+            if flow is None or not flow["queue"]:
+                # no debería pasar; se descarta la entrada en vez de morir
+                self._active.popleft()
+                self._flows.pop(key, None)
+                continue
+            item = flow["queue"][0]
+            size = len(item[1])
+            wait = self._rate_wait(key[0], size, now)
+            if wait > 0:
+                # frenado por caudal: cede el turno sin perder su déficit
+                min_wait = min(min_wait, wait)
+                self._active.rotate(-1)
+                skipped += 1
+                continue
+            if flow["deficit"] < size:
+                if not flow["granted"]:
+                    flow["deficit"] += self.quantum * self._weight(key[1])
+                    flow["granted"] = True
+                    continue
+                # turno agotado: al final de la ronda
+                flow["granted"] = False
+                self._active.rotate(-1)
+                continue
+            flow["deficit"] -= size
+            flow["queue"].popleft()
+            if not flow["queue"]:
+                self._active.popleft()
+                del self._flows[key]
+            return item, 0.0
+        return None, min_wait
+
+    def _pick(self) -> Tuple[Optional[Item], int, float]:
+        for cls in (CONTROL, CHAT):
+            if self._queues[cls]:
+                return self._queues[cls].popleft(), cls, 0.0
+        item, wait = self._next_bulk(time.monotonic())
+        return item, BULK, wait
+
+    def _forget_weights(self, now: float) -> None:
+        while self._weights:
+            fid, (_, used) = next(iter(self._weights.items()))
+            if now - used < FLOW_IDLE_FORGET:
+                break
+            if any(key[1] == fid for key in self._active):
+                self._weights.move_to_end(fid)
+                self._weights[fid] = (self._weights[fid][0], now)
+                continue
+            self._weights.popitem(last=False)
+
+    # --- Hilo ----------------------------------------------------------------
+
+    def _loop(self) -> None:
+        """Un error no puede matar el hilo: se registra y se sigue enviando."""
+        while True:
+            try:
+                self._run()
+            except Exception:
+                traceback.print_exc()
+                print("[scheduler] error interno, el hilo sigue")
+                with self._cond:
+                    # lo que estaba en curso se perdió: recontar lo encolado
+                    self._pending = (
+                        len(self._queues[CONTROL])
+                        + len(self._queues[CHAT])
+                        + sum(len(f["queue"]) for f in self._flows.values())
+                    )
+                    self._cond.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    item, cls, wait = self._pick()
+                    if item is not None:
+                        break
+                    # nada listo: esperar una trama nueva o a que haya tokens
+                    self._cond.wait(None if wait == float("inf") else wait)
+                size = len(item[1])
+                if self._bucket is not None:
+                    self._bucket.charge(size)
+                bucket = self._peer_bucket(item[0])
+                if bucket is not None:
+                    bucket.charge(size)
+                self._stats[cls] += 1
+                self._forget_weights(time.monotonic())
+            try:
+                self._send(*item)
+            except Exception as e:
+                print(f"[scheduler] error enviando a {item[0]}: {e}")
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
@@ -0,0 +1,154 @@
+# src/transfers.py
+"""
+Registro de transferencias de archivos (emisor y receptor).
+Cada transferencia se identifica por su file_id (16 bytes) y acumula
+bytes enviados/confirmados, retransmisiones, RTT y throughput.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import metrics
+
+RECENT_MAX = 100  # transferencias terminadas que se conservan para consulta
+SAMPLE_INTERVAL = 0.5  # ventana (s) para el throughput instantáneo
+RATE_ALPHA = 0.3  # suavizado EWMA del throughput instantáneo
+RTT_ALPHA = 0.125  # suavizado del RTT (como SRTT de TCP)
+
+_active: Dict[bytes, Dict] = {}
+_recent: "OrderedDict[bytes, Dict]" = OrderedDict()
+_lock = threading.Lock()
+
+_IN_PROGRESS = metrics.gauge(
+    "linkchat_transfers_in_progress", "Transferencias en curso", ("direction",)
+)
+_FINISHED = metrics.counter(
+    "linkchat_transfers_total",
+    "Transferencias terminadas por resultado",
+    ("direction", "status"),
+)
+_RETRANSMITS = metrics.counter(
+    "linkchat_retransmits_total", "Tramas reenviadas", ("layer",)
+).labels("file")
+
+
+def _count_active(direction: str) -> int:
+    with _lock:
+        return sum(1 for t in _active.values() if t["direction"] == direction)
+
+
+for _direction in ("send", "recv"):
+    _IN_PROGRESS.labels(_direction).set_function(
+        lambda d=_direction: _count_active(d)
+    )
+
+
+def start(file_id: bytes, direction: str, peer: str, name: str, total: int) -> None:
+    """direction: 'send' o 'recv'. total: tamaño esperado en bytes (0 = desconocido)."""
+    now = time.time()
+    with _lock:
+        _active[file_id] = {
+            "file_id": file_id.hex(),
+            "direction": direction,
+            "peer": peer,
+            "name": name,
+            "total": total,
+            "bytes_sent": 0,
+            "bytes_acked": 0,
+            "retransmits": 0,
+            "rtt": None,
+            "srtt": None,
+            "rate": 0.0,
+            "status": "running",
+            "started_at": now,
+            "updated_at": now,
+            "finished_at": None,
+            "_sample_t": now,
+            "_sample_bytes": 0,
+        }
+
+
+def _update_rate(t: Dict, now: float) -> None:
+    dt = now - t["_sample_t"]
+    if dt < SAMPLE_INTERVAL:
+        return
+    sample = (t["bytes_acked"] - t["_sample_bytes"]) / dt
+    if t["rate"]:
+        t["rate"] = RATE_ALPHA * sample + (1 - RATE_ALPHA) * t["rate"]
+    else:
+        t["rate"] = sample
+    t["_sample_t"] = now
+    t["_sample_bytes"] = t["bytes_acked"]
+
+
+def on_sent(file_id: bytes, nbytes: int, retransmit: bool = False) -> None:
+    if retransmit:
+        _RETRANSMITS.inc()
+    with _lock:
+        t = _active.get(file_id)
+        if t is None:
+            return
+        t["bytes_sent"] += nbytes
+        if retransmit:
+            t["retransmits"] += 1
+        t["updated_at"] = time.time()
+
+
+def on_acked(file_id: bytes, nbytes: int, rtt: Optional[float] = None) -> None:
+    """Bytes confirmados por el receptor (o escritos, en el lado receptor)."""
+    now = time.time()
+    with _lock:
+        t = _active.get(file_id)
+        if t is None:
+            return
+        t["bytes_acked"] += nbytes
+        if rtt is not None:
+            t["rtt"] = rtt
+            if t["srtt"] is None:
+                t["srtt"] = rtt
+            else:
+                t["srtt"] = RTT_ALPHA * rtt + (1 - RTT_ALPHA) * t["srtt"]
+        t["updated_at"] = now
+        _update_rate(t, now)
+
+
+def finish(file_id: bytes, status: str) -> None:
+    with _lock:
+        t = _active.pop(file_id, None)
+        if t is None:
+            return
+        t["status"] = status
+        t["finished_at"] = time.time()
+        _FINISHED.labels(t["direction"], status).inc()
+        _recent[file_id] = t
+        while len(_recent) > RECENT_MAX:
+            _recent.popitem(last=False)
+
+
+def _public(t: Dict) -> Dict:
+    """Copia sin campos internos y con los valores derivados calculados."""
+    out = {k: v for k, v in t.items() if not k.startswith("_")}
+    end = t["finished_at"] or time.time()
+    elapsed = max(end - t["started_at"], 1e-6)
+    out["elapsed"] = elapsed
+    out["avg_rate"] = t["bytes_acked"] / elapsed
+    out["eta"] = None
+    if t["status"] == "running" and t["total"]:
+        rate = t["rate"] or out["avg_rate"]
+        if rate > 0:
+            out["eta"] = max(t["total"] - t["bytes_acked"], 0) / rate
+    return out
+
+
+def get(file_id: bytes) -> Optional[Dict]:
+    with _lock:
+        t = _active.get(file_id) or _recent.get(file_id)
+        return _public(t) if t else None
+
+
+def snapshot() -> List[Dict]:
+    """Transferencias activas seguidas de las terminadas recientemente."""
+    with _lock:
+        items = list(_active.values()) + list(reversed(_recent.values()))
+        return [_public(t) for t in items]
@@ -0,0 +1,53 @@
+# tests/test_merkle.py
+"""
+Veredicto de la verificación Merkle (archivos de MERKLE_MIN_SIZE o más)
+sobre el enlace simulado: si el ACK/NACK con seq = seq de FILE_END se
+pierde, el emisor repite FILE_END y el receptor lo reenvía.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from linksim import Link, Node, mac_for  # noqa: E402  (agrega src/ al path)
+
+import protocol  # noqa: E402
+
+
+def test_lost_verdict_is_resent(tmp_path, monkeypatch):
+    monkeypatch.setenv("RECV_DIR", str(tmp_path / "recv"))
+    dropped = []
+    link = Link()
+    a, b = Node(link, mac_for(1)), Node(link, mac_for(2))
+    fa, fb = a.load("files"), b.load("files")
+    src = tmp_path / "grande.bin"
+    src.write_bytes(os.urandom(fa.MERKLE_MIN_SIZE))
+    end_seq = -(-fa.MERKLE_MIN_SIZE // fa.CHUNK_SIZE) + 1
+
+    def drop(payload: bytes) -> bool:
+        # solo el primer veredicto (ACK seq=end_seq del receptor)
+        if dropped or payload[1] != protocol.ACK:
+            return False
+        if int.from_bytes(payload[3:7], "big") != end_seq:
+            return False
+        dropped.append(payload)
+        return True
+
+    link.drop = drop
+    events = []
+    fb.start_file_loop(lambda s, path, status: events.append(status), b.mac)
+    fa.start_file_loop(lambda s, path, status: None, a.mac)
+    try:
+        started = time.time()
+        fid = fa.send_file(b.mac, str(src), timeout=0.2)
+        elapsed = time.time() - started
+    finally:
+        fa.stop_file_loop()
+        fb.stop_file_loop()
+
+    assert fid and dropped
+    # sin el reenvío el emisor esperaría MERKLE_VERIFY_TIMEOUT ("unverified")
+    assert elapsed < fa.MERKLE_VERIFY_TIMEOUT / 3
+    assert events.count("finished") == 1
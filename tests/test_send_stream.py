@@ -0,0 +1,108 @@
+# tests/test_send_stream.py
+"""
+Envíos de tamaño desconocido (/upload_file sin size, archivos grandes de
+send_folder_stream) sobre el enlace simulado de bench/linksim.py: el
+FILE_END es lo único que cierra la recepción y debe sobrevivir a una
+pérdida.
+"""
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+sys.path.insert(0, os.path.join(ROOT, "web"))
+
+from linksim import Link, Node, mac_for  # noqa: E402  (agrega src/ al path)
+
+import protocol  # noqa: E402
+from uploads import UploadPipe  # noqa: E402
+
+
+def _drop_first(typ, seq=None):
+    """Predicado de Link.drop que descarta solo la primera trama `typ`."""
+    dropped = []
+
+    def drop(payload: bytes) -> bool:
+        if dropped or payload[1] != typ:
+            return False
+        if seq is not None and int.from_bytes(payload[3:7], "big") != seq:
+            return False
+        dropped.append(payload)
+        return True
+
+    drop.dropped = dropped
+    return drop
+
+
+@pytest.fixture
+def pair(tmp_path, monkeypatch):
+    """Devuelve una función que arma emisor y receptor sobre un enlace."""
+    monkeypatch.setenv("RECV_DIR", str(tmp_path / "recv"))
+    loaded = []
+
+    def make(drop):
+        link = Link(drop=drop)
+        a, b = Node(link, mac_for(1)), Node(link, mac_for(2))
+        fa, fb = a.load("files"), b.load("files")
+        events = []
+        fb.start_file_loop(lambda src, path, st: events.append((path, st)), b.mac)
+        fa.start_file_loop(lambda src, path, status: None, a.mac)
+        loaded.extend((fa, fb))
+        return fa, b.mac, events
+
+    yield make
+    for files in loaded:
+        files.stop_file_loop()
+
+
+def _finished(events):
+    return [path for path, status in events if status == "finished"]
+
+
+def _wait(cond, timeout=5.0):
+    deadline = time.time() + timeout
+    while not cond() and time.time() < deadline:
+        time.sleep(0.01)
+    return cond()
+
+
+def test_file_end_lost_upload_pipe(pair):
+    """Como /upload_file sin tamaño: el FILE_END perdido se reintenta."""
+    drop = _drop_first(protocol.FILE_END)
+    files, dest, events = pair(drop)
+    data = os.urandom(50_000)
+    pipe = UploadPipe()
+
+    def upload():
+        for i in range(0, len(data), 8192):
+            pipe.write(data[i : i + 8192])
+        pipe.finish()
+
+    threading.Thread(target=upload).start()
+    files.send_stream(dest, pipe, "subida.bin", 0, timeout=0.2)
+
+    assert drop.dropped
+    assert _wait(lambda: _finished(events))
+    (path,) = _finished(events)
+    with open(path, "rb") as fh:
+        assert fh.read() == data
+
+
+def test_file_end_ack_lost(pair):
+    """Si se pierde el ACK del FILE_END, el repetido se confirma sin duplicar."""
+    data = os.urandom(10_000)
+    end_seq = -(-len(data) // 1400) + 1
+    drop = _drop_first(protocol.ACK, seq=end_seq)
+    files, dest, events = pair(drop)
+    files.send_stream(dest, io.BytesIO(data), "doble.bin", 0, timeout=0.2)
+
+    assert drop.dropped
+    time.sleep(0.3)
+    assert len(_finished(events)) == 1
+    with open(_finished(events)[0], "rb") as fh:
+        assert fh.read() == data
@@ -1,6 +1,8 @@
 import tempfile
 from flask import (
     Flask,
+    Response,
+    g,
     render_template,
     request,
     redirect,
@@ -9,14 +11,20 @@ from flask import (
     jsonify,
     send_file,
 )
-from datetime import datetime
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 import threading
+import itertools
+import mimetypes
 import uuid
 import os
 import sys
 import time
 from network_manager import NetworkManager
+from jobs import QueueFull
+from events import TooManyClients
+from urllib.parse import quote
+from uploads import READ_SIZE, FolderPipe, MultipartStream, UploadPipe
 import secrets
 
 # 🔹 Agregar src al path
@@ -61,6 +69,7 @@ def create_app():
 
 
 from ethernet import get_interface_mac, INTERFACE
+import metrics
 
 app = create_app()
 
@@ -93,8 +102,41 @@ for folder in ["send_files", "recv_files"]:
 
 app.config["MAX_CONTENT_LENGTH"] = 10000 * 1024 * 1024
 
+# Descargas delegadas al proxy inverso (ver _file_response):
+#   LINKCHAT_ACCEL_REDIRECT=/prefijo/ -> nginx sirve BASE_DIR en ese prefijo
+#   LINKCHAT_X_SENDFILE=1 -> Apache / lighttpd con X-Sendfile
+ACCEL_REDIRECT = os.getenv("LINKCHAT_ACCEL_REDIRECT", "")
+app.config["USE_X_SENDFILE"] = os.getenv("LINKCHAT_X_SENDFILE", "0") == "1"
+SENDFILE_BLOCK = 1024 * 1024
+
 network_manager = NetworkManager(RECV_DIR)
-chat_messages = network_manager.chat_messages
+
+# latencia por endpoint: hasta que la respuesta sale de la vista (en los
+# streams SSE y descargas grandes no incluye el envío del cuerpo)
+HTTP_SECONDS = metrics.histogram(
+    "linkchat_http_request_seconds",
+    "Duración de las peticiones HTTP por endpoint",
+    ("endpoint", "method", "status"),
+)
+
+
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def _observe_latency(response):
+    started = g.pop("started", None)
+    if started is not None:
+        rule = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_SECONDS.labels(rule, request.method, response.status_code).observe(
+            time.perf_counter() - started
+        )
+    return response
+
+
+chat_store = network_manager.store
 
 no_login = False
 
@@ -185,22 +227,145 @@ def chat():
     )
 
 
+@app.route("/events")
+def events():
+    """
+    Flujo Server-Sent Events: "chat" {chat, rev} cuando cambia un chat,
+    "peers" cuando cambia la lista de usuarios y "reset" si el cliente
+    perdió eventos. Reanuda desde Last-Event-ID tras una reconexión.
+    Cada flujo ocupa un hilo del servidor: pasado el límite de EventHub
+    responde 503 y el navegador se queda con el polling.
+    """
+    last_id = request.headers.get("Last-Event-ID", type=int)
+    try:
+        stream = network_manager.events.stream(last_id)
+    except TooManyClients as e:
+        return Response(str(e), status=503, headers={"Retry-After": "30"})
+    return Response(
+        stream,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/get_users")
 def get_users():
+    """Lista de peers; con If-None-Match responde 304 si no cambió."""
     users = network_manager.get_peers_for_flask()
-    print(f"[API] get_users - Retornando {len(users)} usuarios", flush=True)
-    return jsonify(users)
+    response = jsonify(users)
+    response.add_etag()
+    response.headers["Cache-Control"] = "no-cache"
+    response = response.make_conditional(request)
+    if response.status_code != 304:
+        print(f"[API] get_users - Retornando {len(users)} usuarios", flush=True)
+    return response
+
+
+BACKFILL_MAX = 500  # mensajes máximos por página de historial
+
+
+def _messages_response(chat_id: str):
+    """
+    Historial de un chat con sincronización incremental:
+      ?after=<cursor>         solo lo nuevo o modificado desde el cursor
+      ?before=<seq>&limit=N   página de mensajes anteriores (backfill)
+      sin parámetros          la ventana reciente
+    Devuelve {"messages", "cursor", "more", "has_older"}; con If-None-Match
+    responde 304 si el chat no cambió (el ETag es el rev del chat).
+    """
+    args = request.args
+    limit = max(1, min(args.get("limit", 50, type=int), BACKFILL_MAX))
+    if "before" in args:
+        page = chat_store.history(
+            chat_id, before=args.get("before", type=int), limit=limit
+        )
+        return jsonify({"messages": page, "has_older": len(page) == limit})
+
+    etag = f"{chat_id}-{chat_store.chat_rev(chat_id)}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    after = args.get("after", type=int)
+    if after is None:
+        cursor = chat_store.chat_rev(chat_id)
+        messages = chat_store.recent(chat_id)
+        more = False
+        has_older = len(messages) >= chat_store.hot_size
+    else:
+        messages, cursor, more = chat_store.changes(chat_id, after)
+        has_older = None
+    print(f"[API] get_messages - Chat {chat_id}: {len(messages)} mensajes", flush=True)
+    response = jsonify(
+        {
+            "messages": messages,
+            "cursor": cursor,
+            "more": more,
+            "has_older": has_older,
+        }
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    if not more:  # una respuesta parcial no representa el estado del chat
+        response.set_etag(etag)
+    return response
+
+
+@app.route("/search")
+def search_messages():
+    """
+    Búsqueda de texto completo en el historial (mensajes y nombres de
+    archivo), del más nuevo al más viejo:
+      ?q=palabras             todas deben aparecer; la última como prefijo
+      ?peer=<mac> | ?group=<gid>  limita a un chat
+      ?sender=<mac>           solo lo enviado por esa MAC
+      ?since=<ts>&until=<ts>  rango de tiempo (unix, segundos)
+      ?before=<seq>&limit=N   página siguiente
+    Devuelve {"results", "next_before", "took_ms"}.
+    """
+    my_mac = session.get("mac")
+    if not my_mac:
+        return jsonify({"error": "Sesión no válida"}), 401
+    args = request.args
+    query = args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "q requerido"}), 400
+
+    chat_id = None
+    if args.get("peer"):
+        chat_id = "-".join(sorted([my_mac, args["peer"]]))
+    elif args.get("group"):
+        chat_id = f"group:{args['group']}"
+    limit = max(1, args.get("limit", 50, type=int))
+
+    started = time.perf_counter()
+    results = chat_store.search(
+        query,
+        chat_id=chat_id,
+        sender=args.get("sender") or None,
+        since=args.get("since", type=float),
+        until=args.get("until", type=float),
+        before=args.get("before", type=int),
+        limit=limit,
+    )
+    took_ms = round((time.perf_counter() - started) * 1000, 2)
+    print(f"[API] search {query!r}: {len(results)} resultados en {took_ms} ms")
+    return jsonify(
+        {
+            "results": results,
+            "next_before": results[-1]["seq"] if len(results) >= limit else None,
+            "took_ms": took_ms,
+        }
+    )
 
 
 @app.route("/get_messages/<other_mac>")
 def get_messages(other_mac):
     my_mac = session.get("mac")
     if not my_mac:
-        return jsonify([])
+        return jsonify({"messages": [], "cursor": 0, "more": False})
     chat_id = "-".join(sorted([my_mac, other_mac]))
-    messages = chat_messages.get(chat_id, [])
-    print(f"[API] get_messages - Chat {chat_id}: {len(messages)} mensajes", flush=True)
-    return jsonify(messages)
+    return _messages_response(chat_id)
 
 
 @app.route("/send_message", methods=["POST"])
@@ -222,15 +387,7 @@ def send_message():
     try:
         network_manager.send_chat_message(other_mac, message_text)
         chat_id = "-".join(sorted([my_mac, other_mac]))
-        if chat_id not in chat_messages:
-            chat_messages[chat_id] = []
-        new_message = {
-            "id": str(uuid.uuid4()),
-            "sender": my_mac,
-            "text": message_text,
-            "timestamp": datetime.now().strftime("%H:%M"),
-        }
-        chat_messages[chat_id].append(new_message)
+        chat_store.add(chat_id, my_mac, message_text)
         print("[API] ✅ Mensaje enviado correctamente", flush=True)
         return jsonify({"success": True})
     except Exception as e:
@@ -244,9 +401,14 @@ def send_message():
 @app.route("/upload_file", methods=["POST"])
 def upload_file():
     """
-    Endpoint CORREGIDO para recibir y enviar archivos.
-    Recibe el archivo real vía FormData, lo guarda temporalmente,
-    lo envía por red y luego lo elimina.
+    Recibe un archivo del navegador y lo envía mientras llega, sin guardarlo
+    antes en SEND_DIR: el cuerpo entra en un UploadPipe que lee el trabajo
+    de envío (ver /jobs). Si el peer va más lento que la subida, el exceso
+    se vuelca a disco y la respuesta sale igual al terminar de subir.
+    Formatos:
+      - cuerpo crudo con ?other_mac=...&filename=...; el tamaño que se
+        anuncia en FILE_START es el Content-Length
+      - multipart con other_mac (y opcionalmente size) antes del archivo
     """
     my_mac = session.get("mac")
 
@@ -254,17 +416,33 @@ def upload_file():
     if not my_mac:
         return jsonify({"success": False, "error": "Sesión no válida"}), 401
 
-    # Obtener datos del formulario
-    other_mac = request.form.get("other_mac")
-
-    # Verificar que el archivo esté en la petición
-    if "file" not in request.files:
-        return jsonify({"success": False, "error": "No se encontró el archivo"}), 400
-
-    file = request.files["file"]
+    if request.mimetype == "multipart/form-data":
+        try:
+            form = MultipartStream(request.stream, request.content_type)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        source = next(form.parts(), None)
+        if source is None:
+            return jsonify(
+                {"success": False, "error": "No se encontró el archivo"}
+            ), 400
+        other_mac = request.args.get("other_mac") or form.fields.get("other_mac")
+        raw_name = source.filename or ""
+        try:
+            file_size = int(form.fields.get("size") or 0)
+        except ValueError:
+            file_size = 0
+    else:
+        source = request.stream
+        other_mac = request.args.get("other_mac")
+        raw_name = request.args.get("filename") or request.headers.get(
+            "X-Filename", ""
+        )
+        file_size = request.content_length or 0
 
     # Verificar que se seleccionó un archivo
-    if file.filename == "":
+    filename = secure_filename(raw_name)
+    if not filename:
         return jsonify(
             {"success": False, "error": "No se seleccionó ningún archivo"}
         ), 400
@@ -275,115 +453,154 @@ def upload_file():
             {"success": False, "error": "MAC de destino no especificada"}
         ), 400
 
-    try:
-        # Guardar archivo temporalmente con nombre seguro
-        filename = secure_filename(file.filename)
-        # Guardar archivo en la carpeta de enviados
-        file_id = str(uuid.uuid4())
-        save_path = os.path.join(SEND_DIR, f"{file_id}_{filename}")
-        file.save(save_path)
-        print(f"[send_file] 📤 Archivo guardado en enviados: {save_path}", flush=True)
-
-        # Verificar que el archivo se guardó correctamente
-        if not os.path.exists(save_path):
-            return jsonify(
-                {"success": False, "error": "Error al guardar archivo temporal"}
-            ), 500
+    # Referencia en el historial del chat; su status sigue al del trabajo
+    # (queued -> sending -> sent / failed / cancelled). No queda copia local.
+    chat_id = "-".join(sorted([my_mac, other_mac]))
+    message = chat_store.add(
+        chat_id,
+        my_mac,
+        f"[ARCHIVO]{filename}",
+        kind="file",
+        filename=filename,
+        file_path=None,
+        size=file_size,
+        status="queued",
+    )
 
-        file_size = os.path.getsize(save_path)
-        print(
-            f"[send_file] Archivo guardado: {filename} ({file_size} bytes)", flush=True
+    pipe = UploadPipe(SEND_DIR)
+    print(
+        f"[send_file] Encolando envío en flujo a {other_mac}: "
+        f"{filename} ({file_size or '?'} bytes)",
+        flush=True,
+    )
+    try:
+        job = network_manager.submit_job(
+            "file",
+            lambda cancel: network_manager.send_stream(
+                other_mac, pipe, filename, file_size, cancel_event=cancel
+            ),
+            dest=other_mac,
+            name=filename,
+            message_id=message["id"],
+            cleanup=pipe.close,
         )
+    except QueueFull as e:
+        chat_store.update(message["id"], status="failed")
+        return jsonify({"success": False, "error": f"Cola llena: {e}"}), 503
+
+    # El trabajo ya puede estar leyendo del tubo mientras sigue la subida
+    try:
+        for block in iter(lambda: source.read(READ_SIZE), b""):
+            pipe.write(block)
+    except BrokenPipeError:
+        status = (network_manager.jobs.get(job["id"]) or {}).get("status")
+        print(f"[send_file] ⚠️ Envío terminado antes de la subida: {status}")
+        return jsonify(
+            {"success": False, "error": f"envío {status}", "job_id": job["id"]}
+        ), 409
+    except Exception as e:
+        pipe.abort(IOError(f"subida interrumpida: {e}"))
+        print(f"[send_file] ❌ Error recibiendo la subida: {e}", flush=True)
+        return jsonify({"success": False, "error": str(e)}), 500
 
-        # Enviar archivo por red
-        print(f"[send_file] Enviando archivo a {other_mac}...", flush=True)
-        network_manager.send_file(other_mac, save_path)
-        print("[send_file] ✅ Archivo enviado correctamente", flush=True)
+    if file_size and pipe.written != file_size:
+        pipe.abort(IOError(f"subida incompleta: {pipe.written}/{file_size} bytes"))
+        return jsonify({"success": False, "error": "Subida incompleta"}), 400
+    pipe.finish()
+    if pipe.spilled:
+        print(f"[send_file] {pipe.spilled} bytes esperaron en disco al peer")
 
-        # Guardar referencia en chat_messages
-        chat_id = "-".join(sorted([my_mac, other_mac]))
-        if chat_id not in chat_messages:
-            chat_messages[chat_id] = []
-
-        file_message = {
-            "id": str(uuid.uuid4()),
-            "sender": my_mac,
-            "text": f"[ARCHIVO]{filename}",
-            "filename": filename,
-            "file_path": save_path,  # 🔹 agregar ruta real
-            "timestamp": datetime.now().strftime("%H:%M"),
-            "type": "file",
-        }
+    return jsonify(
+        {"success": True, "filename": filename, "job_id": job["id"]}
+    ), 202
 
-        chat_messages[chat_id].append(file_message)
 
-        return jsonify({"success": True, "filename": filename})
+@app.route("/upload_file_group", methods=["POST"])
+def upload_file_group():
+    """
+    Envía un archivo a varios usuarios a la vez: cada chunk viaja una sola
+    vez por broadcast y los receptores piden por NACK solo lo que perdieron.
+    """
+    my_mac = session.get("mac")
+    if not my_mac:
+        return jsonify({"success": False, "error": "Sesión no válida"}), 401
 
-    except FileNotFoundError as e:
-        print(f"[send_file] ❌ Archivo no encontrado: {e}", flush=True)
+    if "file" not in request.files:
+        return jsonify({"success": False, "error": "No se encontró el archivo"}), 400
+    file = request.files["file"]
+    if file.filename == "":
         return jsonify(
-            {"success": False, "error": f"Archivo no encontrado: {str(e)}"}
-        ), 404
+            {"success": False, "error": "No se seleccionó ningún archivo"}
+        ), 400
+
+    # receptores explícitos o, por defecto, todos los peers conocidos
+    receivers = request.form.getlist("receivers") or None
+
+    try:
+        filename = secure_filename(file.filename)
+        save_path = os.path.join(SEND_DIR, f"{uuid.uuid4()}_{filename}")
+        file.save(save_path)
+        print(f"[send_file_group] 📤 Archivo guardado: {save_path}", flush=True)
+
+        report = network_manager.send_file_group(save_path, receivers)
+        print(f"[send_file_group] ✅ Informe: {report}", flush=True)
+
+        # registrar el archivo en el chat de cada receptor que lo completó
+        for mac in report["complete"]:
+            chat_id = "-".join(sorted([my_mac, mac]))
+            chat_store.add(
+                chat_id,
+                my_mac,
+                f"[ARCHIVO]{filename}",
+                kind="file",
+                filename=filename,
+                file_path=save_path,
+            )
+
+        return jsonify({"success": True, "filename": filename, "report": report})
 
     except Exception as e:
-        print(f"[send_file] ❌ Error enviando archivo: {e}", flush=True)
+        print(f"[send_file_group] ❌ Error enviando archivo: {e}", flush=True)
         import traceback
 
         traceback.print_exc()
-
-        # Intentar limpiar archivo temporal en caso de error
-        try:
-            if "temp_path" in locals() and os.path.exists(save_path):
-                os.remove(save_path)
-        except Exception:
-            pass
-
         return jsonify({"success": False, "error": str(e)}), 500
 
 
 @app.route("/upload_folder", methods=["POST"])
 def upload_folder():
     """
-    Envía una carpeta directamente a send_files manteniendo estructura
-    Y además crea y envía un .zip de la misma carpeta
+    Recibe una carpeta subida desde el navegador y la envía en un trabajo
+    en segundo plano (ver /jobs) mientras llega, sin escribirla antes en
+    SEND_DIR: los archivos pasan por un FolderPipe que el trabajo recorre
+    con send_folder_stream. Si el peer va más lento que la subida, el
+    exceso se vuelca a disco y la respuesta sale igual al terminar de
+    subir. No se genera .zip en el emisor; el receptor lo arma bajo
+    demanda al descargar la carpeta.
     """
-    dest_mac = request.form.get("dest_mac")
+    from werkzeug.utils import secure_filename as _sf
+
+    try:
+        form = MultipartStream(request.stream, request.content_type)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    parts = form.parts()
+    # dest_mac va en la URL o como campo previo a los archivos
+    first = next(parts, None)
+    dest_mac = request.args.get("dest_mac") or form.fields.get("dest_mac")
 
     if not dest_mac:
         return jsonify({"error": "dest_mac requerido"}), 400
-
-    files_list = request.files.getlist("files")
-    if not files_list:
+    if first is None:
         return jsonify({"error": "no files uploaded"}), 400
 
     # 🔹 OBTENER NOMBRE REAL DE LA CARPETA
-    folder_name = "carpeta"
-    if files_list and files_list[0].filename:
-        first_path = files_list[0].filename
-        if "/" in first_path:
-            folder_name = first_path.split("/")[0]
-        elif "\\" in first_path:
-            folder_name = first_path.split("\\")[0]
-
-    # Si no pudimos determinar el nombre, usar uno por defecto con timestamp
-    if folder_name == "carpeta":
+    first_path = (first.filename or "").replace("\\", "/")
+    folder_name = _sf(first_path.split("/")[0]) if "/" in first_path else ""
+    if not folder_name:
         folder_name = f"carpeta_{int(time.time())}"
 
-    # 🔹 CREAR CARPETA CON NOMBRE REAL DENTRO DE SEND_FILES
-    target_root = os.path.join(SEND_DIR, folder_name)
-
-    # Si ya existe, agregar sufijo numérico
-    counter = 1
-    original_target = target_root
-    while os.path.exists(target_root):
-        target_root = f"{original_target}_{counter}"
-        counter += 1
-
-    os.makedirs(target_root, exist_ok=True)
-
-    from werkzeug.utils import secure_filename as _sf
-    import zipfile
-
     def safe_rel_path(raw_path: str) -> str:
         raw_path = raw_path.replace("\\", "/")
         parts = [p for p in raw_path.split("/") if p not in ("", ".")]
@@ -395,91 +612,163 @@ def upload_folder():
             if not s:
                 s = "file"
             safe_parts.append(s)
-        return os.path.join(*safe_parts) if safe_parts else "file"
-
-    # Guardar archivos manteniendo estructura (CORREGIDO)
-    for f in files_list:
-        rel = f.filename or f.name
-
-        # 🔹 CORRECCIÓN: Remover el nombre de la carpeta raíz de la ruta relativa
-        rel = rel.replace("\\", "/")
-        if "/" in rel:
-            path_parts = rel.split("/")
-            if len(path_parts) > 1 and path_parts[0] == folder_name:
-                rel = "/".join(path_parts[1:])
-            elif len(path_parts) > 1:
-                rel = "/".join(path_parts[1:])
-
-        rel_safe = safe_rel_path(rel)
-        dest_path = os.path.join(target_root, rel_safe)
-        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-        f.save(dest_path)
-        print(f"💾 Archivo guardado: {dest_path}")
-
-    # 🔹 CREAR ARCHIVO .ZIP DE LA CARPETA
-    zip_path = os.path.join(SEND_DIR, f"{os.path.basename(target_root)}.zip")
-    try:
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(target_root):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    # Calcular ruta relativa para mantener estructura en el zip
-                    rel_path = os.path.relpath(file_path, target_root)
-                    zipf.write(file_path, rel_path)
-        print(f"📦 Archivo ZIP creado: {zip_path}")
-    except Exception as e:
-        print(f"❌ Error creando ZIP: {e}")
-        return jsonify({"error": f"Error creando archivo ZIP: {e}"}), 500
+        return "/".join(safe_parts) if safe_parts else "file"
+
+    def entries():
+        for part in itertools.chain([first], parts):
+            # Remover el nombre de la carpeta raíz de la ruta relativa
+            rel = (part.filename or part.name).replace("\\", "/")
+            if "/" in rel:
+                rel = rel.split("/", 1)[1]
+            yield safe_rel_path(rel), part
 
-    # Enviar carpeta
+    # Registrar en el chat - CARPETA (sin copia local: folder_path vacío)
+    my_mac = session.get("mac")
+    chat_id = "-".join(sorted([my_mac, dest_mac]))
+    message = chat_store.add(
+        chat_id,
+        my_mac,
+        f"[CARPETA]{folder_name}",
+        kind="folder",
+        folder_path=None,
+        folder_name=folder_name,
+        status="queued",
+    )
+
+    pipe = FolderPipe(SEND_DIR)
+    print(f"📤 Encolando carpeta en flujo: {folder_name}")
     try:
-        print(f"📤 Enviando carpeta: {target_root}")
-        network_manager.send_folder(dest_mac, target_root, use_ack=True)
-
-        # 🔹 ENVIAR ARCHIVO .ZIP TAMBIÉN
-        print(f"📤 Enviando archivo ZIP: {zip_path}")
-        network_manager.send_file(dest_mac, zip_path)
-
-        # Registrar en el chat - CARPETA
-        my_mac = session.get("mac")
-        chat_id = "-".join(sorted([my_mac, dest_mac]))
-        if chat_id not in chat_messages:
-            chat_messages[chat_id] = []
-
-        # Mensaje para la carpeta
-        folder_message = {
-            "id": str(uuid.uuid4()),
-            "sender": my_mac,
-            "text": f"[CARPETA]{os.path.basename(target_root)}",
-            "folder_path": target_root,
-            "folder_name": os.path.basename(target_root),
-            "timestamp": datetime.now().strftime("%H:%M"),
-            "type": "folder",
-        }
-        chat_messages[chat_id].append(folder_message)
-
-        # 🔹 Mensaje para el archivo ZIP
-        zip_message = {
-            "id": str(uuid.uuid4()),
-            "sender": my_mac,
-            "text": f"[ARCHIVO]{os.path.basename(zip_path)}",
-            "filename": os.path.basename(zip_path),
-            "file_path": zip_path,
-            "timestamp": datetime.now().strftime("%H:%M"),
-            "type": "file",
-        }
-        chat_messages[chat_id].append(zip_message)
+        job = network_manager.submit_job(
+            "folder",
+            lambda cancel: network_manager.send_folder_stream(
+                dest_mac,
+                folder_name,
+                pipe.entries(),
+                use_ack=True,
+                cancel_event=cancel,
+            ),
+            dest=dest_mac,
+            name=folder_name,
+            message_id=message["id"],
+            cleanup=pipe.close,
+        )
+    except QueueFull as e:
+        chat_store.update(message["id"], status="failed")
+        return jsonify({"error": f"Cola llena: {e}"}), 503
 
+    # El trabajo ya puede estar enviando los primeros archivos
+    try:
+        for rel, part in entries():
+            pipe.begin(rel)
+            for block in iter(lambda: part.read(READ_SIZE), b""):
+                pipe.write(block)
+            pipe.end()
+    except BrokenPipeError:
+        status = (network_manager.jobs.get(job["id"]) or {}).get("status")
+        print(f"[send_folder] ⚠️ Envío terminado antes de la subida: {status}")
+        return jsonify({"error": f"envío {status}", "job_id": job["id"]}), 409
     except Exception as e:
-        return jsonify({"error": f"send_folder failed: {e}"}), 500
+        pipe.abort(IOError(f"subida interrumpida: {e}"))
+        print(f"[send_folder] ❌ Error recibiendo la subida: {e}", flush=True)
+        return jsonify({"error": f"upload failed: {e}"}), 500
+    pipe.finish()
+    if pipe.pipe.spilled:
+        print(f"[send_folder] {pipe.pipe.spilled} bytes esperaron en disco al peer")
 
     return jsonify(
         {
             "ok": True,
-            "folder_name": os.path.basename(target_root),
-            "zip_name": os.path.basename(zip_path),
+            "folder_name": folder_name,
+            "files": pipe.files,
+            "bytes": pipe.bytes,
+            "job_id": job["id"],
         }
-    )
+    ), 202
+
+
+@app.route("/groups", methods=["GET", "POST"])
+def groups():
+    """
+    GET: grupos a los que pertenece este nodo.
+    POST {name, members?}: crea el grupo (por defecto con todos los peers).
+    """
+    if request.method == "GET":
+        return jsonify(network_manager.get_groups())
+    data = request.json or {}
+    name = (data.get("name") or "").strip()
+    if not name:
+        return jsonify({"error": "name requerido"}), 400
+    try:
+        gid = network_manager.create_group(name, data.get("members"))
+    except Exception as e:
+        print(f"[API] ❌ Error creando grupo: {e}", flush=True)
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"ok": True, "id": gid, "name": name})
+
+
+@app.route("/groups/<gid>/messages")
+def get_group_messages(gid):
+    return _messages_response(f"group:{gid}")
+
+
+@app.route("/groups/<gid>/send", methods=["POST"])
+def send_group_message(gid):
+    """Un solo broadcast por mensaje; los acuses se reflejan en su status."""
+    message_text = (request.json or {}).get("message")
+    if not message_text:
+        return jsonify({"success": False, "error": "message requerido"}), 400
+    try:
+        message = network_manager.send_group_message(gid, message_text)
+    except KeyError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except Exception as e:
+        print(f"[API] ❌ Error enviando mensaje grupal: {e}", flush=True)
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({"success": True, "id": message["id"]})
+
+
+@app.route("/jobs")
+def list_jobs():
+    """Trabajos de envío en cola, en curso y recientes (el más nuevo primero)."""
+    return jsonify(network_manager.jobs.list())
+
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    job = network_manager.jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "trabajo no encontrado"}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    """Cancela un trabajo: en cola no llega a empezar; en curso se corta
+    antes del siguiente chunk."""
+    job = network_manager.jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "trabajo no encontrado"}), 404
+    return jsonify(job)
+
+
+@app.route("/transfers")
+def get_transfers():
+    """Telemetría de transferencias: throughput, retransmisiones, RTT y ETA"""
+    return jsonify(network_manager.get_transfers())
+
+
+@app.route("/transfers/<file_id>")
+def get_transfer(file_id):
+    info = network_manager.get_transfer(file_id)
+    if info is None:
+        return jsonify({"error": "Transferencia no encontrada"}), 404
+    return jsonify(info)
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Métricas de transporte, transferencias y web para Prometheus"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/logout")
@@ -493,44 +782,150 @@ def logout():
     return redirect(url_for("login"))
 
 
+class _ZipSink:
+    """Destino no seekable para zipfile: acumula lo escrito hasta que se drena."""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def write(self, data) -> int:
+        self._buf += data
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        out = bytes(self._buf)
+        self._buf.clear()
+        return out
+
+
+def stream_zip(folder_path: str, block_size: int = 65536):
+    """
+    Genera un .zip de la carpeta a medida que se lee (sin archivo temporal):
+    cada archivo se comprime por bloques y se entrega lo que va saliendo.
+    """
+    import zipfile
+
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        for root, dirs, files in os.walk(folder_path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                rel_path = os.path.relpath(file_path, folder_path)
+                try:
+                    info = zipfile.ZipInfo.from_file(file_path, rel_path)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    with open(file_path, "rb") as src, zf.open(
+                        info, "w", force_zip64=True
+                    ) as dst:
+                        for b in iter(lambda: src.read(block_size), b""):
+                            dst.write(b)
+                            if len(sink._buf) >= block_size:
+                                yield sink.drain()
+                except OSError as e:
+                    print(f"[DOWNLOAD] ⚠️ Omitiendo {file_path}: {e}", flush=True)
+                yield sink.drain()
+    yield sink.drain()
+
+
+def _file_response(path: str, filename: str, inline: bool = False) -> Response:
+    """
+    Respuesta para un archivo en disco con rangos (206), ETag y
+    Last-Modified, para poder adelantar videos y reanudar descargas.
+    Con wsgi.file_wrapper (gunicorn lo envía con sendfile) también los 206
+    salen sin copiar por Python: el archivo queda posicionado al inicio del
+    rango y el servidor manda solo Content-Length bytes (PEP 3333). Con
+    ACCEL_REDIRECT o USE_X_SENDFILE el proxy hace todo, rangos incluidos.
+    """
+    if inline:
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    else:
+        mimetype = "application/octet-stream"
+    real = os.path.realpath(path)
+    base = os.path.realpath(BASE_DIR)
+    accel = bool(ACCEL_REDIRECT) and os.path.commonpath([real, base]) == base
+    offload = accel or app.config["USE_X_SENDFILE"]
+
+    rv = send_file(
+        path,
+        mimetype=mimetype,
+        as_attachment=not inline,
+        download_name=filename,
+        conditional=not offload,
+        etag=not offload,
+    )
+    if accel:
+        rv.close()
+        rv.response = []
+        rv.content_length = 0
+        rv.headers["X-Accel-Redirect"] = ACCEL_REDIRECT.rstrip("/") + "/" + quote(
+            os.path.relpath(real, base)
+        )
+        return rv
+
+    wrapper = request.environ.get("wsgi.file_wrapper")
+    if rv.status_code == 206 and wrapper is not None:
+        rv.close()
+        f = open(path, "rb")
+        f.seek(rv.content_range.start)
+        rv.response = wrapper(f, SENDFILE_BLOCK)
+    return rv
+
+
 @app.route("/download_file/<file_id>")
 def download_file(file_id):
-    """Descargar archivo real según su ID almacenado"""
+    """
+    Descargar archivo real según su ID almacenado. Acepta Range e
+    If-None-Match / If-Modified-Since; ?inline=1 lo abre en el navegador
+    (p. ej. para ver un video adelantando).
+    """
     try:
         print(f"[DOWNLOAD] Solicitado archivo con ID: {file_id}", flush=True)
 
         # Buscar el mensaje que tenga este ID
-        for chat_id, messages in network_manager.chat_messages.items():
-            for message in messages:
-                if message.get("id") == file_id and (
-                    message.get("type") == "file"
-                    or message.get("text", "").startswith("[ARCHIVO]")
-                ):
-                    file_path = message.get("file_path")
-                    filename = message.get("filename", "archivo_descargado")
-
-                    if not file_path or not os.path.exists(file_path):
-                        print(
-                            f"[DOWNLOAD] ❌ Archivo no encontrado en disco: {file_path}",
-                            flush=True,
-                        )
-                        return "Archivo no encontrado", 404
-
-                    print(
-                        f"[DOWNLOAD] ✅ Enviando archivo real: {file_path}", flush=True
-                    )
-
-                    # 🔹 Usa send_file en modo binario con el nombre correcto
-                    return send_file(
-                        file_path,
-                        as_attachment=True,
-                        download_name=filename,
-                        mimetype="application/octet-stream",
-                    )
+        message = chat_store.get(file_id) or {}
+        if message.get("type") == "file":
+            file_path = message.get("file_path")
+            filename = message.get("filename", "archivo_descargado")
+
+            if not file_path or not os.path.exists(file_path):
+                print(
+                    f"[DOWNLOAD] ❌ Archivo no encontrado en disco: {file_path}",
+                    flush=True,
+                )
+                return "Archivo no encontrado", 404
+
+            print(f"[DOWNLOAD] ✅ Enviando archivo real: {file_path}", flush=True)
+
+            # 🔹 Usa send_file en modo binario con el nombre correcto
+            return _file_response(
+                file_path, filename, inline=request.args.get("inline") == "1"
+            )
+        if message.get("type") == "folder":
+            folder_path = message.get("folder_path")
+            if not folder_path or not os.path.isdir(folder_path):
+                return "Carpeta no encontrada", 404
+            print(f"[DOWNLOAD] 📦 Zip en flujo de: {folder_path}", flush=True)
+            name = secure_filename(message.get("folder_name") or "carpeta")
+            return Response(
+                stream_zip(folder_path),
+                mimetype="application/zip",
+                headers={"Content-Disposition": f'attachment; filename="{name}.zip"'},
+                direct_passthrough=True,
+            )
 
         print(f"[DOWNLOAD] ❌ Mensaje con ID {file_id} no encontrado", flush=True)
         return "Mensaje no encontrado", 404
 
+    except HTTPException:
+        raise  # p. ej. 416 para un rango fuera del archivo
     except Exception as e:
         print(f"[DOWNLOAD] ❌ Error al descargar: {e}", flush=True)
         import traceback
@@ -539,6 +934,33 @@ def download_file(file_id):
         return "Error al descargar archivo", 500
 
 
+@app.route("/stream_file/<file_id>")
+def stream_file(file_id):
+    """
+    Sirve un archivo mientras se recibe (respuesta chunked): sigue el prefijo
+    contiguo ya recibido y espera a que lleguen más datos.
+    """
+    message = chat_store.get(file_id)
+    if message is None or message.get("type") != "file":
+        return "Mensaje no encontrado", 404
+    file_path = message.get("file_path")
+    if not file_path or not os.path.exists(file_path):
+        return "Archivo no encontrado", 404
+
+    filename = message.get("filename", "archivo")
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    print(f"[STREAM] ▶️ Sirviendo {file_path}", flush=True)
+    return Response(
+        network_manager.stream_file(file_path),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": "inline; filename="
+            f'"{secure_filename(filename) or "archivo"}"'
+        },
+        direct_passthrough=True,
+    )
+
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "5000"))
     print(f"[INIT] 🌐 Iniciando servidor Flask en puerto {port}", flush=True)
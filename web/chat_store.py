@@ -0,0 +1,517 @@
+"""
+Almacén de mensajes del chat en SQLite (modo WAL).
+  - Todas las escrituras pasan por un hilo escritor que las agrupa en
+    transacciones: el hilo de recepción solo encola y sigue.
+  - Por chat se mantiene en memoria una ventana caliente con los últimos
+    HOT_SIZE mensajes (registros con __slots__); lo más viejo se lee de
+    la base cuando se pide.
+  - Cada hilo lector usa su propia conexión (WAL permite leer mientras el
+    escritor escribe).
+Un único contador global `rev` marca cada cambio: el seq de un mensaje es
+el rev con el que se creó y su rev sube cada vez que se modifica (status,
+acuses). Pedir los cambios con rev > cursor devuelve tanto los mensajes
+nuevos como los modificados.
+La búsqueda usa un índice FTS5 sobre el texto (incluye los nombres de
+archivo, "[ARCHIVO]nombre"), mantenido por triggers dentro de la misma
+transacción que escribe el mensaje.
+"""
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+DB_PATH = os.path.expanduser(os.getenv("LINKCHAT_CHAT_DB", "~/.linkchat/chat.db"))
+HOT_SIZE = int(os.getenv("LINKCHAT_CHAT_HOT", "200"))  # mensajes en memoria por chat
+BATCH_MAX = 256  # operaciones por transacción del escritor
+BATCH_DELAY = 0.05  # s que el escritor espera para juntar más operaciones
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq     INTEGER PRIMARY KEY,
+    id      TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    sender  TEXT NOT NULL,
+    text    TEXT NOT NULL,
+    ts      REAL NOT NULL,
+    type    TEXT NOT NULL,
+    extra   TEXT,
+    rev     INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_id ON messages(id);
+CREATE INDEX IF NOT EXISTS messages_chat_ts ON messages(chat_id, ts);
+CREATE INDEX IF NOT EXISTS messages_chat_rev ON messages(chat_id, rev);
+"""
+_COLUMNS = "seq, id, chat_id, sender, text, ts, type, extra, rev"
+
+# índice invertido de texto completo; la fila del índice es el seq
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE messages_fts USING fts5(
+    text,
+    content='messages',
+    content_rowid='seq',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, text) VALUES (new.seq, new.text);
+END;
+CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text)
+    VALUES ('delete', old.seq, old.text);
+END;
+CREATE TRIGGER messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text)
+    VALUES ('delete', old.seq, old.text);
+    INSERT INTO messages_fts(rowid, text) VALUES (new.seq, new.text);
+END;
+"""
+SEARCH_MAX = 200  # resultados máximos por página de búsqueda
+
+
+class Message:
+    """Registro compacto de un mensaje; extra guarda los campos opcionales."""
+
+    __slots__ = (
+        "seq",
+        "id",
+        "chat_id",
+        "sender",
+        "text",
+        "ts",
+        "type",
+        "extra",
+        "rev",
+    )
+
+    def __init__(self, seq, id, chat_id, sender, text, ts, type, extra=None, rev=0):
+        self.seq = seq
+        self.id = id
+        self.chat_id = chat_id
+        self.sender = sender
+        self.text = text
+        self.ts = ts
+        self.type = type
+        self.extra = extra
+        self.rev = rev or seq
+
+    @classmethod
+    def from_row(cls, row) -> "Message":
+        seq, id, chat_id, sender, text, ts, type, extra, rev = row
+        extra = json.loads(extra) if extra else None
+        return cls(seq, id, chat_id, sender, text, ts, type, extra, rev)
+
+    def to_row(self) -> tuple:
+        extra = json.dumps(self.extra) if self.extra else None
+        return (
+            self.seq,
+            self.id,
+            self.chat_id,
+            self.sender,
+            self.text,
+            self.ts,
+            self.type,
+            extra,
+            self.rev,
+        )
+
+    def to_dict(self) -> Dict:
+        """Forma JSON que consume la interfaz web."""
+        when = datetime.fromtimestamp(self.ts)
+        fmt = "%H:%M" if when.date() == datetime.now().date() else "%d/%m/%Y %H:%M"
+        out = {
+            "id": self.id,
+            "seq": self.seq,
+            "sender": self.sender,
+            "text": self.text,
+            "timestamp": when.strftime(fmt),
+            "time": self.ts,
+            "type": self.type,
+        }
+        if self.extra:
+            out.update(self.extra)
+        return out
+
+
+class ChatStore:
+    def __init__(self, path: str = DB_PATH, hot_size: int = HOT_SIZE):
+        self.path = path
+        self.hot_size = hot_size
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # chat_id -> últimos mensajes (se carga de la base al primer acceso)
+        self._hot: Dict[str, Deque[Message]] = {}
+        # id -> mensaje, para todo lo que está en alguna ventana caliente
+        self._by_id: Dict[str, Message] = {}
+        # chat_id -> rev del último cambio del chat
+        self._chat_rev: Dict[str, int] = {}
+        # chat_id -> todo cambio con rev mayor está en la ventana caliente
+        self._floor: Dict[str, int] = {}
+        # on_change(chat_id, rev) tras cada alta o modificación
+        self.on_change: Optional[Callable[[str, int], None]] = None
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        conn.commit()
+        self.fts = self._ensure_fts(conn)
+        self._rev = conn.execute(
+            "SELECT COALESCE(MAX(rev), 0) FROM messages"
+        ).fetchone()[0]
+
+        self._ops: "queue.Queue" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def _ensure_fts(conn: sqlite3.Connection) -> bool:
+        """
+        Crea el índice FTS5 si falta e indexa lo que ya estaba en la base.
+        False si el SQLite no trae FTS5 (la búsqueda cae a LIKE).
+        """
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+        ).fetchone()
+        if exists:
+            return True
+        try:
+            with conn:
+                conn.executescript("BEGIN;" + _FTS_SCHEMA)
+                conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            print(f"[chat_store] FTS5 no disponible, búsqueda lineal: {e}")
+            return False
+        return True
+
+    # --- Conexiones ----------------------------------------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        """Conexión propia del hilo actual."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _query(self, sql: str, args: tuple = ()) -> List[Message]:
+        return [Message.from_row(r) for r in self._conn().execute(sql, args)]
+
+    # --- Escritor ------------------------------------------------------------
+
+    def _write_loop(self) -> None:
+        conn = self._conn()
+        while True:
+            ops = [self._ops.get()]
+            deadline = time.monotonic() + BATCH_DELAY
+            while len(ops) < BATCH_MAX:
+                left = deadline - time.monotonic()
+                try:
+                    if left > 0:
+                        ops.append(self._ops.get(timeout=left))
+                    else:
+                        ops.append(self._ops.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    for kind, arg in ops:
+                        if kind == "insert":
+                            conn.execute(
+                                f"INSERT OR REPLACE INTO messages ({_COLUMNS}) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                arg,
+                            )
+                        elif kind == "update":
+                            self._apply_update(conn, *arg)
+            except sqlite3.Error as e:
+                print(f"[chat_store] Error escribiendo {len(ops)} operaciones: {e}")
+            finally:
+                for _ in ops:
+                    self._ops.task_done()
+
+    @staticmethod
+    def _apply_update(
+        conn: sqlite3.Connection, msg_id: str, fields: Dict, rev: int
+    ) -> None:
+        row = conn.execute(
+            "SELECT extra FROM messages WHERE id = ?", (msg_id,)
+        ).fetchone()
+        if row is None:
+            return
+        extra = json.loads(row[0] or "null") or {}
+        extra.update(fields)
+        conn.execute(
+            "UPDATE messages SET extra = ?, rev = ? WHERE id = ?",
+            (json.dumps(extra), rev, msg_id),
+        )
+
+    def flush(self) -> None:
+        """Espera a que el escritor haya volcado todo lo encolado."""
+        self._ops.join()
+
+    # --- Ventana caliente ----------------------------------------------------
+
+    def _hot_window(self, chat_id: str) -> Deque[Message]:
+        """Ventana del chat (con _lock tomado); se carga de la base si falta."""
+        window = self._hot.get(chat_id)
+        if window is None:
+            self.flush()
+            rows = self._query(
+                f"SELECT {_COLUMNS} FROM messages WHERE chat_id = ? "
+                "ORDER BY seq DESC LIMIT ?",
+                (chat_id, self.hot_size),
+            )
+            window = deque(reversed(rows), maxlen=self.hot_size)
+            self._hot[chat_id] = window
+            for msg in window:
+                self._by_id[msg.id] = msg
+            self._chat_rev[chat_id] = self._query_rev(chat_id)
+            # lo que no se cargó puede tener cambios de cualquier rev pasado
+            self._floor[chat_id] = self._rev
+        return window
+
+    def _query_rev(self, chat_id: str) -> int:
+        row = self._conn().execute(
+            "SELECT COALESCE(MAX(rev), 0) FROM messages WHERE chat_id = ?",
+            (chat_id,),
+        ).fetchone()
+        return row[0]
+
+    def _append(self, window: Deque[Message], msg: Message) -> None:
+        """Añade a la ventana; si desaloja uno, sus cambios pasan a la base."""
+        if len(window) == window.maxlen:
+            old = window[0]
+            self._floor[old.chat_id] = max(self._floor[old.chat_id], old.rev)
+            self._by_id.pop(old.id, None)
+        window.append(msg)
+        self._by_id[msg.id] = msg
+
+    # --- API -----------------------------------------------------------------
+
+    def add(
+        self,
+        chat_id: str,
+        sender: str,
+        text: str,
+        kind: str = "text",
+        msg_id: Optional[str] = None,
+        **extra,
+    ) -> Dict:
+        """Registra un mensaje y devuelve su forma JSON (con id y seq)."""
+        with self._lock:
+            window = self._hot_window(chat_id)
+            self._rev += 1
+            msg = Message(
+                self._rev,
+                msg_id or str(uuid.uuid4()),
+                chat_id,
+                sender,
+                text,
+                time.time(),
+                kind,
+                extra or None,
+            )
+            self._append(window, msg)
+            self._chat_rev[chat_id] = msg.rev
+            self._ops.put(("insert", msg.to_row()))
+            out = msg.to_dict()
+        self._notify(chat_id, msg.rev)
+        return out
+
+    def _notify(self, chat_id: str, rev: int) -> None:
+        if self.on_change:
+            try:
+                self.on_change(chat_id, rev)
+            except Exception as e:
+                print(f"[chat_store] error en callback: {e}")
+
+    def update(self, msg_id: str, **fields) -> bool:
+        """Cambia campos opcionales (status, delivered, ...) de un mensaje."""
+        chat_id = None
+        hot = False
+        with self._lock:
+            self._rev += 1
+            rev = self._rev
+            self._ops.put(("update", (msg_id, fields, rev)))
+            msg = self._by_id.get(msg_id)
+            if msg is not None:
+                msg.extra = {**(msg.extra or {}), **fields}
+                msg.rev = rev
+                chat_id = msg.chat_id
+                hot = True
+            else:
+                # fuera de memoria: el cambio solo se ve desde la base
+                self.flush()
+                row = self._conn().execute(
+                    "SELECT chat_id FROM messages WHERE id = ?", (msg_id,)
+                ).fetchone()
+                if row is not None:
+                    chat_id = row[0]
+                    if chat_id in self._hot:
+                        self._floor[chat_id] = rev
+            if chat_id in self._hot:
+                self._chat_rev[chat_id] = rev
+        if chat_id is not None:
+            self._notify(chat_id, rev)
+        return hot
+
+    def chat_rev(self, chat_id: str) -> int:
+        """Rev del último cambio del chat: sirve de ETag."""
+        with self._lock:
+            self._hot_window(chat_id)
+            return self._chat_rev[chat_id]
+
+    def changes(
+        self, chat_id: str, after: int, limit: int = 500
+    ) -> Tuple[List[Dict], int, bool]:
+        """
+        Mensajes del chat creados o modificados con rev > after, por rev.
+        Devuelve (mensajes, cursor para la próxima llamada, hay_más).
+        """
+        with self._lock:
+            window = self._hot_window(chat_id)
+            cursor = self._chat_rev[chat_id]
+            if after >= self._floor[chat_id]:
+                changed = sorted(
+                    (m for m in window if m.rev > after), key=lambda m: m.rev
+                )
+                if len(changed) <= limit:
+                    return [m.to_dict() for m in changed], cursor, False
+        # el cursor es anterior a la ventana en memoria: a la base
+        self.flush()
+        rows = self._query(
+            f"SELECT {_COLUMNS} FROM messages WHERE chat_id = ? AND rev > ? "
+            "ORDER BY rev LIMIT ?",
+            (chat_id, after, limit + 1),
+        )
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if more:
+            cursor = rows[-1].rev
+        elif rows:
+            cursor = max(cursor, rows[-1].rev)
+        return [m.to_dict() for m in rows], cursor, more
+
+    def recent(self, chat_id: str) -> List[Dict]:
+        """Ventana caliente del chat, del mensaje más viejo al más nuevo."""
+        with self._lock:
+            return [m.to_dict() for m in self._hot_window(chat_id)]
+
+    def history(
+        self, chat_id: str, before: Optional[int] = None, limit: int = 50
+    ) -> List[Dict]:
+        """Los `limit` mensajes anteriores a `before` (seq) o los últimos, en orden."""
+        self.flush()
+        if before is None:
+            rows = self._query(
+                f"SELECT {_COLUMNS} FROM messages WHERE chat_id = ? "
+                "ORDER BY seq DESC LIMIT ?",
+                (chat_id, limit),
+            )
+        else:
+            rows = self._query(
+                f"SELECT {_COLUMNS} FROM messages WHERE chat_id = ? AND seq < ? "
+                "ORDER BY seq DESC LIMIT ?",
+                (chat_id, before, limit),
+            )
+        return [m.to_dict() for m in reversed(rows)]
+
+    @staticmethod
+    def _fts_query(text: str) -> str:
+        """
+        Convierte lo que escribe el usuario en una consulta FTS5 segura:
+        todas las palabras deben aparecer y la última vale como prefijo
+        (para buscar mientras se escribe).
+        """
+        words = re.findall(r"\w+", text)
+        if not words:
+            return ""
+        terms = [f'"{w}"' for w in words]
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(
+        self,
+        text: str,
+        chat_id: Optional[str] = None,
+        sender: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        before: Optional[int] = None,
+        limit: int = 50,
+    ) -> List[Dict]:
+        """
+        Mensajes que contienen las palabras de `text`, del más nuevo al más
+        viejo. Filtros opcionales por chat, remitente y rango de tiempo (ts
+        unix); before (seq) pagina hacia atrás. Cada resultado lleva chat_id.
+        """
+        limit = max(1, min(limit, SEARCH_MAX))
+        where = []
+        args: list = []
+        if self.fts:
+            query = self._fts_query(text)
+            if not query:
+                return []
+            source = (
+                "messages_fts JOIN messages ON messages.seq = messages_fts.rowid"
+            )
+            where.append("messages_fts MATCH ?")
+            args.append(query)
+        else:
+            words = re.findall(r"\w+", text)
+            if not words:
+                return []
+            source = "messages"
+            for w in words:
+                where.append("text LIKE ?")
+                args.append(f"%{w}%")
+        for clause, value in (
+            ("chat_id = ?", chat_id),
+            ("sender = ?", sender),
+            ("ts >= ?", since),
+            ("ts < ?", until),
+            ("seq < ?", before),
+        ):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+        columns = ", ".join(f"messages.{c.strip()}" for c in _COLUMNS.split(","))
+        # FTS5 recorre sus coincidencias por rowid descendente sin ordenar
+        order = "messages_fts.rowid" if self.fts else "messages.seq"
+        sql = (
+            f"SELECT {columns} FROM {source} WHERE {' AND '.join(where)} "
+            f"ORDER BY {order} DESC LIMIT ?"
+        )
+        self.flush()
+        out = []
+        for msg in self._query(sql, tuple(args) + (limit,)):
+            item = msg.to_dict()
+            item["chat_id"] = msg.chat_id
+            out.append(item)
+        return out
+
+    def get(self, msg_id: str) -> Optional[Dict]:
+        """Mensaje por id: primero en el índice en memoria, si no en la base."""
+        with self._lock:
+            msg = self._by_id.get(msg_id)
+            if msg is not None:
+                return msg.to_dict()
+        self.flush()
+        rows = self._query(f"SELECT {_COLUMNS} FROM messages WHERE id = ?", (msg_id,))
+        return rows[0].to_dict() if rows else None
+
+    def close(self) -> None:
+        self.flush()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,92 @@
+"""
+Eventos para la interfaz web por Server-Sent Events.
+Los eventos se guardan una sola vez en un buffer circular compartido y
+cada cliente conectado solo recuerda su último id: no hay colas ni hilos
+por cliente, todos esperan en la misma Condition. Un cliente que se
+reconecta manda Last-Event-ID y recibe lo que se perdió; si ya no está en
+el buffer recibe un evento "reset" y vuelve a pedir todo.
+El servidor de Werkzeug igual ocupa un hilo por conexión abierta, así que
+los flujos simultáneos se limitan a MAX_CLIENTS: el resto recibe 503 y la
+página sigue con el polling condicional.
+"""
+import json
+import os
+import threading
+from collections import deque
+from typing import Deque, Iterator, Optional, Tuple
+
+RING_SIZE = 1024  # eventos recientes que se pueden reenviar
+HEARTBEAT = 15.0  # s entre comentarios de keep-alive
+RETRY_MS = 2000  # espera de reconexión que se sugiere al navegador
+MAX_CLIENTS = int(os.getenv("LINKCHAT_SSE_MAX_CLIENTS", "32"))
+
+
+class TooManyClients(Exception):
+    """Ya hay MAX_CLIENTS flujos abiertos."""
+
+
+class EventHub:
+    def __init__(self, size: int = RING_SIZE, max_clients: int = MAX_CLIENTS):
+        self._ring: Deque[Tuple[int, str, str]] = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._last_id = 0
+        self.max_clients = max_clients
+        self.clients = 0
+
+    def publish(self, event: str, data: Optional[dict] = None) -> int:
+        """Agrega un evento y despierta a todos los clientes."""
+        payload = json.dumps(data or {})
+        with self._cond:
+            self._last_id += 1
+            self._ring.append((self._last_id, event, payload))
+            self._cond.notify_all()
+            return self._last_id
+
+    def _since(self, last_id: int) -> Optional[list]:
+        """Eventos con id > last_id (con _cond tomado); None si ya se perdieron."""
+        if last_id > self._last_id:
+            return None  # id de antes de un reinicio del servidor
+        if self._ring and last_id < self._ring[0][0] - 1:
+            return None
+        return [e for e in self._ring if e[0] > last_id]
+
+    def stream(self, last_id: Optional[int] = None) -> Iterator[str]:
+        """
+        Generador con el texto SSE para un cliente. Sin last_id empieza
+        desde el evento actual (no reenvía historia); el punto de partida
+        se fija al llamar, no al empezar a iterar. Lanza TooManyClients si
+        ya hay max_clients flujos abiertos.
+        """
+        with self._cond:
+            if self.clients >= self.max_clients:
+                raise TooManyClients(f"{self.clients} clientes conectados")
+            self.clients += 1
+            start = self._last_id if last_id is None else last_id
+        return self._events_after(start)
+
+    def _events_after(self, cursor: int) -> Iterator[str]:
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            yield from self._follow(cursor)
+        finally:
+            # el servidor cierra el generador cuando el cliente se desconecta
+            with self._cond:
+                self.clients -= 1
+
+    def _follow(self, cursor: int) -> Iterator[str]:
+        while True:
+            with self._cond:
+                pending = self._since(cursor)
+                if pending == []:
+                    self._cond.wait(HEARTBEAT)
+                    pending = self._since(cursor)
+            if pending is None:
+                with self._cond:
+                    cursor = self._last_id
+                yield f"id: {cursor}\nevent: reset\ndata: {{}}\n\n"
+            elif not pending:
+                yield ": keep-alive\n\n"
+            else:
+                for event_id, event, payload in pending:
+                    yield f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n"
+                cursor = pending[-1][0]
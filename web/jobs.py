@@ -0,0 +1,152 @@
+"""
+Trabajos de transferencia en segundo plano.
+Las rutas de subida registran un trabajo y responden enseguida; un pool
+acotado de hilos los ejecuta. Cada trabajo recibe un threading.Event de
+cancelación que se pasa hasta files.send_stream.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+WORKERS = int(os.getenv("LINKCHAT_JOB_WORKERS", "4"))  # envíos simultáneos
+MAX_PENDING = int(os.getenv("LINKCHAT_JOB_QUEUE", "64"))  # en cola + en curso
+RECENT_MAX = 100  # trabajos terminados que se conservan para consulta
+
+_FINAL = ("done", "failed", "cancelled")
+
+
+class QueueFull(Exception):
+    """Ya hay MAX_PENDING trabajos sin terminar."""
+
+
+class JobManager:
+    """
+    on_update(job) se llama en cada cambio de estado con una copia pública
+    del trabajo: queued -> running -> done | failed | cancelled.
+    """
+
+    def __init__(
+        self,
+        workers: int = WORKERS,
+        max_pending: int = MAX_PENDING,
+        on_update: Optional[Callable[[Dict], None]] = None,
+    ):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="job"
+        )
+        self.max_pending = max_pending
+        self.on_update = on_update
+        self._jobs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _public(self, job: Dict) -> Dict:
+        return {
+            k: v
+            for k, v in job.items()
+            if k not in ("cancel", "future", "fn", "cleanup")
+        }
+
+    def _set(self, job: Dict, **fields) -> None:
+        with self._lock:
+            job.update(fields)
+            public = self._public(job)
+        if self.on_update:
+            try:
+                self.on_update(public)
+            except Exception as e:
+                print(f"[jobs] error en callback: {e}")
+
+    def submit(
+        self,
+        kind: str,
+        fn: Callable[[threading.Event], object],
+        *,
+        dest: str,
+        name: str,
+        cleanup: Optional[Callable[[], None]] = None,
+        **info,
+    ) -> Dict:
+        """
+        Encola fn(cancel_event); su valor de retorno queda en job["result"].
+        cleanup() se llama siempre al terminar (p. ej. borrar temporales).
+        Lanza QueueFull si hay demasiados trabajos pendientes.
+        """
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "dest": dest,
+            "name": name,
+            "status": "queued",
+            "error": None,
+            "result": None,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "cancel": threading.Event(),
+            "fn": fn,
+            "cleanup": cleanup,
+            **info,
+        }
+        with self._lock:
+            pending = sum(
+                1 for j in self._jobs.values() if j["status"] not in _FINAL
+            )
+            if pending >= self.max_pending:
+                raise QueueFull(f"{pending} trabajos pendientes")
+            self._jobs[job["id"]] = job
+            self._trim()
+            job["future"] = self._executor.submit(self._run, job)
+        print(f"[jobs] {job['id'][:8]} encolado: {kind} {name} -> {dest}")
+        return self._public(job)
+
+    def _trim(self) -> None:
+        """Olvida los terminados más viejos (con _lock tomado)."""
+        done = [jid for jid, j in self._jobs.items() if j["status"] in _FINAL]
+        for jid in done[: max(0, len(done) - RECENT_MAX)]:
+            del self._jobs[jid]
+
+    def _run(self, job: Dict) -> None:
+        try:
+            if job["cancel"].is_set():
+                self._set(job, status="cancelled", finished=time.time())
+                return
+            self._set(job, status="running", started=time.time())
+            try:
+                result = job["fn"](job["cancel"])
+            except Exception as e:
+                status = "cancelled" if job["cancel"].is_set() else "failed"
+                print(f"[jobs] {job['id'][:8]} {status}: {e}")
+                self._set(job, status=status, error=str(e), finished=time.time())
+                return
+            self._set(job, status="done", result=result, finished=time.time())
+        finally:
+            if job["cleanup"]:
+                try:
+                    job["cleanup"]()
+                except Exception as e:
+                    print(f"[jobs] error limpiando {job['id'][:8]}: {e}")
+
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        """Pide cancelar un trabajo; None si no existe."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] in _FINAL:
+                return self._public(job)
+            job["cancel"].set()
+        print(f"[jobs] {job_id[:8]} cancelación pedida")
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job else None
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            return [self._public(j) for j in reversed(self._jobs.values())]
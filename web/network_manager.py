@@ -1,19 +1,31 @@
-from datetime import datetime
 import threading
 import time
 from typing import Dict, List, Callable, Optional
 import os
-import uuid
+
+from chat_store import DB_PATH, ChatStore
+from events import EventHub
+from jobs import JobManager
 
 
 class NetworkManager:
-    def __init__(self, RECV_DIR: str):
+    def __init__(self, RECV_DIR: str, db_path: str = DB_PATH):
         self.peers: Dict[str, Dict] = {}
         self.my_mac = None
         self.on_peers_updated: Optional[Callable] = None
         self.running = False
-        self.chat_messages = {}
+        # historial de los chats (SQLite + ventana en memoria por chat)
+        self.store = ChatStore(db_path)
+        # eventos para la interfaz (SSE): cambios en chats y en los peers
+        self.events = EventHub()
+        self.store.on_change = self._on_chat_change
+        # envíos en segundo plano lanzados desde la web
+        self.jobs = JobManager(on_update=self._on_job_update)
         self.RECV_DIR = RECV_DIR
+        # id del mensaje de cada archivo en recepción, por ruta absoluta
+        self._receiving: Dict[str, str] = {}
+        # mensajes de grupo enviados, por (gid, seq): {"id", "members", "delivered"}
+        self._group_sent: Dict[tuple, Dict] = {}
         self._import_backend_modules()
 
     def _import_backend_modules(self):
@@ -26,23 +38,52 @@ class NetworkManager:
             )
 
             from messaging import discover_peers, send_message, start_message_loop
-            from files import send_file, start_file_loop, stop_file_loop
+            from files import (
+                send_file,
+                send_file_group,
+                send_stream,
+                start_file_loop,
+                stop_file_loop,
+            )
 
             # importar send_folder para enviar carpetas recursivas
-            from folders import send_folder
+            from folders import send_folder, send_folder_stream, sync_folder
+            from files import stream_incoming
             from ethernet import send_frame, start_recv_loop, stop_recv_loop
+            import groups
+            import metrics
+            import presence
+            import transfers
+
+            metrics.gauge("linkchat_peers", "Peers conocidos").set_function(
+                lambda: len(self.peers)
+            )
 
             self.backend = {
                 "discover_peers": discover_peers,
                 "send_message": send_message,
                 "send_file": send_file,
+                "send_file_group": send_file_group,
+                "send_stream": send_stream,
                 "send_folder": send_folder,
+                "send_folder_stream": send_folder_stream,
+                "sync_folder": sync_folder,
                 "start_file_loop": start_file_loop,
                 "stop_file_loop": stop_file_loop,
                 "send_frame": send_frame,
                 "start_recv_loop": start_recv_loop,
                 "stop_recv_loop": stop_recv_loop,
                 "start_message_loop": start_message_loop,
+                "start_presence": presence.start,
+                "start_group_loop": groups.start_group_loop,
+                "create_group": groups.create_group,
+                "list_groups": groups.list_groups,
+                "send_group_message": groups.send_group_message,
+                "group_receipts": groups.receipts,
+                "stop_presence": presence.stop,
+                "transfers_snapshot": transfers.snapshot,
+                "transfer_info": transfers.get,
+                "stream_incoming": stream_incoming,
             }
             self.backend_available = True
         except ImportError as e:
@@ -65,15 +106,22 @@ class NetworkManager:
         ):
             return
         chat_id = "-".join(sorted([self.my_mac, other_mac]))
-        if chat_id not in self.chat_messages:
-            self.chat_messages[chat_id] = []
-        new_message = {
-            "id": str(uuid.uuid4()),
-            "sender": other_mac,
-            "text": message_text,
-            "timestamp": datetime.now().strftime("%H:%M"),
-        }
-        self.chat_messages[chat_id].append(new_message)
+        self.store.add(chat_id, other_mac, message_text)
+
+    def rec_group_message(self, src_mac: str, gid: str, text: str, seq: int) -> None:
+        self.store.add(f"group:{gid}", src_mac, text)
+
+    def _on_group_receipt(self, gid: str, seq: int, member: str) -> None:
+        """Acuse de un miembro: actualiza el contador "entregados/miembros"."""
+        sent = self._group_sent.get((gid, seq))
+        if sent is None or member in sent["delivered"]:
+            return
+        sent["delivered"].append(member)
+        self.store.update(
+            sent["id"],
+            delivered=list(sent["delivered"]),
+            status=f"{len(sent['delivered'])}/{sent['members']}",
+        )
 
     def rec_file(self, src_mac: str, file_path: str, status: str) -> None:
         """Maneja la recepción de archivos y carpetas"""
@@ -83,46 +131,94 @@ class NetworkManager:
             print("📤 Ignorando archivo propio")
             return
 
-        if status == "completed" or status == "finished":
-            absolute_path = os.path.abspath(file_path)
+        absolute_path = os.path.abspath(file_path)
 
-            # Verificar que esté dentro de RECV_DIR
-            if not absolute_path.startswith(os.path.abspath(self.RECV_DIR)):
-                print(f"⚠️ Archivo fuera de RECV_DIR: {absolute_path}")
-                return
+        if (
+            status == "reaped"
+            or status.startswith("rejected")
+            or status.startswith("error")
+            or status == "finished_hash_mismatch"
+        ):
+            print(f"⚠️ Transferencia descartada ({status}): {file_path}")
+            msg_id = self._receiving.pop(absolute_path, None)
+            if msg_id:
+                self.store.update(msg_id, status="failed")
+            return
 
-            # 🔹 EVITAR REGISTRAR ARCHIVOS QUE ESTÁN DENTRO DE CARPETAS RECIBIDAS
-            # Si el archivo está dentro de una subcarpeta de RECV_DIR, probablemente
-            # es parte de una carpeta y no debe mostrarse individualmente
-            rel_path = os.path.relpath(absolute_path, self.RECV_DIR)
-            if os.path.sep in rel_path and not rel_path.startswith(".."):
-                # Este archivo está dentro de una subcarpeta, es parte de una carpeta recibida
-                # No lo registramos individualmente en el chat
-                print(f"📁 Archivo dentro de carpeta (no mostrar en chat): {rel_path}")
-                return
+        if status == "dir_created":
+            self._rec_folder(src_mac, absolute_path)
+            return
 
-            # Determinar si es archivo individual o parte de carpeta
-            filename = os.path.basename(absolute_path)
+        if status not in ("started", "completed", "finished"):
+            return
 
-            chat_id = "-".join(sorted([self.my_mac, src_mac]))
-            if chat_id not in self.chat_messages:
-                self.chat_messages[chat_id] = []
+        # el archivo ya se mostraba en el chat mientras se recibía
+        if status != "started" and absolute_path in self._receiving:
+            self.store.update(self._receiving.pop(absolute_path), status="received")
+            print(f"✅ Archivo recibido: {absolute_path}")
+            return
 
-        # Registrar como archivo individual solo si no es parte de una carpeta
-        file_message = {
-            "id": str(uuid.uuid4()),
-            "sender": src_mac,
-            "text": f"[ARCHIVO]{filename}",
-            "file_path": absolute_path,
-            "filename": filename,
-            "timestamp": datetime.now().strftime("%H:%M"),
-            "type": "file",
-        }
+        # Verificar que esté dentro de RECV_DIR
+        if not absolute_path.startswith(os.path.abspath(self.RECV_DIR)):
+            print(f"⚠️ Archivo fuera de RECV_DIR: {absolute_path}")
+            return
 
-        self.chat_messages[chat_id].append(file_message)
+        # 🔹 EVITAR REGISTRAR ARCHIVOS QUE ESTÁN DENTRO DE CARPETAS RECIBIDAS
+        # Si el archivo está dentro de una subcarpeta de RECV_DIR, probablemente
+        # es parte de una carpeta y no debe mostrarse individualmente
+        rel_path = os.path.relpath(absolute_path, self.RECV_DIR)
+        if os.path.sep in rel_path and not rel_path.startswith(".."):
+            # Este archivo está dentro de una subcarpeta, es parte de una carpeta recibida
+            # No lo registramos individualmente en el chat
+            print(f"📁 Archivo dentro de carpeta (no mostrar en chat): {rel_path}")
+            return
+
+        # Determinar si es archivo individual o parte de carpeta
+        filename = os.path.basename(absolute_path)
+
+        chat_id = "-".join(sorted([self.my_mac, src_mac]))
+
+        # Registrar como archivo individual solo si no es parte de una carpeta
+        file_message = self.store.add(
+            chat_id,
+            src_mac,
+            f"[ARCHIVO]{filename}",
+            kind="file",
+            file_path=absolute_path,
+            filename=filename,
+            status="receiving" if status == "started" else "received",
+        )
+        if status == "started":
+            self._receiving[absolute_path] = file_message["id"]
+            print(f"📥 Recibiendo archivo: {filename}")
+            return
         print(f"✅ Archivo recibido: {filename}")
         print(f"📁 Ruta: {absolute_path}")
 
+    def _rec_folder(self, src_mac: str, folder_path: str) -> None:
+        """
+        Registra en el chat una carpeta recibida. Una carpeta enviada en flujo
+        anuncia su raíz con cada manifiesto: se registra una sola vez.
+        """
+        recv_dir = os.path.abspath(self.RECV_DIR)
+        if os.path.dirname(folder_path) != recv_dir:
+            return
+
+        chat_id = "-".join(sorted([self.my_mac, src_mac]))
+        if any(m.get("folder_path") == folder_path for m in self.store.recent(chat_id)):
+            return
+
+        folder_name = os.path.basename(folder_path)
+        self.store.add(
+            chat_id,
+            src_mac,
+            f"[CARPETA]{folder_name}",
+            kind="folder",
+            folder_path=folder_path,
+            folder_name=folder_name,
+        )
+        print(f"📁 Carpeta recibida: {folder_name}")
+
     def start(self, my_mac: str):
         print(f"Starting NetworkManager with MAC: {my_mac}")
 
@@ -133,60 +229,73 @@ class NetworkManager:
 
         self.my_mac = my_mac
         self.running = True
-        self._start_discovery_polling()
         self.backend["start_message_loop"](self.rec_messages)
+        self.backend["start_presence"](my_mac, on_change=self._on_presence)
+        self.backend["start_group_loop"](
+            my_mac, self.rec_group_message, self._on_group_receipt
+        )
         self._start_file_receiver()
         print(f"NetworkManager iniciado para MAC: {my_mac}")
 
     def stop(self):
         self.running = False
         if self.backend_available:
+            self.backend["stop_presence"]()
             self.backend["stop_recv_loop"]()
             self.backend["stop_file_loop"]()
 
-    def _start_discovery_polling(self):
-        def discovery_loop():
-            while self.running:
-                try:
-                    # discovery real o simulado
-                    if self.backend_available:
-                        discovered = self.backend["discover_peers"](timeout=1.0)
-                    else:
-                        # demo discovery usando env var PEERS
-                        discovered_peers = os.getenv("PEERS", "")
-                        discovered = []
-                        for peer_info in discovered_peers.split(","):
-                            if not peer_info.strip():
-                                continue
-                            name, mac = peer_info.split(":")
-                            discovered.append((mac.strip(), name.strip()))
-
-                    for mac, name in discovered:
-                        if mac not in self.peers:
-                            self.peers[mac] = {
-                                "name": name,
-                                "status": "online",
-                                "last_seen": time.time(),
-                            }
-                        else:
-                            self.peers[mac]["last_seen"] = time.time()
-
-                    # limpiar peers antiguos
-                    current_time = time.time()
-                    for mac in list(self.peers.keys()):
-                        if current_time - self.peers[mac].get("last_seen", 0) > 10:
-                            del self.peers[mac]
-
-                    if self.on_peers_updated:
-                        self.on_peers_updated()
-
-                except Exception as e:
-                    print(f"Error en discovery: {e}")
-
-                time.sleep(3)
-
-        thread = threading.Thread(target=discovery_loop, daemon=True)
-        thread.start()
+    def _on_chat_change(self, chat_id: str, rev: int) -> None:
+        self.events.publish("chat", {"chat": chat_id, "rev": rev})
+
+    # estado del trabajo -> status del mensaje del chat que lo representa
+    _JOB_MESSAGE_STATUS = {
+        "queued": "queued",
+        "running": "sending",
+        "done": "sent",
+        "failed": "failed",
+        "cancelled": "cancelled",
+    }
+
+    def _on_job_update(self, job: Dict) -> None:
+        if job.get("message_id"):
+            self.store.update(
+                job["message_id"], status=self._JOB_MESSAGE_STATUS[job["status"]]
+            )
+        self.events.publish("job", {"id": job["id"], "status": job["status"]})
+
+    def submit_job(
+        self,
+        kind: str,
+        fn: Callable,
+        *,
+        dest: str,
+        name: str,
+        message_id: Optional[str] = None,
+        cleanup: Optional[Callable[[], None]] = None,
+    ) -> Dict:
+        """
+        Encola un envío en segundo plano: fn(cancel_event) corre en el pool
+        de self.jobs. Si message_id se pasa, el status de ese mensaje sigue
+        al del trabajo. Lanza QueueFull si la cola está llena.
+        """
+        if not self.backend_available:
+            raise RuntimeError("Backend no disponible")
+        job = self.jobs.submit(
+            kind, fn, dest=dest, name=name, cleanup=cleanup, message_id=message_id
+        )
+        if message_id:
+            self.store.update(message_id, job_id=job["id"])
+        return job
+
+    def _on_presence(self, peers: Dict[str, Dict]) -> None:
+        """Callback de presence: la lista de peers cambió (alta, nombre o expiración)."""
+        self.peers = {
+            mac: {"name": p["name"], "status": "online", "last_seen": p["last_seen"]}
+            for mac, p in peers.items()
+        }
+        self.events.publish("peers")
+        if self.on_peers_updated:
+            self.on_peers_updated()
 
     def _start_file_receiver(self):
         def file_callback(src_mac: str, path: str, status: str):
@@ -201,10 +310,74 @@ class NetworkManager:
             raise RuntimeError("Backend no disponible")
         self.backend["send_message"](dest_mac, message)
 
-    def send_file(self, dest_mac: str, file_path: str):
+    def create_group(self, name: str, members=None) -> str:
+        """Crea un grupo (por defecto con todos los peers) y devuelve su id."""
+        if not self.backend_available:
+            raise RuntimeError("Backend no disponible")
+        if members is None:
+            members = list(self.peers.keys())
+        return self.backend["create_group"](name, members)
+
+    def get_groups(self) -> List[Dict]:
+        if not self.backend_available:
+            return []
+        return self.backend["list_groups"]()
+
+    def send_group_message(self, gid: str, text: str) -> Dict:
+        """
+        Envía un mensaje al grupo (un solo broadcast) y lo registra en su chat.
+        El campo status ("entregados/miembros") se actualiza con los acuses.
+        """
+        if not self.backend_available:
+            raise RuntimeError("Backend no disponible")
+        group = next((g for g in self.get_groups() if g["id"] == gid), None)
+        if group is None:
+            raise KeyError(f"grupo desconocido: {gid}")
+        members = len([m for m in group["members"] if m != self.my_mac])
+        seq = self.backend["send_group_message"](gid, text)
+        message = self.store.add(
+            f"group:{gid}",
+            self.my_mac,
+            text,
+            members=members,
+            delivered=[],
+            status=f"0/{members}",
+        )
+        self._group_sent[(gid, seq)] = {
+            "id": message["id"],
+            "members": members,
+            "delivered": [],
+        }
+        # acuses que llegaron antes de registrar el mensaje
+        receipts = self.backend["group_receipts"](gid, seq) or {}
+        for member in receipts.get("delivered", []):
+            self._on_group_receipt(gid, seq, member)
+        return message
+
+    def send_file(self, dest_mac: str, file_path: str, **kwargs):
+        if not self.backend_available:
+            raise RuntimeError("Backend no disponible")
+        return self.backend["send_file"](dest_mac, file_path, **kwargs)
+
+    def send_stream(self, dest_mac: str, stream, name: str, size: int, **kwargs):
+        """
+        Envía un archivo leyendo de un flujo (files.send_stream); size se
+        anuncia en FILE_START (0 = desconocido).
+        """
+        if not self.backend_available:
+            raise RuntimeError("Backend no disponible")
+        return self.backend["send_stream"](dest_mac, stream, name, size, **kwargs)
+
+    def send_file_group(self, file_path: str, receivers=None, **kwargs) -> Dict:
+        """
+        Envía un archivo una sola vez por broadcast a todos los receptores
+        (files.send_file_group) y devuelve el informe de entrega.
+        """
         if not self.backend_available:
             raise RuntimeError("Backend no disponible")
-        self.backend["send_file"](dest_mac, file_path)
+        if receivers is None:
+            receivers = list(self.peers.keys())
+        return self.backend["send_file_group"](file_path, receivers=receivers, **kwargs)
 
     # Añadir método delegado en la clase NetworkManager
     def send_folder(self, dest_mac: str, folder_path: str, **kwargs):
@@ -214,6 +387,45 @@ class NetworkManager:
         # pasar kwargs para use_ack/retries/timeout si se desean
         return self.backend["send_folder"](dest_mac, folder_path, **kwargs)
 
+    def sync_folder(self, dest_mac: str, folder_path: str, **kwargs):
+        """
+        Sincroniza una carpeta con el peer enviando solo lo nuevo o modificado
+        (folders.sync_folder). delete=True propaga los borrados.
+        """
+        if not self.backend_available:
+            raise RuntimeError("Backend no disponible")
+        return self.backend["sync_folder"](dest_mac, folder_path, **kwargs)
+
+    def send_folder_stream(self, dest_mac: str, folder_name: str, entries, **kwargs):
+        """Envía una carpeta cuyos archivos se leen de un flujo (folders.send_folder_stream)."""
+        if not self.backend_available:
+            raise RuntimeError("Backend no disponible")
+        return self.backend["send_folder_stream"](
+            dest_mac, folder_name, entries, **kwargs
+        )
+
+    def stream_file(self, file_path: str):
+        """Generador con los bytes de un archivo que puede estar aún recibiéndose."""
+        if not self.backend_available:
+            raise RuntimeError("Backend no disponible")
+        return self.backend["stream_incoming"](file_path)
+
+    def get_transfers(self) -> List[Dict]:
+        """Telemetría de transferencias activas y recientes (ambos sentidos)."""
+        if not self.backend_available:
+            return []
+        return self.backend["transfers_snapshot"]()
+
+    def get_transfer(self, file_id: str) -> Optional[Dict]:
+        """Telemetría de una transferencia por su file_id en hex."""
+        if not self.backend_available:
+            return None
+        try:
+            fid = bytes.fromhex(file_id)
+        except ValueError:
+            return None
+        return self.backend["transfer_info"](fid)
+
     def get_peers_for_flask(self) -> List[Dict]:
         result = []
         for mac, data in self.peers.items():
@@ -244,6 +456,7 @@ class NetworkManager:
                             "status": "online",
                             "last_seen": time.time(),
                         }
+                        self.events.publish("peers")
                 if self.on_peers_updated:
                     self.on_peers_updated()
                 time.sleep(5)
@@ -1,9 +1,22 @@
 let users = [];
 let currentChat = null;
 let isGroupChat = false;
+let currentGroupId = null;
 let uploadStates = new Map(); // Guarda estado de subidas: {id: {type, name}}
 let messageAnimations = new Set(); // Controla mensajes ya animados
 
+// Sincronización incremental del chat abierto
+let chatKey = null;        // URL base de los mensajes del chat abierto
+let messageCursor = null;  // cursor devuelto por el servidor (rev del chat)
+let messagesEtag = null;   // ETag de la última respuesta completa
+let oldestSeq = null;      // seq del mensaje más viejo mostrado (backfill)
+let hasOlder = false;
+let loadingOlder = false;
+let usersEtag = null;
+let pushConnected = false; // con /events abierto no hace falta el polling
+let syncing = false;
+let syncAgain = false;
+
 // Función para mostrar mensaje de envío en progreso
 function showUploadInProgress(type, name, id) {
     uploadStates.set(id, {
@@ -78,11 +91,17 @@ function formatBytes(bytes) {
     return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
 }
 
-// Cargar usuarios desde Flask
+// Cargar usuarios desde Flask (304 si la lista no cambió)
 function fetchUsers() {
-    fetch('/get_users')
-        .then(res => res.json())
+    const headers = usersEtag ? {'If-None-Match': usersEtag} : {};
+    return fetch('/get_users', {headers: headers, cache: 'no-store'})
+        .then(res => {
+            if (res.status === 304) return null;
+            usersEtag = res.headers.get('ETag');
+            return res.json();
+        })
         .then(data => {
+            if (!data) return;
             users = data;
             applySavedNames();
             loadChats();
@@ -138,6 +157,7 @@ function loadChats() {
 // Abrir chat individual
 function openChat(index) {
     isGroupChat = false;
+    currentGroupId = null;
     currentChat = users[index];
     const header = document.getElementById("chat-header");
     const displayName = currentChat.name ? currentChat.name : "Desconocido";
@@ -171,147 +191,336 @@ function openGroupChat() {
         el.classList.remove("selected");
     });
 
-    // Limpiar mensajes (o cargar mensajes grupales si los guardas)
     document.getElementById("messages").innerHTML = "";
+    chatKey = null; // forzar carga completa al volver a abrir el grupo
+
+    // Grupo "general" con los usuarios online: el backend envía cada
+    // mensaje en un solo broadcast y recoge los acuses de cada miembro
+    const members = users.filter(user => user.status === "online").map(user => user.mac);
+    fetch('/groups', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({name: "general", members: members})
+    })
+    .then(res => res.json())
+    .then(data => {
+        if (data.ok) {
+            currentGroupId = data.id;
+            loadGroupMessages();
+        }
+    })
+    .catch(err => console.error("Error creando grupo:", err));
+}
+
+// URL base de los mensajes del chat abierto
+function currentMessagesUrl() {
+    if (isGroupChat) return currentGroupId ? `/groups/${currentGroupId}/messages` : null;
+    return currentChat ? `/get_messages/${currentChat.mac}` : null;
+}
+
+// Cargar mensajes del grupo actual
+function loadGroupMessages() {
+    if (!isGroupChat || !currentGroupId) return Promise.resolve();
+    return syncMessages();
 }
 
 // Cargar mensajes desde el servidor
 function loadMessages(otherMac) {
     if (isGroupChat) return; // Los mensajes grupales no se cargan así
+    return syncMessages();
+}
 
-    fetch(`/get_messages/${otherMac}`)
-        .then(res => res.json())
-        .then(messages => {
-            renderMessages(messages);
+// Trae solo lo nuevo o modificado desde el último cursor. Al cambiar de
+// chat (o en la primera carga) pide la ventana reciente y redibuja todo.
+function syncMessages() {
+    const url = currentMessagesUrl();
+    if (!url) return Promise.resolve();
+
+    const fresh = url !== chatKey;
+    if (fresh) {
+        chatKey = url;
+        messageCursor = null;
+        messagesEtag = null;
+        oldestSeq = null;
+        hasOlder = false;
+    }
+    const query = messageCursor === null ? '' : `?after=${messageCursor}`;
+    const headers = messagesEtag ? {'If-None-Match': messagesEtag} : {};
+
+    return fetch(url + query, {headers: headers, cache: 'no-store'})
+        .then(res => {
+            if (res.status === 304) return null;
+            const etag = res.headers.get('ETag');
+            return res.json().then(data => ({data: data, etag: etag}));
+        })
+        .then(result => {
+            if (!result || url !== chatKey) return; // sin cambios o chat cambiado
+            const data = result.data;
+            if (messageCursor === null) {
+                renderMessages(data.messages);
+                hasOlder = !!data.has_older;
+            } else {
+                upsertMessages(data.messages);
+            }
+            messageCursor = data.cursor;
+            messagesEtag = result.etag;
+            if (data.more) return syncMessages();
         })
         .catch(err => console.error("Error al cargar mensajes:", err));
 }
 
-// Renderizar mensajes
-function renderMessages(messages) {
-    const messagesDiv = document.getElementById("messages");
-
-    // Guardar elementos de upload existentes
-    const existingUploads = Array.from(messagesDiv.querySelectorAll('.upload-in-progress'));
-
-    // Verificar si los mensajes normales son diferentes usando IDs
-    const currentNormalMessages = Array.from(messagesDiv.querySelectorAll('.message:not(.upload-in-progress)'));
-    const currentMessageIds = new Set(currentNormalMessages.map(div => div.dataset.messageId));
-    const newMessageIds = new Set(messages.map(m => m.id));
+// Id del chat abierto tal como lo nombra el servidor
+function currentChatId() {
+    if (isGroupChat) return currentGroupId ? `group:${currentGroupId}` : null;
+    return currentChat ? [currentUserMac, currentChat.mac].sort().join('-') : null;
+}
 
-    // Si los conjuntos de IDs son iguales, no hacer nada con mensajes normales
-    if (currentMessageIds.size === newMessageIds.size &&
-        [...currentMessageIds].every(id => newMessageIds.has(id))) {
+// Agrupa las sincronizaciones pedidas por eventos seguidos
+function requestSync() {
+    if (syncing) {
+        syncAgain = true;
         return;
     }
-
-    // Si hay cambios, limpiar solo mensajes normales que no existen en los nuevos
-    currentNormalMessages.forEach(el => {
-        const messageId = el.dataset.messageId;
-        if (!newMessageIds.has(messageId)) {
-            el.remove();
+    syncing = true;
+    syncMessages().finally(() => {
+        syncing = false;
+        if (syncAgain) {
+            syncAgain = false;
+            requestSync();
         }
     });
+}
+
+// Eventos del servidor (SSE): el chat se actualiza al instante. Si no hay
+// soporte o la conexión cae, el polling de startUserPolling sigue activo.
+function startPushEvents() {
+    if (!window.EventSource) return;
+    const source = new EventSource('/events');
+
+    source.onopen = () => {
+        pushConnected = true;
+        // lo ocurrido mientras no había conexión (o antes de abrirla)
+        fetchUsers();
+        requestSync();
+    };
+    source.onerror = () => {
+        // EventSource reintenta solo (con Last-Event-ID); mientras, polling
+        pushConnected = false;
+    };
+    source.addEventListener('chat', e => {
+        const data = JSON.parse(e.data);
+        if (data.chat === currentChatId()) requestSync();
+    });
+    source.addEventListener('peers', () => fetchUsers());
+    source.addEventListener('reset', () => {
+        fetchUsers();
+        requestSync();
+    });
+}
+
+// Backfill: página de mensajes anteriores al más viejo mostrado
+function loadOlderMessages() {
+    const url = chatKey;
+    if (!url || !hasOlder || loadingOlder || oldestSeq === null) return;
+    loadingOlder = true;
+
+    fetch(`${url}?before=${oldestSeq}&limit=50`)
+        .then(res => res.json())
+        .then(data => {
+            if (url !== chatKey) return;
+            hasOlder = data.has_older;
+            prependMessages(data.messages);
+        })
+        .catch(err => console.error("Error al cargar historial:", err))
+        .finally(() => {
+            loadingOlder = false;
+        });
+}
+
+function trackOldest(messages) {
+    messages.forEach(m => {
+        if (m.seq !== undefined && (oldestSeq === null || m.seq < oldestSeq)) oldestSeq = m.seq;
+    });
+}
+
+// Renderizar mensajes (reemplaza los del chat anterior)
+function renderMessages(messages) {
+    const messagesDiv = document.getElementById("messages");
+    messagesDiv.querySelectorAll('.message:not(.upload-in-progress)').forEach(el => el.remove());
+    upsertMessages(messages);
+}
+
+// Inserta los mensajes nuevos al final y redibuja en su sitio los que cambiaron
+function upsertMessages(messages) {
+    if (!messages.length) return;
+    const messagesDiv = document.getElementById("messages");
+    const firstUpload = messagesDiv.querySelector('.upload-in-progress');
 
-    // Renderizar solo mensajes nuevos
     messages.forEach(m => {
-        // Si el mensaje ya existe en el DOM, no hacer nada
-        if (document.querySelector(`[data-message-id="${m.id}"]`)) {
-            return;
+        const element = createMessageElement(m);
+        const existing = messagesDiv.querySelector(`[data-message-id="${m.id}"]`);
+        if (existing) {
+            element.classList.add("show");
+            existing.replaceWith(element);
+        } else {
+            // los envíos en curso quedan siempre al final
+            messagesDiv.insertBefore(element, firstUpload);
+            animateMessage(element, m);
         }
+    });
+    trackOldest(messages);
 
-        const messageElement = document.createElement("div");
-        const isMyMessage = m.sender === currentUserMac;
-        messageElement.className = `message ${isMyMessage ? 'msg-me' : 'msg-them'}`;
-        messageElement.dataset.messageId = m.id;
-
-        const timestamp = m.timestamp ? `<small class="timestamp">${m.timestamp}</small>` : '';
-
-        // Detectar si es mensaje de archivo normal
-        if (m.type === 'file' || (m.text && m.text.startsWith("[ARCHIVO]"))) {
-            messageElement.classList.add("file-message");
-            const filename = m.filename || m.text.replace("[ARCHIVO]", "");
-            const fileExtension = filename.split('.').pop().toLowerCase();
-
-            // Iconos por tipo de archivo
-            const fileIcons = {
-                'pdf': 'fa-file-pdf',
-                'doc': 'fa-file-word',
-                'docx': 'fa-file-word',
-                'txt': 'fa-file-alt',
-                'zip': 'fa-file-archive',
-                'rar': 'fa-file-archive',
-                'jpg': 'fa-file-image',
-                'jpeg': 'fa-file-image',
-                'png': 'fa-file-image',
-                'gif': 'fa-file-image',
-                'mp4': 'fa-file-video',
-                'mp3': 'fa-file-audio'
-            };
-
-            const fileIcon = fileIcons[fileExtension] || 'fa-file';
-
-            messageElement.innerHTML = `
-                <div class="file-message-container ${isMyMessage ? 'own-file' : 'other-file'}">
-                    <div class="file-icon">
-                        <i class="fas ${fileIcon}"></i>
-                    </div>
-                    <div class="file-info">
-                        <div class="file-name">${filename}</div>
-                        <div class="file-actions">
-                            <button onclick="downloadFile('${m.id}')" class="download-btn">
-                                <i class="fas fa-download"></i>
-                            </button>
-                        </div>
-                    </div>
+    messagesDiv.scrollTop = messagesDiv.scrollHeight;
+}
+
+// Agrega al principio una página de historial sin mover la vista
+function prependMessages(messages) {
+    if (!messages.length) return;
+    const messagesDiv = document.getElementById("messages");
+    const previousHeight = messagesDiv.scrollHeight;
+    const first = messagesDiv.firstChild;
+
+    messages.forEach(m => {
+        if (messagesDiv.querySelector(`[data-message-id="${m.id}"]`)) return;
+        const element = createMessageElement(m);
+        element.classList.add("show");
+        messageAnimations.add(m.id);
+        messagesDiv.insertBefore(element, first);
+    });
+    trackOldest(messages);
+
+    messagesDiv.scrollTop += messagesDiv.scrollHeight - previousHeight;
+}
+
+function animateMessage(element, m) {
+    // Solo animar si es un mensaje nuevo (no durante refresh)
+    if (!messageAnimations.has(m.id)) {
+        setTimeout(() => element.classList.add("show"), 50);
+        messageAnimations.add(m.id);
+    } else {
+        // Si ya fue animado antes, mostrarlo directamente
+        element.classList.add("show");
+    }
+}
+
+// Construye el elemento DOM de un mensaje
+function createMessageElement(m) {
+    const messageElement = document.createElement("div");
+    const isMyMessage = m.sender === currentUserMac;
+    messageElement.className = `message ${isMyMessage ? 'msg-me' : 'msg-them'}`;
+    messageElement.dataset.messageId = m.id;
+    if (m.status) messageElement.dataset.status = m.status;
+
+    const timestamp = m.timestamp ? `<small class="timestamp">${m.timestamp}</small>` : '';
+
+    // Detectar si es mensaje de archivo normal
+    if (m.type === 'file' || (m.text && m.text.startsWith("[ARCHIVO]"))) {
+        messageElement.classList.add("file-message");
+        const filename = m.filename || m.text.replace("[ARCHIVO]", "");
+        const fileExtension = filename.split('.').pop().toLowerCase();
+
+        // Iconos por tipo de archivo
+        const fileIcons = {
+            'pdf': 'fa-file-pdf',
+            'doc': 'fa-file-word',
+            'docx': 'fa-file-word',
+            'txt': 'fa-file-alt',
+            'zip': 'fa-file-archive',
+            'rar': 'fa-file-archive',
+            'jpg': 'fa-file-image',
+            'jpeg': 'fa-file-image',
+            'png': 'fa-file-image',
+            'gif': 'fa-file-image',
+            'mp4': 'fa-file-video',
+            'mp3': 'fa-file-audio'
+        };
+
+        const fileIcon = fileIcons[fileExtension] || 'fa-file';
+
+        // Mientras se recibe se puede ver en streaming
+        const streamButton = m.status === 'receiving' ? `
+                        <button onclick="streamFile('${m.id}')" class="download-btn" title="Ver mientras se recibe">
+                            <i class="fas fa-play"></i>
+                        </button>` : '';
+
+        messageElement.innerHTML = `
+            <div class="file-message-container ${isMyMessage ? 'own-file' : 'other-file'}">
+                <div class="file-icon">
+                    <i class="fas ${fileIcon}"></i>
                 </div>
-                ${timestamp}
-            `;
-        }
-        // Detectar si es mensaje de carpeta (nuevo)
-        else if (m.type === 'folder' || (m.text && m.text.startsWith("[CARPETA]"))) {
-            messageElement.classList.add("file-message");
-            const folderName = m.filename ? m.filename.replace('.zip', '') : m.text.replace("[CARPETA]", "");
-
-            messageElement.innerHTML = `
-                <div class="file-message-container ${isMyMessage ? 'own-file' : 'other-file'}">
-                    <div class="file-icon">
-                        <i class="fas fa-folder"></i>
+                <div class="file-info">
+                    <div class="file-name">${filename}</div>
+                    <div class="file-actions">${jobControls(m, isMyMessage)}${streamButton}
+                        ${m.file_path !== null ? `<button onclick="downloadFile('${m.id}')" class="download-btn">
+                            <i class="fas fa-download"></i>
+                        </button>` : ''}
                     </div>
-                    <div class="file-info">
-                        <div class="file-name">${folderName}</div>
-                        <div class="file-actions">
-                            <button onclick="downloadFile('${m.id}')" class="download-btn">
-                                <i class="fas fa-download"></i>
-                            </button>
-                        </div>
+                </div>
+            </div>
+            ${timestamp}
+        `;
+    }
+    // Detectar si es mensaje de carpeta (nuevo)
+    else if (m.type === 'folder' || (m.text && m.text.startsWith("[CARPETA]"))) {
+        messageElement.classList.add("file-message");
+        const folderName = m.filename ? m.filename.replace('.zip', '') : m.text.replace("[CARPETA]", "");
+
+        messageElement.innerHTML = `
+            <div class="file-message-container ${isMyMessage ? 'own-file' : 'other-file'}">
+                <div class="file-icon">
+                    <i class="fas fa-folder"></i>
+                </div>
+                <div class="file-info">
+                    <div class="file-name">${folderName}</div>
+                    <div class="file-actions">${jobControls(m, isMyMessage)}
+                        ${m.folder_path ? `<button onclick="downloadFile('${m.id}')" class="download-btn">
+                            <i class="fas fa-download"></i>
+                        </button>` : ''}
                     </div>
                 </div>
-                ${timestamp}
-            `;
-        } else {
-            // Mensaje de texto normal
-            messageElement.innerHTML = `${m.text} ${timestamp}`;
+            </div>
+            ${timestamp}
+        `;
+    } else {
+        // Mensaje de texto normal (en grupos: autor y acuses de entrega)
+        let author = '';
+        if (isGroupChat && !isMyMessage) {
+            const user = users.find(u => u.mac === m.sender);
+            author = `<small class="author">${user && user.name ? user.name : m.sender}</small> `;
         }
+        const receipts = m.members !== undefined ? ` <small class="receipts" title="Entregado">✓ ${m.status}</small>` : '';
+        messageElement.innerHTML = `${author}${m.text} ${timestamp}${receipts}`;
+    }
 
-        messagesDiv.appendChild(messageElement);
+    return messageElement;
+}
 
-        // Solo animar si es un mensaje nuevo (no durante refresh)
-        if (!messageAnimations.has(m.id)) {
-            setTimeout(() => messageElement.classList.add("show"), 50);
-            messageAnimations.add(m.id);
-        } else {
-            // Si ya fue animado antes, mostrarlo directamente
-            messageElement.classList.add("show");
-        }
-    });
+// Estado del trabajo de envío de un archivo/carpeta propio (ver /jobs)
+const JOB_STATUS_LABELS = {
+    queued: 'En cola',
+    sending: 'Enviando…',
+    failed: 'Error al enviar',
+    cancelled: 'Cancelado'
+};
+
+function jobControls(m, isMyMessage) {
+    if (!isMyMessage || !JOB_STATUS_LABELS[m.status]) return '';
+    const cancelButton = m.job_id && (m.status === 'queued' || m.status === 'sending') ? `
+                        <button onclick="cancelJob('${m.job_id}')" class="download-btn" title="Cancelar envío">
+                            <i class="fas fa-times"></i>
+                        </button>` : '';
+    return `<small class="job-status">${JOB_STATUS_LABELS[m.status]}</small>${cancelButton}`;
+}
 
-    // Re-agregar elementos de upload
-    existingUploads.forEach(uploadEl => {
-        messagesDiv.appendChild(uploadEl);
-    });
+function cancelJob(jobId) {
+    fetch(`/jobs/${jobId}/cancel`, { method: 'POST' })
+        .then(() => requestSync())
+        .catch(err => console.error("Error cancelando envío:", err));
+}
 
-    messagesDiv.scrollTop = messagesDiv.scrollHeight;
+// Ver un archivo mientras todavía se está recibiendo
+function streamFile(fileId) {
+    window.open(`/stream_file/${fileId}`, '_blank');
 }
 
 // Añade esta función para descargar archivos
@@ -346,36 +555,19 @@ function sendMessage() {
     if(!text) return;
 
     if (isGroupChat) {
-        // Enviar a todos los usuarios online
-        const onlineUsers = users.filter(user => user.status === "online");
-        let sentCount = 0;
-
-        onlineUsers.forEach(user => {
-            fetch('/send_message', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    other_mac: user.mac,
-                    message: text
-                })
-            })
-            .then(res => res.json())
-            .then(data => {
-                if(data.success) sentCount++;
-            })
-            .catch(err => console.error("Error enviando mensaje grupal:", err));
-        });
+        if (!currentGroupId) return alert("El grupo todavía no está listo.");
 
-        // Mostrar mensaje localmente
-        const messagesDiv = document.getElementById("messages");
-        const p = document.createElement("p");
-        p.className = "msg-me";
-        p.innerHTML = `${text} <small class="timestamp">${new Date().toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'})}</small>`;
-        messagesDiv.appendChild(p);
-        setTimeout(() => p.classList.add("show"), 50);
-        messagesDiv.scrollTop = messagesDiv.scrollHeight;
-
-        console.log(`Mensaje grupal enviado a ${sentCount} usuarios`);
+        // Un solo envío: el backend lo difunde al grupo
+        fetch(`/groups/${currentGroupId}/send`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({message: text})
+        })
+        .then(res => res.json())
+        .then(data => {
+            if(data.success) loadGroupMessages();
+        })
+        .catch(err => console.error("Error enviando mensaje grupal:", err));
 
     } else if(currentChat) {
         // Enviar mensaje individual
@@ -407,14 +599,27 @@ function sendFile(file) {
     const uploadId = 'upload_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9);
 
     if (isGroupChat) {
-        // Enviar archivo a todos los usuarios online
+        // Enviar archivo a todos los usuarios online en un único envío broadcast
         const onlineUsers = users.filter(user => user.status === "online");
-        let sentCount = 0;
 
-        onlineUsers.forEach(user => {
-            console.log(`Enviando archivo ${fileName} a ${user.mac}`);
-            sentCount++;
-        });
+        const formData = new FormData();
+        formData.append('file', file);
+        onlineUsers.forEach(user => formData.append('receivers', user.mac));
+
+        fetch('/upload_file_group', {
+            method: 'POST',
+            body: formData
+        })
+        .then(res => res.json())
+        .then(data => {
+            if (data.success) {
+                const sentCount = data.report.complete.length;
+                console.log(`Archivo '${fileName}' entregado a ${sentCount} de ${onlineUsers.length} usuarios`);
+            } else {
+                alert("Error al enviar archivo: " + (data.error || "Error desconocido"));
+            }
+        })
+        .catch(err => console.error("Error enviando archivo grupal:", err));
 
         // Mostrar mensaje de archivo localmente
         const messagesDiv = document.getElementById("messages");
@@ -425,21 +630,20 @@ function sendFile(file) {
         setTimeout(() => p.classList.add("show"), 50);
         messagesDiv.scrollTop = messagesDiv.scrollHeight;
 
-        alert(`Archivo '${fileName}' enviado a ${sentCount} usuarios`);
 
     } else if(currentChat) {
         // Mostrar mensaje de subida en progreso
         showUploadInProgress('file', fileName, uploadId);
 
-        const formData = new FormData();
-        formData.append('file', file);
-        formData.append('other_mac', currentChat.mac);
+        // Cuerpo crudo: el servidor lo reenvía al peer mientras llega y
+        // anuncia el tamaño (Content-Length) en FILE_START
+        const params = new URLSearchParams({ other_mac: currentChat.mac, filename: fileName });
 
         // Usar XMLHttpRequest para el envío real
         const xhr = new XMLHttpRequest();
 
         xhr.addEventListener('load', () => {
-            if (xhr.status === 200) {
+            if (xhr.status >= 200 && xhr.status < 300) {
                 const data = JSON.parse(xhr.responseText);
                 if(data.success) {
                     completeUpload(uploadId);
@@ -466,8 +670,9 @@ function sendFile(file) {
             alert("Error de conexión al enviar archivo");
         });
 
-        xhr.open('POST', '/upload_file');
-        xhr.send(formData);
+        xhr.open('POST', `/upload_file?${params}`);
+        xhr.setRequestHeader('Content-Type', 'application/octet-stream');
+        xhr.send(file);
     }
 }
 
@@ -515,25 +720,12 @@ function startUserPolling() {
     let isPolling = false;
 
     setInterval(() => {
-        if (isPolling) return;
+        if (isPolling || pushConnected) return;
 
         isPolling = true;
-        fetch('/get_users')
-            .then(res => res.json())
-            .then(data => {
-                users = data;
-                applySavedNames();
-                loadChats();
-
-                // Si hay un chat abierto, recargar sus mensajes también
-                if(currentChat && !isGroupChat) {
-                    return fetch(`/get_messages/${currentChat.mac}`)
-                        .then(res => res.json())
-                        .then(messages => {
-                            renderMessages(messages);
-                        });
-                }
-            })
+        // ambas peticiones son condicionales: sin cambios cuestan un 304
+        fetchUsers()
+            .then(() => syncMessages())
             .catch(err => console.error(err))
             .finally(() => {
                 isPolling = false;
@@ -545,6 +737,12 @@ function startUserPolling() {
 document.addEventListener("DOMContentLoaded", () => {
     fetchUsers();
     startUserPolling();
+    startPushEvents();
+
+    // Al llegar arriba del todo se pide la página anterior del historial
+    document.getElementById("messages").addEventListener("scroll", e => {
+        if (e.target.scrollTop === 0) loadOlderMessages();
+    });
 
     // --- NUEVO: input y botón para enviar carpetas ---
     // Crear input hidden webkitdirectory
@@ -606,7 +804,7 @@ document.addEventListener("DOMContentLoaded", () => {
                 const xhr = new XMLHttpRequest();
 
                 xhr.addEventListener('load', () => {
-                    if (xhr.status === 200) {
+                    if (xhr.status >= 200 && xhr.status < 300) {
                         const data = JSON.parse(xhr.responseText);
                         if (data.ok) {
                             completeUpload(uploadId);
@@ -632,7 +830,8 @@ document.addEventListener("DOMContentLoaded", () => {
                     alert("Error de conexión al enviar carpeta");
                 });
 
-                xhr.open("POST", "/upload_folder");
+                // dest_mac también en la URL: el servidor lee el cuerpo en flujo
+                xhr.open("POST", "/upload_folder?dest_mac=" + encodeURIComponent(destMac));
                 xhr.send(fd);
 
             } catch (err) {
@@ -0,0 +1,326 @@
+"""
+Lectura incremental de cuerpos multipart/form-data.
+A diferencia de request.files, no se guarda nada en disco ni en memoria:
+cada archivo se lee del socket a medida que el consumidor lo pide.
+UploadPipe conecta una subida con el envío por la red que corre en otro
+hilo, para no tener que guardar el archivo completo antes de enviarlo;
+FolderPipe hace lo mismo con los archivos de una carpeta.
+"""
+import os
+import struct
+import tempfile
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterator, Optional, Tuple, Union
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    Field,
+    File,
+    MultipartDecoder,
+    NeedData,
+)
+
+READ_SIZE = 64 * 1024
+PIPE_MEMORY = int(os.getenv("LINKCHAT_UPLOAD_BUFFER", str(8 * 1024 * 1024)))
+SPOOL_SEGMENT = 1024 * 1024  # bytes máximos por lectura del spool
+
+
+class UploadPart:
+    """Un archivo del formulario. Debe consumirse antes de pedir el siguiente."""
+
+    def __init__(self, form: "MultipartStream", name: str, filename: str):
+        self._form = form
+        self.name = name
+        self.filename = filename
+        self._buf = bytearray()
+        self._done = False
+
+    def read(self, n: int = -1) -> bytes:
+        while (n < 0 or len(self._buf) < n) and not self._done:
+            event = self._form._next_event()
+            if isinstance(event, Data):
+                self._buf += event.data
+                if not event.more_data:
+                    self._done = True
+            else:
+                self._done = True
+        if n < 0:
+            n = len(self._buf)
+        out = bytes(self._buf[:n])
+        del self._buf[:n]
+        return out
+
+    def drain(self) -> None:
+        while self.read(READ_SIZE):
+            pass
+
+
+class MultipartStream:
+    def __init__(self, stream, content_type: str):
+        mimetype, options = parse_options_header(content_type or "")
+        boundary = options.get("boundary")
+        if mimetype != "multipart/form-data" or not boundary:
+            raise ValueError("se esperaba multipart/form-data con boundary")
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary.encode("latin-1"))
+        self._current: Optional[UploadPart] = None
+        self.fields: Dict[str, str] = {}
+
+    def _next_event(self):
+        while True:
+            event = self._decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+            data = self._stream.read(READ_SIZE)
+            self._decoder.receive_data(data or None)
+            if not data and self._decoder.complete and not self._decoder.buffer:
+                return Epilogue(data=b"")
+
+    def parts(self) -> Iterator[UploadPart]:
+        """
+        Genera los archivos en el orden del cuerpo. Los campos de texto que
+        aparecen entre medio quedan en self.fields.
+        """
+        while True:
+            if self._current is not None:
+                self._current.drain()
+                self._current = None
+            event = self._next_event()
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, Field):
+                value = bytearray()
+                while True:
+                    data = self._next_event()
+                    if not isinstance(data, Data):
+                        break
+                    value += data.data
+                    if not data.more_data:
+                        break
+                self.fields[event.name] = value.decode("utf-8", errors="replace")
+            elif isinstance(event, File):
+                self._current = UploadPart(self, event.name, event.filename)
+                yield self._current
+
+
+class UploadPipe:
+    """
+    Tubo entre la subida HTTP (write) y el envío por la red (read, desde
+    otro hilo). Hasta `memory` bytes esperan en RAM; si el peer va más lento
+    que el navegador, lo que no entra se vuelca a un temporal en spool_dir
+    y se lee de ahí en orden, así la subida nunca se frena por la red. El
+    temporal se trunca cada vez que el lector lo alcanza.
+    """
+
+    def __init__(self, spool_dir: Optional[str] = None, memory: int = PIPE_MEMORY):
+        self.spool_dir = spool_dir
+        self.memory = memory
+        # bytes en RAM o (offset, largo) en el spool, en orden de llegada
+        self._segments: Deque[Union[bytes, Tuple[int, int]]] = deque()
+        self._mem = 0
+        self._spool = None  # se crea con el primer desborde
+        self._spool_end = 0
+        self._spooled = 0  # bytes del spool aún sin leer
+        self._cond = threading.Condition()
+        self._eof = False
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._buf = memoryview(b"")  # resto del último segmento (lector)
+        self.written = 0
+        self.spilled = 0  # bytes que pasaron por disco
+
+    # --- Lado de la subida ---------------------------------------------------
+
+    def write(self, data: bytes) -> None:
+        """Nunca bloquea. BrokenPipeError si el envío ya terminó."""
+        if not data:
+            return
+        with self._cond:
+            if self._closed:
+                raise BrokenPipeError("el envío ya terminó")
+            if self._mem + len(data) <= self.memory:
+                self._segments.append(bytes(data))
+                self._mem += len(data)
+            else:
+                self._spill(data)
+            self.written += len(data)
+            self._cond.notify_all()
+
+    def _spill(self, data: bytes) -> None:
+        """Agrega data al final del spool (con _cond tomado)."""
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile(
+                prefix=".upload-", dir=self.spool_dir
+            )
+        os.pwrite(self._spool.fileno(), data, self._spool_end)
+        last = self._segments[-1] if self._segments else None
+        if (
+            isinstance(last, tuple)
+            and last[0] + last[1] == self._spool_end
+            and last[1] + len(data) <= SPOOL_SEGMENT
+        ):
+            self._segments[-1] = (last[0], last[1] + len(data))
+        else:
+            self._segments.append((self._spool_end, len(data)))
+        self._spool_end += len(data)
+        self._spooled += len(data)
+        self.spilled += len(data)
+
+    def finish(self) -> None:
+        """Fin de la subida: el lector recibe b"" al vaciar el tubo."""
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def abort(self, error: BaseException) -> None:
+        """La subida se cortó: el próximo read() lanza error."""
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+    # --- Lado del envío ------------------------------------------------------
+
+    def _next_segment(self) -> memoryview:
+        with self._cond:
+            while True:
+                if self._error is not None:
+                    raise self._error
+                if self._segments:
+                    break
+                if self._eof or self._closed:
+                    return memoryview(b"")
+                self._cond.wait()
+            seg = self._segments.popleft()
+            if isinstance(seg, bytes):
+                self._mem -= len(seg)
+                return memoryview(seg)
+            offset, length = seg
+            data = os.pread(self._spool.fileno(), length, offset)
+            self._spooled -= length
+            if not self._spooled:
+                self._spool.truncate(0)
+                self._spool_end = 0
+            return memoryview(data)
+
+    def read(self, n: int = -1) -> bytes:
+        """
+        Bloquea hasta tener n bytes (o el fin de la subida): los chunks que
+        salen a la red tienen siempre el tamaño pedido salvo el último.
+        """
+        out = bytearray()
+        while n < 0 or len(out) < n:
+            if not self._buf:
+                self._buf = self._next_segment()
+                if not self._buf:
+                    break
+            take = len(self._buf) if n < 0 else n - len(out)
+            out += self._buf[:take]
+            self._buf = self._buf[take:]
+        return bytes(out)
+
+    def close(self) -> None:
+        """Lo llama el envío al terminar: libera el spool y corta write()."""
+        with self._cond:
+            self._closed = True
+            self._segments.clear()
+            self._mem = 0
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+            self._cond.notify_all()
+
+
+_NAME = struct.Struct(">H")  # largo de la ruta relativa
+_BLOCK = struct.Struct(">I")  # largo de un bloque de datos; 0 = fin del archivo
+
+
+class _FramedReader:
+    """Contenido de un archivo dentro del tubo de una FolderPipe."""
+
+    def __init__(self, pipe: UploadPipe):
+        self._pipe = pipe
+        self._left = 0  # bytes que quedan del bloque actual
+        self._done = False
+
+    def _read_exact(self, n: int) -> bytes:
+        data = self._pipe.read(n)
+        if len(data) < n:
+            raise IOError("flujo de carpeta truncado")
+        return data
+
+    def read(self, n: int = -1) -> bytes:
+        out = bytearray()
+        while (n < 0 or len(out) < n) and not self._done:
+            if not self._left:
+                (self._left,) = _BLOCK.unpack(self._read_exact(_BLOCK.size))
+                if not self._left:
+                    self._done = True
+                    break
+            take = self._left if n < 0 else min(self._left, n - len(out))
+            out += self._read_exact(take)
+            self._left -= take
+        return bytes(out)
+
+    def drain(self) -> None:
+        while self.read(READ_SIZE):
+            pass
+
+
+class FolderPipe:
+    """
+    Una carpeta en flujo sobre un único UploadPipe: la subida escribe los
+    archivos uno tras otro (begin/write/end) y el envío los recorre con
+    entries() como pares (ruta relativa, lector). Cada archivo va como su
+    ruta y bloques con prefijo de largo, así no hace falta conocer los
+    tamaños de antemano.
+    """
+
+    def __init__(self, spool_dir: Optional[str] = None, memory: int = PIPE_MEMORY):
+        self.pipe = UploadPipe(spool_dir, memory)
+        self.files = 0
+        self.bytes = 0
+
+    # --- Lado de la subida ---------------------------------------------------
+
+    def begin(self, rel: str) -> None:
+        name = rel.encode("utf-8")
+        self.pipe.write(_NAME.pack(len(name)) + name)
+
+    def write(self, data: bytes) -> None:
+        if data:
+            self.pipe.write(_BLOCK.pack(len(data)) + data)
+            self.bytes += len(data)
+
+    def end(self) -> None:
+        self.pipe.write(_BLOCK.pack(0))
+        self.files += 1
+
+    def finish(self) -> None:
+        self.pipe.finish()
+
+    def abort(self, error: BaseException) -> None:
+        self.pipe.abort(error)
+
+    # --- Lado del envío ------------------------------------------------------
+
+    def entries(self) -> Iterator[Tuple[str, _FramedReader]]:
+        """
+        Pares (ruta relativa, lector) en el orden de la subida. Lo que el
+        consumidor no leyó de un archivo se descarta al pedir el siguiente.
+        """
+        while True:
+            head = self.pipe.read(_NAME.size)
+            if not head:
+                return
+            if len(head) < _NAME.size:
+                raise IOError("flujo de carpeta truncado")
+            (size,) = _NAME.unpack(head)
+            reader = _FramedReader(self.pipe)
+            yield reader._read_exact(size).decode("utf-8"), reader
+            reader.drain()
+
+    def close(self) -> None:
+        self.pipe.close()